@@ -1,94 +1,226 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import os
-import tempfile
+import sys
+import json
+import functools
+import hmac
+import threading
+import time
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Filter, FieldCondition, MatchValue
-from sentence_transformers import SentenceTransformer
-from config import EmbeddingCfg, QdrantCfg, ChunkCfg, LLMCfg
+from config import EmbeddingCfg, QdrantCfg, ChunkCfg, LLMCfg, UploadCfg, SearchCfg, CompressCfg, AdminCfg
 from ingest import (
-    load_text_from_file,
+    iter_file_chunks,
     ensure_collection,
     embedder,
-    upsert_chunks
+    upsert_chunks,
+    skip_unchanged,
+    apply_incremental,
+    parent_collection,
+    parent_ids_of,
+    prune_parents,
+    delete_points,
+    dedup_index,
+    drop_near_duplicates,
+    apply_duplicates,
+    release_duplicates,
+    collection_names,
+    resolve_collection,
+    check_collection_models,
+    ModelMismatch
 )
-from utils_chunk import greedy_chunk_by_tokens
 from query import (
     load_embedder,
     load_llm,
     search,
+    llm_paraphrases,
+    compress_contexts,
     build_prompt,
-    chat
+    chat,
+    answer_batch
 )
+from tenants import TenantRouter, TenantError
+import chunk_cache
+import migrate
+from upload import iter_uploaded_files, UploadError, UploadTooLarge
 
 app = Flask(__name__)
+# 管理用 API（埋め込みモデルの移行など全テナントに影響する操作）。テナント向けの app とは別のポートで動かす
+admin_app = Flask(__name__ + '.admin')
 
 # 設定
 EMB = EmbeddingCfg()
 QDR = QdrantCfg()
 CH = ChunkCfg()
 LLM = LLMCfg()
+UPLOAD = UploadCfg()
+SRCH = SearchCfg()
+COMP = CompressCfg()
+ADMIN = AdminCfg()
 
 # アップロード許可する拡張子
-ALLOWED_EXTENSIONS = {'txt', 'md', 'pdf', 'json'}
+ALLOWED_EXTENSIONS = {'txt', 'md', 'pdf', 'json', 'jsonl'}
+MAX_TOP_K = 50   # /question の top_k の上限
 
 # LLMとEmbedderをグローバルで保持（初回ロード後は再利用）
 _embedder_cache = None
 _llm_cache = None
 _tokenizer_cache = None
+_llm_loaded = False
+# 起動時のバックグラウンドロードとリクエストからのロードが重ならないように
+_embedder_lock = threading.Lock()
+_llm_lock = threading.Lock()
+# /ready 用の読み込み状況
+_startup = {'started_at': time.time(), 'error': None}
 
 def get_cached_embedder():
     """埋め込みモデルをキャッシュして再利用"""
     global _embedder_cache
     if _embedder_cache is None:
-        print("[INFO] Loading embedder model...")
-        _embedder_cache = load_embedder()
+        with _embedder_lock:
+            if _embedder_cache is None:
+                print("[INFO] Loading embedder model...")
+                _embedder_cache = load_embedder()
     return _embedder_cache
 
 def get_cached_llm():
     """LLMとトークナイザーをキャッシュして再利用"""
-    global _llm_cache, _tokenizer_cache
-    if _llm_cache is None or _tokenizer_cache is None:
-        if LLM.model_type == "openai":
-            print("[INFO] Using OpenAI API model...")
-            _tokenizer_cache, _llm_cache = None, None
-        else:
-            print("[INFO] Loading local LLM model (this may take a while)...")
-            _tokenizer_cache, _llm_cache = load_llm()
+    global _llm_cache, _tokenizer_cache, _llm_loaded
+    if not _llm_loaded:
+        with _llm_lock:
+            if not _llm_loaded:
+                if LLM.model_type == "openai":
+                    print("[INFO] Using OpenAI API model...")
+                    _tokenizer_cache, _llm_cache = None, None
+                else:
+                    print("[INFO] Loading local LLM model (this may take a while)...")
+                    _tokenizer_cache, _llm_cache = load_llm()
+                _llm_loaded = True
     return _tokenizer_cache, _llm_cache
 
+def preload_models():
+    """埋め込みモデルと LLM を読み込む（起動時にバックグラウンドスレッドで実行）"""
+    t0 = time.perf_counter()
+    try:
+        print("[STARTUP] Pre-loading embedder model...")
+        get_cached_embedder()
+        print("[STARTUP] Pre-loading LLM model...")
+        get_cached_llm()
+        print(f"[STARTUP] All models loaded in {time.perf_counter() - t0:.1f}s")
+    except Exception as e:
+        _startup['error'] = str(e)
+        print(f"[ERROR] Model preload failed: {e}")
+
+# テナントごとのコレクション/キャッシュ/同時実行数を管理（Qdrantクライアントは共有）
+router = TenantRouter()
+
+# アップロード受信と並行してチャンク化するワーカー
+_upload_pool = ThreadPoolExecutor(max_workers=UPLOAD.workers)
+
+def tenant_scoped(view):
+    """リクエストのテナントを解決し、同時実行枠を確保してから view(tenant, ...) を呼ぶ"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            tenant = router.from_request(request)
+            with router.slot(tenant):
+                return view(tenant, *args, **kwargs)
+        except TenantError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), e.status
+    return wrapper
+
+def write_gated(destructive: bool = False):
+    """埋め込みモデルの切り替え中は書き込みを止める（destructive は移行中ずっと拒否）"""
+    def deco(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                with migrate.writing(destructive):
+                    return view(*args, **kwargs)
+            except migrate.MigrationError as e:
+                return jsonify({
+                    'success': False,
+                    'message': str(e)
+                }), e.status
+        return wrapper
+    return deco
+
+def admin_token() -> str:
+    return ADMIN.token or os.getenv('RAG_ADMIN_TOKEN', '')
+
+def admin_only(view):
+    """管理用トークンを確認する（未設定ならローカルにだけ公開している前提で通す）"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = admin_token()
+        if token and not hmac.compare_digest(request.headers.get(ADMIN.header, ''), token):
+            return jsonify({
+                'success': False,
+                'message': '管理用トークンが必要です'
+            }), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def format_contexts(contexts: List[Dict]) -> List[Dict]:
+    """レスポンス用のコンテキスト情報（本文はプレビューのみ。命中した子チャンクの本文は match_text）"""
+    context_info = []
+    for i, ctx in enumerate(contexts, 1):
+        context_info.append({
+            'index': i,
+            'source': ctx.get('source', ''),
+            'title': ctx.get('title', ''),
+            'page': ctx.get('page', ''),
+            'chunk_id': ctx.get('chunk_id', ''),
+            'dup_sources': ctx.get('dup_sources', []),
+            'text_preview': ctx.get('text', '')[:200] + '...' if len(ctx.get('text', '')) > 200 else ctx.get('text', ''),
+            # 親子チャンクで命中した子の本文（text は親の本文。圧縮後もこちらはそのまま）
+            'match_text': ctx.get('match_text', '')
+        })
+    return context_info
+
+def parse_top_k(data: Dict) -> Optional[int]:
+    """リクエストの top_k（省略時 5）。1〜MAX_TOP_K の整数でなければ None"""
+    top_k = data.get('top_k', 5)
+    if isinstance(top_k, bool) or not isinstance(top_k, (int, str)):
+        return None
+    try:
+        top_k = int(top_k)
+    except ValueError:
+        return None
+    return top_k if 1 <= top_k <= MAX_TOP_K else None
+
 def allowed_file(filename: str) -> bool:
     """ファイル拡張子が許可されているかチェック"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_file_to_chunks(filepath: str, filename: str) -> List[Dict]:
-    """ファイルをチャンクに分割してメタデータを付与"""
-    text = load_text_from_file(filepath)
-    if not text.strip():
-        return []
-    
-    chunks = greedy_chunk_by_tokens(
-        text,
-        target_tokens=CH.target_tokens,
-        overlap_tokens=CH.overlap_tokens,
-        min_chars=CH.min_chars,
-    )
-    
-    all_chunks = []
-    for i, ch in enumerate(chunks):
-        all_chunks.append({
-            "text": ch,
-            "source": filename,
-            "chunk_id": i
-        })
-    
-    return all_chunks
+def process_file_to_chunks(src, filename: str) -> List[Dict]:
+    """ファイル（パスまたは受信バッファ）をチャンクに分割してメタデータを付与（JSON/JSONLはレコード単位）"""
+    return list(iter_file_chunks(src, filename))
+
+def chunk_upload(tenant, client, filename: str, buf) -> Tuple[str, List[Dict], List, List]:
+    """受信済みバッファをチャンク化し、既存と同一のチャンクを除外する（ワーカースレッドで実行）"""
+    reused, stale = [], []
+    try:
+        chunks = tenant.tag(list(skip_unchanged(
+            client, tenant.collection, filename,
+            process_file_to_chunks(buf, filename), reused, stale,
+            scope=tenant.scope,
+        )))
+    finally:
+        buf.close()
+    return filename, chunks, reused, stale
 
 @app.route('/embedd', methods=['POST'])
-def embedd_files():
+@tenant_scoped
+@write_gated()
+def embedd_files(tenant):
     """
     PDFやテキストファイルを受け取り、ベクトル化してQdrantに保存
 
@@ -96,101 +228,128 @@ def embedd_files():
       - files: アップロードするファイル（複数可）
       - file:  単一ファイル（後方互換）
 
+    本文は request.stream から逐次パースし、受信し終えたファイルから順にチャンク化する。
+    サイズ上限（UploadCfg）を超えた時点で 413 を返す。
+
     レスポンス:
       - success, message, processed_files, total_chunks など
     """
-    # 受信ログ（デバッグ用）
-    print("Content-Type:", request.content_type)
-    print("Headers:", dict(request.headers))
-    print("Form keys:", list(request.form.keys()))
-    print("Files keys:", list(request.files.keys()))
+    # 受信ログ（ヘッダー全体は出さない）
+    print(f"[EMBEDD] Content-Type: {request.mimetype}, Content-Length: {request.content_length}")
 
     try:
-        # --- フィールド名の互換吸収（'files' 優先、次に 'file'） ---
-        incoming_files = []
-        if 'files' in request.files:
-            incoming_files = request.files.getlist('files')
-        elif 'file' in request.files:
-            single = request.files.get('file')
-            if single:
-                incoming_files = [single]
-
-        if not incoming_files:
+        boundary = request.mimetype_params.get('boundary', '')
+        if request.mimetype != 'multipart/form-data' or not boundary:
             return jsonify({
                 'success': False,
-                'message': "ファイルが送信されていません（期待するフィールド名: 'files' または 'file'）。",
+                'message': "multipart/form-data で送信してください（期待するフィールド名: 'files' または 'file'）。",
                 'debug': {
-                    'files_keys': list(request.files.keys()),
-                    'form_keys': list(request.form.keys()),
                     'content_type': request.content_type
                 }
             }), 400
-
-        # --- 空ファイルや無名ファイルを除外 ---
-        files = [f for f in incoming_files if f and getattr(f, 'filename', '').strip() != '']
-        if not files:
-            return jsonify({
-                'success': False,
-                'message': 'ファイルが選択されていません（filenameが空）。'
-            }), 400
+        # Content-Length が分かっていれば本文を読む前に拒否する
+        if request.content_length and request.content_length > UPLOAD.max_request_bytes:
+            raise UploadTooLarge(f"リクエストが上限（{UPLOAD.max_request_bytes} bytes）を超えています")
 
         # Qdrantクライアントと埋め込みモデルの初期化
-        client = QdrantClient(host=QDR.host, port=QDR.port)
+        client = router.client()
         model = embedder()  # 既存の関数名に合わせています
         dim = model.encode(["dim_check"], normalize_embeddings=EMB.normalize).shape[-1]
-        ensure_collection(client, dim, QDR.collection)
+        ensure_collection(client, dim, tenant.collection)
+        router.ensure_tenant_index(tenant)
 
         all_chunks = []
         processed_files = []
+        received_filenames = []
+        # 同名ファイルの再アップロード時は、内容の変わったチャンクだけ埋め込み直す
+        reused, stale = [], []
 
-        # 各ファイルを処理
-        for file in files:
-            filename = secure_filename(file.filename)
-            if not allowed_file(filename):
-                print(f"[SKIP] 非対応拡張子: {filename}")
-                continue
+        # 受信済みのファイルから順にチャンク化を始める（後続ファイルの受信と並行）
+        futures = []
+        try:
+            for _, raw_name, buf in iter_uploaded_files(request.stream, boundary.encode('latin-1')):
+                filename = secure_filename(raw_name)
+                received_filenames.append(filename)
+                if not filename or not allowed_file(filename):
+                    print(f"[SKIP] 非対応拡張子/無名ファイル: {raw_name!r}")
+                    buf.close()
+                    continue
+                futures.append(_upload_pool.submit(chunk_upload, tenant, client, filename, buf))
+        except BaseException:
+            # 受信エラー時は未着手のチャンク化を取り消す
+            for f in futures:
+                f.cancel()
+            raise
+        results = [f.result() for f in futures]
 
-            # 一時ファイルとして保存
-            suffix = os.path.splitext(filename)[1]
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                file.save(tmp.name)
-                tmp_path = tmp.name
+        if not received_filenames:
+            return jsonify({
+                'success': False,
+                'message': "ファイルが送信されていません（期待するフィールド名: 'files' または 'file'）。"
+            }), 400
+        if not any(received_filenames):
+            return jsonify({
+                'success': False,
+                'message': 'ファイルが選択されていません（filenameが空）。'
+            }), 400
 
-            try:
-                # チャンクに分割
-                chunks = process_file_to_chunks(tmp_path, filename)
-                all_chunks.extend(chunks)
-                processed_files.append(filename)
-                print(f"[EMBEDD] {filename} -> {len(chunks)} chunks")
-            finally:
-                # 一時ファイルを削除
-                try:
-                    if os.path.exists(tmp_path):
-                        os.unlink(tmp_path)
-                except Exception as _:
-                    # 失敗しても致命的ではないのでログのみ
-                    print(f"[WARN] 一時ファイル削除に失敗: {tmp_path}")
-
-        if not all_chunks:
+        for filename, chunks, file_reused, file_stale in results:
+            all_chunks.extend(chunks)
+            reused.extend(file_reused)
+            stale.extend(file_stale)
+            processed_files.append(filename)
+            print(f"[EMBEDD] {filename} -> {len(chunks)} chunks ({len(file_reused)} unchanged)")
+
+        # 埋め込みモデルの移行中は、切り替え時にこのファイルの分だけを反映できるよう記録する
+        migrate.record_write(tenant.collection, processed_files)
+
+        # 再アップロードされたファイルはいったん他ポイントの重複元から外し、
+        # 別ファイルとほぼ同一のチャンクは埋め込まずに既存ポイントの dup_sources に記録する
+        for filename in processed_files:
+            release_duplicates(client, tenant.collection, filename, scope=tenant.scope)
+        dups = {}
+        n_candidates = len(all_chunks)
+        all_chunks = list(drop_near_duplicates(
+            client, tenant.collection, all_chunks, dups, dedup_index(), scope=tenant.scope
+        ))
+
+        if not all_chunks and not reused and not dups:
             return jsonify({
                 'success': False,
                 'message': '処理可能なファイルがありませんでした（拡張子/内容を確認してください）。',
                 'debug': {
-                    'received_filenames': [secure_filename(f.filename) for f in files]
+                    'received_filenames': received_filenames
                 }
             }), 400
 
-        # Qdrantにアップサート
-        upsert_chunks(client, QDR.collection, model, all_chunks)
+        # クォータ確認後、Qdrantにアップサート
+        router.check_quota(tenant, len(all_chunks) - len(stale))
+        if all_chunks:
+            upsert_chunks(client, tenant.collection, model, all_chunks)
+        # 重複の記録を先に: 消えるチャンクが他ファイルの重複元なら、削除せずそのファイルのポイントとして残る
+        apply_duplicates(client, tenant.collection, dups)
+        apply_incremental(client, tenant.collection, reused, stale)
+        tenant.invalidate()
 
         return jsonify({
             'success': True,
             'message': 'ファイルの埋め込みが完了しました',
             'processed_files': len(processed_files),
             'file_names': processed_files,
-            'total_chunks': len(all_chunks)
+            'total_chunks': n_candidates + len(reused),
+            'embedded_chunks': len(all_chunks),
+            'unchanged_chunks': len(reused),
+            'duplicate_chunks': n_candidates - len(all_chunks),
+            'removed_chunks': len(stale)
         }), 200
 
+    except TenantError:
+        raise
+    except UploadError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status
     except Exception as e:
         print(f"[ERROR] {str(e)}")
         return jsonify({
@@ -199,7 +358,8 @@ def embedd_files():
         }), 500
 
 @app.route('/question', methods=['POST'])
-def answer_question():
+@tenant_scoped
+def answer_question(tenant):
     """
     質問を受け取り、RAGを使って回答を生成
     
@@ -231,26 +391,54 @@ def answer_question():
             }), 400
         
         # オプションパラメータ
-        top_k = data.get('top_k', 5)
+        top_k = parse_top_k(data)
+        if top_k is None:
+            return jsonify({
+                'success': False,
+                'message': f'top_k は 1〜{MAX_TOP_K} の整数で指定してください'
+            }), 400
         source_filter = data.get('source_filter', None)
         
-        print(f"[QUESTION] {question}")
+        print(f"[QUESTION] ({tenant.name}) {question}")
+
+        cache_key = (question, top_k, source_filter)
+        cached = tenant.answer_cache.get(cache_key)
+        if cached is not None:
+            print("[INFO] Answer cache hit")
+            return jsonify(cached), 200
         
-        # Qdrantクライアントの初期化
-        client = QdrantClient(host=QDR.host, port=QDR.port)
+        # Qdrantクライアント（共有）
+        client = router.client()
         
         # 埋め込みモデルをロード（キャッシュ利用）
         emb_model = get_cached_embedder()
         
-        # ベクトル検索でコンテキストを取得
-        print("[INFO] Searching for relevant contexts...")
-        hits = search(
-            client=client,
-            emb_model=emb_model,
-            query=question,
-            top_k=top_k,
-            source_filter=source_filter
-        )
+        # ベクトル検索でコンテキストを取得（テナントの検索キャッシュを優先）
+        hits = tenant.query_cache.get(cache_key)
+        if hits is None:
+            print("[INFO] Searching for relevant contexts...")
+            # クエリ拡張で LLM の言い換えも使う場合（質問ごとにキャッシュされる）
+            paraphrases = None
+            if SRCH.expansion and SRCH.expansion_llm:
+                tokenizer, llm_model = get_cached_llm()
+                paraphrases = llm_paraphrases(question, llm_model, tokenizer)
+            t0 = time.perf_counter()
+            hits = search(
+                client=client,
+                emb_model=emb_model,
+                query=question,
+                top_k=top_k,
+                source_filter=source_filter,
+                collection=tenant.collection,
+                scope=tenant.scope,
+                paraphrases=paraphrases
+            )
+            search_ms = (time.perf_counter() - t0) * 1000
+            tenant.query_cache.put(cache_key, hits)
+            # 埋め込みモデルの移行中は一部の質問を新しいコレクションでも検索して比較する（バックグラウンド）
+            migration = migrate.current()
+            if migration is not None:
+                migration.shadow(tenant.collection, question, top_k, source_filter, tenant.scope, hits, search_ms)
         
         if not hits:
             return jsonify({
@@ -260,6 +448,9 @@ def answer_question():
         
         contexts = [payload for _, payload in hits]
         print(f"[INFO] Found {len(contexts)} relevant contexts")
+        # 質問に近い文だけを残してプロンプトを短くする
+        if COMP.enabled:
+            contexts = compress_contexts(emb_model, question, contexts)
         
         # LLMをロード（キャッシュ利用）
         tokenizer, llm_model = get_cached_llm()
@@ -274,24 +465,17 @@ def answer_question():
         print("結果取得完了")
         
         # レスポンスを整形
-        context_info = []
-        for i, ctx in enumerate(contexts, 1):
-            context_info.append({
-                'index': i,
-                'source': ctx.get('source', ''),
-                'title': ctx.get('title', ''),
-                'page': ctx.get('page', ''),
-                'chunk_id': ctx.get('chunk_id', ''),
-                'text_preview': ctx.get('text', '')[:200] + '...' if len(ctx.get('text', '')) > 200 else ctx.get('text', '')
-            })
+        context_info = format_contexts(contexts)
         
-        return jsonify({
+        result = {
             'success': True,
             'question': question,
             'answer': answer,
             'num_contexts': len(contexts),
             'contexts': context_info
-        }), 200
+        }
+        tenant.answer_cache.put(cache_key, result)
+        return jsonify(result), 200
         
     except Exception as e:
         print(f"[ERROR] {str(e)}")
@@ -302,8 +486,95 @@ def answer_question():
             'message': f'エラーが発生しました: {str(e)}'
         }), 500
 
+@app.route('/question/batch', methods=['POST'])
+def answer_question_batch():
+    """
+    複数の質問をまとめて処理し、1問1行の JSONL でストリーミング返却（オフライン評価向け）
+
+    リクエスト:
+        - questions: 質問文のリスト（必須）
+        - top_k: 検索する関連文書数（任意、デフォルト5）
+        - source_filter: 特定のソースファイルでフィルタリング（任意）
+        - batch_size: 1回の埋め込み/検索/生成でまとめる質問数（任意、デフォルト8）
+
+    レスポンス (application/x-ndjson):
+        - 各行: {"index", "question", "answer", "num_contexts", "contexts"}
+    """
+    try:
+        tenant = router.from_request(request)
+    except TenantError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status
+
+    # 入力の検証はテナント枠を確保する前に（不正なリクエストで枠を消費しない）
+    data = request.get_json(silent=True) or {}
+    questions = data.get('questions', [])
+    questions = [str(q).strip() for q in questions if str(q).strip()] if isinstance(questions, list) else []
+    if not questions:
+        return jsonify({
+            'success': False,
+            'message': '質問（questions）が空です'
+        }), 400
+    top_k = parse_top_k(data)
+    if top_k is None:
+        return jsonify({
+            'success': False,
+            'message': f'top_k は 1〜{MAX_TOP_K} の整数で指定してください'
+        }), 400
+    source_filter = data.get('source_filter', None)
+    try:
+        batch_size = max(1, int(data.get('batch_size', 8)))
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': 'batch_size は整数で指定してください'
+        }), 400
+
+    # 生成はレスポンス返却後も続くため、テナント枠はレスポンスを閉じるまで保持する
+    stack = ExitStack()
+    try:
+        stack.enter_context(router.slot(tenant))
+    except TenantError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status
+
+    try:
+        client = router.client()
+        emb_model = get_cached_embedder()
+        tokenizer, llm_model = get_cached_llm()
+        print(f"[QUESTION/BATCH] ({tenant.name}) {len(questions)} questions, batch_size={batch_size}")
+
+        def generate():
+            try:
+                for res in answer_batch(
+                    client, emb_model, llm_model, tokenizer, questions,
+                    top_k=top_k, source_filter=source_filter, batch_size=batch_size,
+                    collection=tenant.collection, scope=tenant.scope,
+                ):
+                    contexts = res.pop('contexts')
+                    res['success'] = res['answer'] is not None
+                    res['num_contexts'] = len(contexts)
+                    res['contexts'] = format_contexts(contexts)
+                    yield json.dumps(res, ensure_ascii=False) + "\n"
+            except Exception as e:
+                print(f"[ERROR] {str(e)}")
+                yield json.dumps({'success': False, 'message': f'エラーが発生しました: {str(e)}'}, ensure_ascii=False) + "\n"
+
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.call_on_close(stack.close)
+    except BaseException:
+        # レスポンスを返せなかった場合はここで枠を返す（call_on_close は呼ばれない）
+        stack.close()
+        raise
+    return response
+
 @app.route('/documents', methods=['GET'])
-def list_documents():
+@tenant_scoped
+def list_documents(tenant):
     """
     登録されている文書の一覧を取得
     
@@ -313,11 +584,11 @@ def list_documents():
         - total: 総チャンク数
     """
     try:
-        client = QdrantClient(host=QDR.host, port=QDR.port)
+        client = router.client()
         
         # コレクションの存在確認
-        collections = [c.name for c in client.get_collections().collections]
-        if QDR.collection not in collections:
+        collections = collection_names(client)
+        if tenant.collection not in collections:
             return jsonify({
                 'success': True,
                 'documents': [],
@@ -327,9 +598,10 @@ def list_documents():
         
         # 全データを取得（sourceでグループ化）
         scroll_result = client.scroll(
-            collection_name=QDR.collection,
+            collection_name=tenant.collection,
+            scroll_filter=tenant.filter(),
             limit=10000,
-            with_payload=True,
+            with_payload=['source', 'chunk_id', 'dup_sources'],
             with_vectors=False
         )
         
@@ -347,6 +619,14 @@ def list_documents():
                 }
             doc_dict[source]['chunk_count'] += 1
             doc_dict[source]['chunk_ids'].append(point.payload.get('chunk_id', -1))
+            # 近似重複として他ファイルのチャンクにまとめられた分
+            for dup in point.payload.get('dup_sources') or []:
+                doc_dict.setdefault(dup, {
+                    'source': dup,
+                    'chunk_count': 0,
+                    'chunk_ids': []
+                }).setdefault('duplicate_chunks', 0)
+                doc_dict[dup]['duplicate_chunks'] += 1
         
         documents = list(doc_dict.values())
         
@@ -365,7 +645,9 @@ def list_documents():
         }), 500
 
 @app.route('/documents/<path:filename>', methods=['DELETE'])
-def delete_document(filename):
+@tenant_scoped
+@write_gated()
+def delete_document(tenant, filename):
     """
     特定の文書を削除
     
@@ -377,48 +659,52 @@ def delete_document(filename):
         - deleted_count: 削除したチャンク数
     """
     try:
-        client = QdrantClient(host=QDR.host, port=QDR.port)
+        client = router.client()
         
         # コレクションの存在確認
-        collections = [c.name for c in client.get_collections().collections]
-        if QDR.collection not in collections:
+        collections = collection_names(client)
+        if tenant.collection not in collections:
             return jsonify({
                 'success': False,
                 'message': 'コレクションが存在しません'
             }), 404
         
         # 対象ファイルのポイントIDを取得
+        from qdrant_client.http.models import FieldCondition, MatchValue
         scroll_result = client.scroll(
-            collection_name=QDR.collection,
-            scroll_filter=Filter(
-                must=[FieldCondition(key="source", match=MatchValue(value=filename))]
+            collection_name=tenant.collection,
+            scroll_filter=tenant.filter(
+                [FieldCondition(key="source", match=MatchValue(value=filename))]
             ),
             limit=10000,
-            with_payload=False,
+            with_payload=["parent_id", "dup_sources"],
             with_vectors=False
         )
         
         points = scroll_result[0]
-        point_ids = [point.id for point in points]
+        migrate.record_write(tenant.collection, [filename])
+        # 他ポイントの重複元としてだけ記録されているファイルもある
+        released = release_duplicates(client, tenant.collection, filename, scope=tenant.scope)
         
-        if not point_ids:
+        if not points and not released:
             return jsonify({
                 'success': False,
                 'message': f'ファイル "{filename}" は見つかりませんでした'
             }), 404
         
-        # ポイントを削除
-        client.delete(
-            collection_name=QDR.collection,
-            points_selector=point_ids
-        )
+        # ポイントを削除（他ファイルの重複元でもあるものはそのファイルのポイントとして残す。
+        # どの子からも参照されなくなった親（節）も削除）
+        deleted, promoted = delete_points(client, tenant.collection, points)
+        tenant.invalidate()
         
-        print(f"[DELETE] Deleted {len(point_ids)} chunks from '{filename}'")
+        print(f"[DELETE] Deleted {len(deleted)} chunks from '{filename}' "
+              f"({len(promoted)} kept for duplicate sources, {released} duplicate records released)")
         
         return jsonify({
             'success': True,
             'message': f'ファイル "{filename}" を削除しました',
-            'deleted_count': len(point_ids)
+            'deleted_count': len(deleted),
+            'reassigned_count': len(promoted)
         }), 200
         
     except Exception as e:
@@ -431,23 +717,41 @@ def delete_document(filename):
         }), 500
 
 @app.route('/reset', methods=['POST'])
-def reset_database():
+@tenant_scoped
+@write_gated(destructive=True)
+def reset_database(tenant):
     """
-    データベース全体を初期化（全データ削除）
+    テナントのデータを初期化（他テナントのデータは残る）
     
     レスポンス:
         - success: 成功フラグ
         - message: メッセージ
     """
     try:
-        client = QdrantClient(host=QDR.host, port=QDR.port)
+        client = router.client()
         
         # コレクションの存在確認
-        collections = [c.name for c in client.get_collections().collections]
-        if QDR.collection in collections:
-            # コレクションを削除
-            client.delete_collection(collection_name=QDR.collection)
-            print(f"[RESET] Collection '{QDR.collection}' deleted")
+        collections = collection_names(client)
+        if tenant.collection in collections:
+            if tenant.scope:
+                # 共有コレクション: テナントのポイントだけ削除
+                from qdrant_client.http.models import FilterSelector
+                parent_ids = parent_ids_of(client, tenant.collection, tenant.filter())
+                client.delete(
+                    collection_name=tenant.collection,
+                    points_selector=FilterSelector(filter=tenant.filter())
+                )
+                # 親は全テナント共有なので、他テナントから参照されていないものだけ削除
+                prune_parents(client, tenant.collection, parent_ids)
+                print(f"[RESET] Tenant '{tenant.name}' points deleted from '{tenant.collection}'")
+            else:
+                # コレクションを削除（エイリアスなら実体を。親チャンクのコレクションも）
+                client.delete_collection(collection_name=resolve_collection(client, tenant.collection))
+                if parent_collection(tenant.collection) in collections:
+                    client.delete_collection(collection_name=parent_collection(tenant.collection))
+                print(f"[RESET] Collection '{tenant.collection}' deleted")
+        chunk_cache.invalidate_collection(tenant.collection)
+        tenant.invalidate()
         
         return jsonify({
             'success': True,
@@ -461,21 +765,180 @@ def reset_database():
             'message': f'エラーが発生しました: {str(e)}'
         }), 500
 
+# =========================================
+# 管理用 API（admin_app。AdminCfg のポートでのみ受け付ける）
+# =========================================
+@admin_app.route('/migration', methods=['POST'])
+@admin_only
+def start_migration():
+    """
+    埋め込みモデルの移行を開始（保存済みの本文を新モデルで埋め込み直す。バックグラウンド）
+
+    リクエスト:
+        - model_name: 新しい埋め込みモデル（必須）
+
+    移行中は /question の一部を新旧両方で検索し、GET /migration で一致率とレイテンシを確認できる
+    """
+    data = request.get_json(silent=True) or {}
+    model_name = str(data.get('model_name', '')).strip()
+    if not model_name:
+        return jsonify({
+            'success': False,
+            'message': 'model_name が必要です'
+        }), 400
+    try:
+        migration = migrate.start(router.client(), model_name)
+    except migrate.MigrationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+    return jsonify({'success': True, **migration.status()}), 202
+
+@admin_app.route('/migration', methods=['GET'])
+@admin_only
+def migration_status():
+    """移行の進捗（コレクションごとの件数）とシャドー検索の集計（上位の一致率・p50/p95 レイテンシ）"""
+    migration = migrate.current()
+    if migration is None:
+        return jsonify({
+            'success': False,
+            'message': '移行は実行されていません'
+        }), 404
+    return jsonify({'success': True, **migration.status()}), 200
+
+@admin_app.route('/migration/switch', methods=['POST'])
+@admin_only
+def switch_migration():
+    """
+    新しいコレクションへ切り替える（書き込みを止めて差分を反映し、エイリアスを一括で付け替える）
+    切り替え後は config.py の EmbeddingCfg.model_name も新モデルに書き換えること（再起動後に使うモデル）
+    """
+    migration = migrate.current()
+    if migration is None:
+        return jsonify({
+            'success': False,
+            'message': '移行は実行されていません'
+        }), 404
+
+    def install_embedder(model):
+        global _embedder_cache
+        with _embedder_lock:
+            _embedder_cache = model
+        router.invalidate_all()
+
+    try:
+        synced = migration.switch(on_switch=install_embedder)
+    except migrate.MigrationError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+    return jsonify({
+        'success': True,
+        'message': f'{migration.model_name} に切り替えました（config.py の EmbeddingCfg.model_name を更新してください）',
+        'synced': synced,
+        **migration.status()
+    }), 200
+
+@admin_app.route('/migration', methods=['DELETE'])
+@admin_only
+def finish_migration():
+    """切り替え後は旧モデルのコレクションを削除、切り替え前は移行を中止して新しいコレクションを削除"""
+    migration = migrate.current()
+    if migration is None:
+        return jsonify({
+            'success': False,
+            'message': '移行は実行されていません'
+        }), 404
+    try:
+        dropped = migration.finish()
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'エラーが発生しました: {str(e)}'
+        }), 500
+    return jsonify({
+        'success': True,
+        'dropped_collections': dropped,
+        **migration.status()
+    }), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """ヘルスチェック用エンドポイント"""
+    """ヘルスチェック用エンドポイント（プロセスが応答できるか。モデルの読み込みは待たない）"""
     return jsonify({
         'status': 'ok',
         'message': 'Flask RAG API is running'
     }), 200
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """
+    レディネスチェック用エンドポイント
+    埋め込みモデルと LLM の読み込みが終わるまでは 503 を返す
+    （ロードバランサーやオーケストレーターはこちらでトラフィック投入を判断する）
+    """
+    embedder_ready = _embedder_cache is not None
+    ready = embedder_ready and _llm_loaded
+    return jsonify({
+        'status': 'ready' if ready else ('error' if _startup['error'] else 'loading'),
+        'embedder_loaded': embedder_ready,
+        'llm_loaded': _llm_loaded,
+        'uptime_sec': round(time.time() - _startup['started_at'], 1),
+        'error': _startup['error']
+    }), 200 if ready else 503
+
+def verify_embedding_model():
+    """
+    起動時: 各コレクションのエイリアスが設定の埋め込みモデルの実体を指しているか確かめる（違えば ModelMismatch）。
+    Qdrant に接続できない場合は警告だけ出して起動する
+    """
+    try:
+        check_collection_models(router.client())
+    except ModelMismatch:
+        raise
+    except Exception as e:
+        print(f"[WARN] Could not verify the embedding model against Qdrant: {e}")
+
+def serve_admin():
+    """管理用 API を別スレッドの別サーバーで動かす（テナント向けのポートには出さない）"""
+    if ADMIN.port <= 0:
+        return
+    if not admin_token() and ADMIN.host not in ('127.0.0.1', 'localhost', '::1'):
+        print(f"[ERROR] Admin API on {ADMIN.host} requires AdminCfg.token (or RAG_ADMIN_TOKEN); not starting it")
+        return
+    from werkzeug.serving import make_server
+    server = make_server(ADMIN.host, ADMIN.port, admin_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='admin-api', daemon=True).start()
+    print(f"[STARTUP] Admin API (/migration) on http://{ADMIN.host}:{ADMIN.port}")
+
 if __name__ == '__main__':
-    # アプリ起動時にモデルを事前ロード
-    print("[STARTUP] Pre-loading embedder model...")
-    get_cached_embedder()
-    print("[STARTUP] Pre-loading LLM model...")
-    get_cached_llm()
-    print("[STARTUP] All models loaded. Starting server...")
-    
-    app.run(host='0.0.0.0', port=1234, debug=True)
+    debug = True
+    try:
+        verify_embedding_model()
+    except ModelMismatch as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    # モデルはバックグラウンドで事前ロードし、サーバーはすぐに起動する（/health は即応答、/ready はロード完了後に 200）
+    # debug のリローダーでは親プロセスでロードしない（実際に処理する子プロセスだけで読み込む）
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        threading.Thread(target=preload_models, name='preload-models', daemon=True).start()
+        serve_admin()
+    print("[STARTUP] Starting server (models are loading in the background)...")
+
+    app.run(host='0.0.0.0', port=1234, debug=debug)
 
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+簡易ベンチマーク
+
+  python bench.py embed            # 埋め込みバックエンド比較（vectors/s、バケット化の効果、torch との一致度）
+  python bench.py prefill          # 接頭辞KVキャッシュ有無での TTFT 比較
+  python bench.py decode           # デコードプロファイルごとの tokens/s
+  python bench.py llm --quant int8 # LLM の起動時間・RSS・tokens/s（量子化モードごとに別プロセスで実行）
+  python bench.py imports          # モジュールの import 時間と、その時点で読み込まれた重い依存
+  python bench.py search           # 固定/適応的な候補取得・クエリ拡張での検索レイテンシ・取得件数（要: Qdrant と登録済み文書）
+  python bench.py compress         # コンテキスト圧縮の有無でのプロンプトトークン数と圧縮の所要時間（要: Qdrant と登録済み文書）
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from typing import List
+
+import numpy as np
+
+from config import ChunkCfg
+
+CH = ChunkCfg()
+
+# =========================================
+# ベンチ用コーパス
+# =========================================
+def load_corpus(src_dir: str, limit: int) -> List[str]:
+    """docs 配下をチャンク化したテキスト。足りなければ合成文で埋める"""
+    from ingest import discover_files, load_text_from_file
+    from utils_chunk import greedy_chunk_by_tokens
+
+    texts: List[str] = []
+    for fp in discover_files(src_dir):
+        text = load_text_from_file(fp)
+        texts.extend(greedy_chunk_by_tokens(
+            text,
+            target_tokens=CH.target_tokens,
+            overlap_tokens=CH.overlap_tokens,
+            min_chars=CH.min_chars,
+        ))
+        if len(texts) >= limit:
+            break
+    i = 0
+    while len(texts) < limit:
+        # 短文と長文を混ぜる（FAQ + PDF の混在を模擬）
+        n = 1 if i % 2 == 0 else 20
+        texts.append("ベンチマーク用のサンプル文です。" * n + f"({i})")
+        i += 1
+    return texts[:limit]
+
+# =========================================
+# 埋め込み
+# =========================================
+def bench_embed(args):
+    from embedding import encode_bucketed, load_embedding_backend
+
+    texts = load_corpus(args.src, args.n)
+    results = {}
+    for backend in args.backends:
+        model = load_embedding_backend(device="cpu", backend=backend)
+        model.encode(texts[:8], batch_size=8, normalize_embeddings=True)  # warmup
+        t0 = time.perf_counter()
+        vecs = model.encode(texts, batch_size=args.batch_size, normalize_embeddings=True)
+        dt = time.perf_counter() - t0
+        results[backend] = np.asarray(vecs, dtype=np.float32)
+        print(f"[BENCH] embed backend={backend} n={len(texts)} {len(texts) / dt:.1f} vectors/s ({dt:.2f}s)")
+
+        # 長さバケット化バッチ（ingest の upsert_chunks と同じ経路）
+        t0 = time.perf_counter()
+        bvecs = encode_bucketed(model, texts, normalize_embeddings=True)
+        dt = time.perf_counter() - t0
+        diff = float(np.abs(bvecs - results[backend]).max())
+        print(f"[BENCH] embed backend={backend} bucketed {len(texts) / dt:.1f} vectors/s ({dt:.2f}s) max|diff|={diff:.2e}")
+
+    if "torch" in results:
+        ref = results["torch"]
+        for backend, vecs in results.items():
+            if backend == "torch":
+                continue
+            cos = (ref * vecs).sum(axis=1)
+            print(f"[BENCH] cosine(torch, {backend}): mean={cos.mean():.4f} min={cos.min():.4f}")
+
+# =========================================
+# 生成（prefill / TTFT）
+# =========================================
+def _contexts(texts: List[str], n: int) -> List[dict]:
+    return [{"text": t, "source": "bench", "chunk_id": i} for i, t in enumerate(texts[:n])]
+
+def bench_prefill(args):
+    import query
+
+    query.LLM.max_new_tokens = args.max_new_tokens
+    tok, model = query.load_llm()
+    texts = load_corpus(args.src, 32)
+    questions = [f"ベンチマーク質問 {i} の要点は何ですか？" for i in range(args.n)]
+    # 前半は同じコンテキストで質問だけ変える（繰り返しコンテキスト）、後半はコンテキストも変える
+    plans = [
+        ("same contexts", [_contexts(texts, 3)] * args.n),
+        ("varied contexts", [_contexts(texts[i % 8:], 3) for i in range(args.n)]),
+    ]
+    for label, ctx_list in plans:
+        for use_cache in (False, True):
+            ttft, cached, prompt = [], 0, 0
+            for q, ctxs in zip(questions, ctx_list):
+                stats = {}
+                query.chat(model, tok, query.build_prompt(q, ctxs, tok), use_prefix_cache=use_cache, stats=stats)
+                ttft.append(stats["ttft_ms"] or 0.0)
+                cached += stats["cached_tokens"]
+                prompt += stats["prompt_tokens"]
+            print(f"[BENCH] prefill {label:15s} prefix_cache={str(use_cache):5s} "
+                  f"TTFT mean={np.mean(ttft):.0f} ms p50={np.median(ttft):.0f} ms "
+                  f"cached={cached / max(prompt, 1):.0%} of prompt tokens")
+
+def bench_decode(args):
+    import query
+
+    query.LLM.max_new_tokens = args.max_new_tokens
+    tok, model = query.load_llm()
+    texts = load_corpus(args.src, 32)
+    prompts = [query.build_prompt(f"ベンチマーク質問 {i} の要点は何ですか？", _contexts(texts[i % 8:], 3), tok)
+               for i in range(args.n)]
+    for profile in args.profiles:
+        query.chat(model, tok, prompts[0], profile=profile)  # warmup（assisted はドラフトモデルのロード込み）
+        tokens, secs = 0, 0.0
+        for msgs in prompts:
+            stats = {}
+            query.chat(model, tok, msgs, profile=profile, stats=stats)
+            tokens += stats["new_tokens"]
+            secs += stats["total_ms"] / 1000
+        print(f"[BENCH] decode profile={profile:9s} {tokens / max(secs, 1e-9):.1f} tokens/s "
+              f"mean latency={secs / len(prompts) * 1000:.0f} ms mean tokens={tokens / len(prompts):.0f}")
+
+def bench_llm(args):
+    import query
+
+    query.LLM.cpu_quant = args.quant
+    query.LLM.decoding = "greedy"
+    query.LLM.max_new_tokens = args.max_new_tokens
+    if args.threads:
+        query.LLM.num_threads = args.threads
+    t0 = time.perf_counter()
+    tok, model = query.load_llm()
+    startup = time.perf_counter() - t0
+    rss = query.rss_gb()
+
+    texts = load_corpus(args.src, 8)
+    msgs = query.build_prompt("ベンチマーク質問の要点は何ですか？", _contexts(texts, 3), tok)
+    tokens, secs = 0, 0.0
+    for _ in range(args.n):
+        stats = {}
+        query.chat(model, tok, msgs, stats=stats)
+        tokens += stats["new_tokens"]
+        secs += stats["total_ms"] / 1000
+    print(f"[BENCH] llm quant={args.quant} startup={startup:.1f}s RSS={rss:.2f} GB "
+          f"(after generate {query.rss_gb():.2f} GB) {tokens / max(secs, 1e-9):.1f} tokens/s")
+
+# =========================================
+# 検索（適応的な候補取得・クエリ拡張）
+# =========================================
+def bench_search(args):
+    import query
+    from qdrant_client import QdrantClient
+
+    emb = query.load_embedder()
+    client = QdrantClient(host=query.QDR.host, port=query.QDR.port)
+    dim = emb.get_sentence_embedding_dimension()
+    # 文書の冒頭文を質問に見立てる
+    questions = [t.split("。")[0][:80] for t in load_corpus(args.src, args.n)]
+    query.search(client, emb, questions[0], top_k=args.top_k)  # warmup
+    for adaptive, expand in ((False, False), (True, False), (False, True)):
+        lat, fetched, survivors, body, n_queries = [], 0, 0, 0, 0
+        for q in questions:
+            stats = {}
+            t0 = time.perf_counter()
+            hits = query.search(client, emb, q, top_k=args.top_k, adaptive=adaptive, expand=expand, stats=stats)
+            lat.append((time.perf_counter() - t0) * 1000)
+            fetched += stats.get("fetched", 0)
+            survivors += stats.get("survivors", 0)
+            n_queries += stats.get("queries", 1)
+            body += sum(len(json.dumps(p, ensure_ascii=False).encode("utf-8")) for _, p in hits) / max(len(hits), 1)
+        n = len(questions)
+        # 推定転送量: ベクトル(float32) + payload を取得した件数分（adaptive は id/スコアのみの取得分を 48 bytes/件 で加算）
+        per_body = dim * 4 + body / n
+        est = (survivors * per_body + fetched * 48) if adaptive else fetched * per_body
+        print(f"[BENCH] search adaptive={str(adaptive):5s} expand={str(expand):5s} "
+              f"p50={np.median(lat):.1f} ms mean={np.mean(lat):.1f} ms queries={n_queries / n:.1f} "
+              f"fetched={fetched / n:.1f} with body={(survivors if adaptive else fetched) / n:.1f} "
+              f"est. bytes/query={est / n / 1024:.1f} KiB")
+
+# =========================================
+# コンテキスト圧縮
+# =========================================
+def bench_compress(args):
+    import query
+    from qdrant_client import QdrantClient
+    from transformers import AutoTokenizer
+
+    emb = query.load_embedder()
+    tok = AutoTokenizer.from_pretrained(query.LLM.model_path, use_fast=True)
+    client = QdrantClient(host=query.QDR.host, port=query.QDR.port)
+    questions = [t.split("。")[0][:80] for t in load_corpus(args.src, args.n)]
+    contexts_list = [[p for _, p in query.search(client, emb, q, top_k=args.top_k)] for q in questions]
+
+    def prompt_tokens(q, ctxs) -> int:
+        msgs = query.build_prompt(q, ctxs, tok)
+        return len(tok.apply_chat_template(msgs, tokenize=True, add_generation_prompt=True))
+
+    base = [prompt_tokens(q, c) for q, c in zip(questions, contexts_list)]
+    print(f"[BENCH] compress off prompt tokens mean={np.mean(base):.0f} p50={np.median(base):.0f}")
+    for label in ("cold", "warm"):
+        t0 = time.perf_counter()
+        compressed = query.compress_contexts_batch(emb, questions, contexts_list, token_budget=args.budget)
+        dt = (time.perf_counter() - t0) * 1000 / len(questions)
+        toks = [prompt_tokens(q, c) for q, c in zip(questions, compressed)]
+        print(f"[BENCH] compress on ({label:4s}) prompt tokens mean={np.mean(toks):.0f} p50={np.median(toks):.0f} "
+              f"({1 - np.mean(toks) / max(np.mean(base), 1):.0%} fewer) compress={dt:.1f} ms/question")
+
+# =========================================
+# import 時間（コールドスタート）
+# =========================================
+HEAVY_MODULES = ("torch", "transformers", "sentence_transformers", "qdrant_client", "pdfplumber", "onnxruntime")
+
+_IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+print(json.dumps({{"seconds": dt, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def bench_imports(args):
+    """モジュールごとに新しいプロセスで import し、所要時間と読み込まれた重い依存を表示する"""
+    for module in args.modules:
+        times, loaded = [], []
+        for _ in range(args.repeat):
+            proc = subprocess.run(
+                [sys.executable, "-c", _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                capture_output=True, text=True,
+            )
+            if proc.returncode != 0:
+                err = (proc.stderr.strip().splitlines() or ["?"])[-1]
+                print(f"[BENCH] import {module:22s} failed: {err}")
+                break
+            res = json.loads(proc.stdout.strip().splitlines()[-1])
+            times.append(res["seconds"])
+            loaded = res["loaded"]
+        else:
+            print(f"[BENCH] import {module:22s} min={min(times) * 1000:.0f} ms "
+                  f"mean={np.mean(times) * 1000:.0f} ms heavy={','.join(loaded) or '-'}")
+
+def main():
+    ap = argparse.ArgumentParser(description="LocalLLMRAG benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("embed", help="埋め込みバックエンドの vectors/s 比較")
+    p.add_argument("--src", default="docs")
+    p.add_argument("--n", type=int, default=512)
+    p.add_argument("--batch-size", type=int, default=64)
+    p.add_argument("--backends", nargs="+", default=["torch", "onnx"])
+    p.set_defaults(func=bench_embed)
+
+    p = sub.add_parser("prefill", help="接頭辞KVキャッシュ有無での TTFT 比較")
+    p.add_argument("--src", default="docs")
+    p.add_argument("--n", type=int, default=8)
+    p.add_argument("--max-new-tokens", type=int, default=8)
+    p.set_defaults(func=bench_prefill)
+
+    p = sub.add_parser("decode", help="デコードプロファイルごとの tokens/s")
+    p.add_argument("--src", default="docs")
+    p.add_argument("--n", type=int, default=4)
+    p.add_argument("--max-new-tokens", type=int, default=256)
+    p.add_argument("--profiles", nargs="+", default=["sample", "greedy", "assisted"])
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("llm", help="LLM の起動時間・RSS・tokens/s")
+    p.add_argument("--src", default="docs")
+    p.add_argument("--quant", default="none", choices=["none", "int8", "int4"])
+    p.add_argument("--threads", type=int, default=0)
+    p.add_argument("--n", type=int, default=3)
+    p.add_argument("--max-new-tokens", type=int, default=128)
+    p.set_defaults(func=bench_llm)
+
+    p = sub.add_parser("search", help="固定/適応的な候補取得・クエリ拡張での検索レイテンシ")
+    p.add_argument("--src", default="docs")
+    p.add_argument("--n", type=int, default=50)
+    p.add_argument("--top-k", type=int, default=5)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("compress", help="コンテキスト圧縮の有無でのプロンプトトークン数")
+    p.add_argument("--src", default="docs")
+    p.add_argument("--n", type=int, default=20)
+    p.add_argument("--top-k", type=int, default=5)
+    p.add_argument("--budget", type=int, default=0, help="0 なら CompressCfg.token_budget")
+    p.set_defaults(func=bench_compress)
+
+    p = sub.add_parser("imports", help="モジュールの import 時間（コールドスタート）")
+    p.add_argument("--modules", nargs="+", default=["app", "ingest", "query", "tenants"] + list(HEAVY_MODULES[:4]))
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_imports)
+
+    args = ap.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+検索候補（チャンク）のクライアント側キャッシュ
+
+キーは (実体のコレクション名, point id)。値はベクトル（float32）と payload。
+エイリアス（rag_docs など）は使用中の埋め込みモデルの実体名（rag_docs__emb_<モデル>）に直してからキーにするので、
+モデル移行の切り替えの前後で旧モデルのベクトルを新モデルのものとして返すことはない（cache_collection）。
+  - "memory": プロセス内。ベクトルは (max_entries, dim) の float32 配列に詰めて持ち、LRU で追い出す
+              （他プロセスの invalidate は届かないので、書き込みが単一のサーバープロセスだけの場合に使う）
+  - "sqlite": 複数ワーカー・CLI（ingest.py / snapshot.py）と共有するファイル（WAL + mmap で読む）。
+              最終アクセス時刻（ATIME_RESOLUTION 秒単位）の古いものから追い出す。別プロセスからの invalidate も反映されるので既定
+
+point id はインジェストのたびに新しく振られ、ベクトルは変わらない。payload を書き換える経路
+（差分インジェスト・重複の記録・削除・リセット）は invalidate / invalidate_collection を呼ぶ。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import CacheCfg
+
+CACHE = CacheCfg()
+
+Entry = Tuple[np.ndarray, Dict]
+
+# sqlite の最終アクセス時刻の粒度（秒）。これより新しいヒットでは書き込まない
+ATIME_RESOLUTION = 60.0
+
+def _key(collection: str, pid) -> str:
+    return f"{collection}:{pid}"
+
+class MemoryChunkCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._vecs: Optional[np.ndarray] = None
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._payloads: Dict[int, Dict] = {}
+        self._free: List[int] = []
+        self._lock = threading.Lock()
+
+    def get_many(self, collection: str, ids: Iterable, dim: int = 0) -> Dict[str, Entry]:
+        out: Dict[str, Entry] = {}
+        with self._lock:
+            if self._vecs is None or (dim and self._vecs.shape[1] != dim):
+                return out
+            for pid in ids:
+                slot = self._slots.get(_key(collection, pid))
+                if slot is None:
+                    continue
+                self._slots.move_to_end(_key(collection, pid))
+                out[str(pid)] = (self._vecs[slot].copy(), self._payloads[slot])
+        return out
+
+    def put_many(self, collection: str, records: Iterable[Tuple[object, List[float], Dict]]):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            for pid, vec, payload in records:
+                vec = np.asarray(vec, dtype=np.float32)
+                if self._vecs is None:
+                    self._vecs = np.zeros((self.max_entries, vec.shape[-1]), dtype=np.float32)
+                    self._free = list(range(self.max_entries - 1, -1, -1))
+                if vec.shape[-1] != self._vecs.shape[1]:
+                    # 次元の違うコレクション（別モデル）は載せない
+                    continue
+                key = _key(collection, pid)
+                slot = self._slots.get(key)
+                if slot is None:
+                    if not self._free:
+                        _, old = self._slots.popitem(last=False)
+                        self._payloads.pop(old, None)
+                        self._free.append(old)
+                    slot = self._free.pop()
+                self._slots[key] = slot
+                self._slots.move_to_end(key)
+                self._vecs[slot] = vec
+                self._payloads[slot] = payload
+
+    def invalidate(self, collection: str, ids: Iterable):
+        with self._lock:
+            for pid in ids:
+                slot = self._slots.pop(_key(collection, pid), None)
+                if slot is not None:
+                    self._payloads.pop(slot, None)
+                    self._free.append(slot)
+
+    def invalidate_collection(self, collection: str):
+        prefix = collection + ":"
+        with self._lock:
+            for key in [k for k in self._slots if k.startswith(prefix)]:
+                slot = self._slots.pop(key)
+                self._payloads.pop(slot, None)
+                self._free.append(slot)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+class SqliteChunkCache:
+    """複数プロセスで共有するキャッシュ（スレッドごとに接続を持つ）"""
+
+    def __init__(self, path: str, max_entries: int, mmap_bytes: int = 0):
+        self.path = path
+        self.max_entries = max_entries
+        self.mmap_bytes = mmap_bytes
+        self._local = threading.local()
+        self._puts = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, vec BLOB, payload TEXT, atime REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS chunks_atime ON chunks(atime)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if self.mmap_bytes > 0:
+                conn.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, collection: str, ids: Iterable, dim: int = 0) -> Dict[str, Entry]:
+        keys = {_key(collection, pid): str(pid) for pid in ids}
+        if not keys:
+            return {}
+        conn = self._conn()
+        marks = ",".join("?" * len(keys))
+        rows = conn.execute(
+            f"SELECT key, vec, payload, atime FROM chunks WHERE key IN ({marks})", list(keys)
+        ).fetchall()
+        if dim:
+            # 次元の違うベクトル（別モデル）はヒットにしない（put_many で置き換わる）
+            rows = [r for r in rows if len(r[1]) == dim * 4]
+        # 最終アクセス時刻は ATIME_RESOLUTION 秒より古いものだけ更新する
+        # （ヒットのたびに書き込むと、ファイルを共有する全ワーカーの読み込みが書き込みロックで直列になる）
+        now = time.time()
+        stale = [r[0] for r in rows if now - r[3] > ATIME_RESOLUTION]
+        if stale:
+            stale_marks = ",".join("?" * len(stale))
+            conn.execute(f"UPDATE chunks SET atime=? WHERE key IN ({stale_marks})", [now] + stale)
+            conn.commit()
+        return {keys[k]: (np.frombuffer(v, dtype=np.float32), json.loads(p)) for k, v, p, _ in rows}
+
+    def put_many(self, collection: str, records: Iterable[Tuple[object, List[float], Dict]]):
+        if self.max_entries <= 0:
+            return
+        now = time.time()
+        rows = [
+            (_key(collection, pid), np.asarray(vec, dtype=np.float32).tobytes(), json.dumps(payload, ensure_ascii=False), now)
+            for pid, vec, payload in records
+        ]
+        if not rows:
+            return
+        conn = self._conn()
+        conn.executemany("INSERT OR REPLACE INTO chunks (key, vec, payload, atime) VALUES (?, ?, ?, ?)", rows)
+        self._puts += len(rows)
+        # 件数の確認は書き込みがある程度たまってから
+        if self._puts >= max(64, self.max_entries // 100):
+            self._puts = 0
+            excess = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM chunks WHERE key IN (SELECT key FROM chunks ORDER BY atime LIMIT ?)", (excess,)
+                )
+        conn.commit()
+
+    def invalidate(self, collection: str, ids: Iterable):
+        keys = [_key(collection, pid) for pid in ids]
+        if not keys:
+            return
+        conn = self._conn()
+        conn.executemany("DELETE FROM chunks WHERE key=?", [(k,) for k in keys])
+        conn.commit()
+
+    def invalidate_collection(self, collection: str):
+        conn = self._conn()
+        # LIKE のワイルドカードを避けるため範囲で消す（":" の次の文字 ";" まで）
+        conn.execute("DELETE FROM chunks WHERE key >= ? AND key < ?", (collection + ":", collection + ";"))
+        conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_chunk_cache():
+    """CacheCfg に従ったキャッシュ（無効なら None）"""
+    global _cache
+    if not CACHE.enabled:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if CACHE.backend == "sqlite":
+                    os.makedirs(os.path.dirname(os.path.abspath(CACHE.path)), exist_ok=True)
+                    _cache = SqliteChunkCache(CACHE.path, CACHE.max_entries, CACHE.mmap_bytes)
+                elif CACHE.backend == "memory":
+                    _cache = MemoryChunkCache(CACHE.max_entries)
+                else:
+                    raise ValueError(f"Unknown chunk cache backend: {CACHE.backend}")
+    return _cache
+
+def cache_collection(collection: str) -> str:
+    """
+    キャッシュのキーに使うコレクション名。エイリアス（論理名）は使用中のモデルの実体名にし、
+    実体名（移行中の新しいコレクションなど）はそのまま使う
+    """
+    from ingest import MODEL_MARK, model_collection
+
+    return collection if MODEL_MARK in collection else model_collection(collection)
+
+def invalidate(collection: str, ids: Iterable):
+    cache = get_chunk_cache()
+    if cache is not None:
+        cache.invalidate(cache_collection(collection), list(ids))
+
+def invalidate_collection(collection: str):
+    cache = get_chunk_cache()
+    if cache is not None:
+        cache.invalidate_collection(cache_collection(collection))
@@ -6,6 +6,7 @@
 """
 
 from dataclasses import dataclass
+from typing import Tuple
 
 @dataclass
 class EmbeddingCfg:
@@ -13,6 +14,15 @@ class EmbeddingCfg:
     model_name: str = "sentence-transformers/all-MiniLM-L6-v2" #Qdrant/multilingual-e5-large-onnx こっちを本番環境で使う
     batch_size: int = 64
     normalize: bool = True   # コサイン類似を使う場合 True 推奨
+    # バックエンド: "torch" (SentenceTransformer) / "onnx" (ONNX Runtime, CPUノード向け)
+    backend: str = "torch"
+    onnx_dir: str = ".onnx_cache"   # 初回エクスポート先（モデルごとにサブディレクトリ）
+    onnx_quantize: bool = True      # int8 動的量子化（False で fp32 のまま）
+    onnx_threads: int = 0           # intra-op スレッド数（0 = ORT既定）
+    # 長さバケット化バッチ: 1バッチの (件数 × 最長トークン長) 上限。0 = 空きメモリから自動
+    batch_tokens: int = 0
+    batch_memory_fraction: float = 0.25   # 自動時に使う空きメモリの割合
+    upsert_batch: int = 2048              # ingest 時にまとめて埋め込み・登録する件数
 
 @dataclass
 class QdrantCfg:
@@ -20,6 +30,29 @@ class QdrantCfg:
     port: int = 6333
     collection: str = "rag_docs"
 
+@dataclass
+class TenantCfg:
+    # "collection": テナントごとにコレクション（既定テナントは QdrantCfg.collection）
+    # "payload"   : 共有コレクション + インデックス付き tenant キー（数百テナント向け）
+    mode: str = "collection"
+    header: str = "X-Tenant-ID"        # テナントを指定するヘッダー（JSONの "tenant" でも可）
+    default_tenant: str = "default"
+    max_chunks: int = 0                # テナントあたりのチャンク数上限（0 = 無制限）
+    max_concurrent: int = 0            # テナントあたりの同時リクエスト数（0 = 無制限）
+    acquire_timeout: float = 0.5       # 空きを待つ秒数（超えたら 429）
+    query_cache_size: int = 256        # テナントごとの検索結果キャッシュ件数
+    answer_cache_size: int = 128       # テナントごとの回答キャッシュ件数
+    max_tenants: int = 1024            # 状態を保持するテナント数（超えたら未使用のものから破棄）
+
+@dataclass
+class UploadCfg:
+    max_request_bytes: int = 512 * 1024 * 1024   # /embedd 1リクエストの上限
+    max_file_bytes: int = 200 * 1024 * 1024      # 1ファイルの上限
+    max_field_bytes: int = 1024 * 1024           # ファイル以外のフォーム値の上限
+    spool_threshold: int = 16 * 1024 * 1024      # PDFがこのサイズを超えたら一時ファイルへ
+    read_size: int = 64 * 1024                   # ストリームの読み込み単位
+    workers: int = 2                             # 受信と並行してチャンク化するスレッド数
+
 @dataclass
 class LLMCfg:
     # モデルタイプ: "local" (ローカル) または "openai" (OpenAI API)
@@ -34,17 +67,100 @@ class LLMCfg:
     max_new_tokens: int = 512
     temperature: float = 0.7
     top_p: float = 0.9
+    prefix_cache: bool = True          # 固定プロンプト接頭辞の KV キャッシュを再利用
+    prefix_cache_entries: int = 0      # 直近プロンプト全体の KV を保持する件数（繰り返しコンテキスト用。1件で7Bなら数百MB。0 = システム文の接頭辞のみ）
+    # デコードプロファイル: "sample"（従来） / "greedy"（決定的・高速） / "assisted"（ドラフトモデルによる投機的デコード）
+    decoding: str = "sample"
+    draft_model_path: str = "Qwen/Qwen2.5-0.5B-Instruct"  # assisted 用。本番モデルと同系列のトークナイザを持つ小型モデル
+    stop_at_citation: bool = True      # 出典番号の行（例: [1],[3]）を出力したら生成を止める
+    stop_sequences: Tuple[str, ...] = ()  # 追加の停止文字列
+    # CPU 専用ホスト向け
+    cpu_quant: str = "none"            # "none" / "int8"（torch 動的量子化） / "int4"（optimum-quanto, weight-only）
+    num_threads: int = 0               # intra-op スレッド数（0 = torch 既定）
+    interop_threads: int = 0           # inter-op スレッド数（0 = torch 既定）
     
     # OpenAI API設定（model_type="openai"の場合）
     openai_model: str = "gpt-4o-mini"  # "gpt-4o-mini" / "gpt-4o" / "gpt-3.5-turbo"
     openai_api_key: str = ""  # 環境変数 OPENAI_API_KEY から取得
     openai_base_url: str = ""  # カスタムエンドポイント用（空の場合はデフォルト）
 
+@dataclass
+class SearchCfg:
+    # 適応的な候補取得: まず id とスコアだけをページ単位で取得し、残りの候補が top_k に入り得なくなった時点で打ち切る。
+    # ベクトルと payload は生き残った候補の分だけ取得する
+    adaptive: bool = True
+    page_size: int = 8
+    score_gap: float = 0.2      # 最高スコアからこれ以上離れた候補は取らない
+    min_score: float = 0.0      # これ未満のスコアの候補は取らない（0 で無効）
+    # 取得する payload（検索・プロンプト・レスポンスで使うものだけ。空なら minhash/lsh 以外すべて）
+    payload_fields: Tuple[str, ...] = ("text", "title", "source", "page", "chunk_id", "parent_id", "dup_sources")
+    # クエリ拡張: 元の質問に加えてキーワードの部分集合（と任意で LLM の言い換え）でも検索し、
+    # 順位を RRF で統合してから MMR にかける（埋め込みは1回の encode、Qdrant へは1回の search_batch）
+    expansion: bool = False
+    expansion_max: int = 4        # 元の質問以外に作るクエリの上限
+    expansion_llm: bool = False   # LLM による言い換えも加える（質問ごとにキャッシュ）
+    paraphrases: int = 2          # LLM に作らせる言い換えの数
+    paraphrase_entries: int = 1024
+    rrf_k: int = 60               # RRF の定数（1 / (rrf_k + 順位) を足し合わせる）
+
+@dataclass
+class CacheCfg:
+    # 検索候補のベクトル・payload のクライアント側キャッシュ（point id 単位、LRU）
+    enabled: bool = True
+    backend: str = "sqlite"     # "sqlite"（ingest.py / snapshot.py・複数ワーカーと共有するファイル）/ "memory"（プロセス内）
+    max_entries: int = 20000    # 384次元なら float32 で約 30MB + payload
+    path: str = ".chunk_cache/chunks.sqlite"
+    mmap_bytes: int = 256 << 20 # sqlite を mmap で読む上限
+    parent_entries: int = 4096  # 親チャンク本文のキャッシュ件数（本文ハッシュが ID なので無効化不要）
+
 @dataclass
 class ChunkCfg:
     target_tokens: int = 400
     overlap_tokens: int = 60
     min_chars: int = 150
+    # 親子チャンク: 小さい子チャンク（文ウィンドウ）を埋め込んで検索し、LLM には親（重なりのない節）を渡す
+    # 親は本文のハッシュで重複排除して "{collection}__parents" に保存する
+    parent_child: bool = True
+    parent_tokens: int = 500        # 親（節）の目安。build_prompt の1コンテキスト上限（約900文字）に収まる大きさ
+    child_tokens: int = 120
+    child_overlap_tokens: int = 30
+    search_fanout: int = 3          # 子チャンク検索時は粗取り件数をこの倍率で増やす（同じ親の子が並ぶため）
+
+@dataclass
+class DedupCfg:
+    # インジェスト時の近似重複除去（MinHash/LSH）。別ファイルのほぼ同一チャンクは埋め込まず、
+    # 既存ポイントの payload "dup_sources" に重複元ファイルを記録する
+    enabled: bool = True
+    threshold: float = 0.85     # 推定 Jaccard 係数がこれ以上なら重複
+    num_perm: int = 64          # MinHash の署名長（bands で割り切れること）
+    bands: int = 16             # LSH の帯の数（多いほど低い類似度でも候補になる）
+    shingle: int = 5            # 文字 n-gram の n
+    query_batch: int = 64       # Qdrant への候補問い合わせ1回あたりのチャンク数
+
+@dataclass
+class MigrationCfg:
+    # 埋め込みモデルの移行（migrate.py）。保存済みの本文を新モデルで埋め込み直し、エイリアスで切り替える
+    batch: int = 256              # 1回に読み出して埋め込み直す件数
+    shadow_sample: float = 0.1    # 移行中に新旧両方のコレクションで検索する /question の割合
+    shadow_history: int = 1000    # 一致率・レイテンシを集計する直近の件数
+    write_wait_s: float = 30.0    # 切り替え時に実行中の書き込み（/embedd など）の完了を待つ秒数
+
+@dataclass
+class AdminCfg:
+    # 管理用 API（/migration）。テナント向けのポートとは別のサーバーで受け付ける
+    host: str = "127.0.0.1"       # 既定はローカルからのみ。外から使う場合は token を必ず設定する
+    port: int = 1235              # 0 で管理用 API を起動しない
+    token: str = ""               # 環境変数 RAG_ADMIN_TOKEN からも取得。設定時はヘッダーで一致を確認
+    header: str = "X-Admin-Token"
+
+@dataclass
+class CompressCfg:
+    # 抽出型のコンテキスト圧縮（search と build_prompt の間）: チャンクを文に分け、
+    # 質問の埋め込みと近い文だけをトークン予算内で残す
+    enabled: bool = True
+    token_budget: int = 900       # 全コンテキストで残す文の合計トークン数（目安: 文字数 / 1.8）
+    min_sentences: int = 1        # 各コンテキストに必ず残す文の数（出典番号を欠番にしないため）
+    sentence_entries: int = 20000 # 文の埋め込みの LRU 件数（埋め込みモデルごと）
 
 # =========================================
 # 設定例
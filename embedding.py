@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+埋め込みバックエンド
+
+EmbeddingCfg.backend で切り替える:
+  - "torch": SentenceTransformer（従来どおり）
+  - "onnx" : ONNX Runtime（CPU向け。初回に設定モデルをエクスポート＋int8動的量子化）
+
+どちらも encode(texts, batch_size=..., normalize_embeddings=...) を持つので、
+呼び出し側（ingest / query）は SentenceTransformer と同じように扱える。
+"""
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import EmbeddingCfg
+
+EMB = EmbeddingCfg()
+
+# numpy 側で再現できるプーリング（これ以外は torch と同じベクトルにならない）
+ONNX_POOLING = ("mean", "cls", "max")
+
+# =========================================
+# ONNX エクスポート
+# =========================================
+def onnx_model_dir(model_name: str, quantize: bool) -> str:
+    suffix = "-int8" if quantize else ""
+    return os.path.join(EMB.onnx_dir, model_name.replace("/", "__") + suffix)
+
+def export_onnx(model_name: str, out_dir: str, quantize: bool = True) -> str:
+    """
+    SentenceTransformer の Transformer 部分を ONNX に書き出す。
+    Pooling/Normalize は numpy 側で再現するため、メタ情報として meta.json に保存する。
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    st = SentenceTransformer(model_name, device="cpu")
+    transformer = st[0]
+    hf_model = transformer.auto_model.eval()
+    tok = transformer.tokenizer
+
+    pooling = "mean"
+    has_normalize = False
+    for m in st:
+        if isinstance(m, Pooling):
+            pooling = m.get_pooling_mode_str()
+        if isinstance(m, Normalize):
+            has_normalize = True
+    if pooling not in ONNX_POOLING:
+        raise ValueError(
+            f"ONNX backend does not support pooling mode '{pooling}' of {model_name} "
+            f"(supported: {', '.join(ONNX_POOLING)}); use backend='torch'"
+        )
+
+    class _Wrapper(torch.nn.Module):
+        # ModelOutput ではなく last_hidden_state のみ返す（ONNX 出力を固定するため）
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            kwargs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if token_type_ids is not None:
+                kwargs["token_type_ids"] = token_type_ids
+            return self.model(**kwargs)[0]
+
+    dummy = tok(["dim_check", "onnx export"], padding=True, return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in dummy]
+    dynamic_axes = {n: {0: "batch", 1: "seq"} for n in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+
+    os.makedirs(out_dir, exist_ok=True)
+    fp32_path = os.path.join(out_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            _Wrapper(hf_model),
+            tuple(dummy[n] for n in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    tok.save_pretrained(out_dir)
+
+    model_path = fp32_path
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        model_path = os.path.join(out_dir, "model.int8.onnx")
+        quantize_dynamic(fp32_path, model_path, weight_type=QuantType.QInt8)
+
+    meta = {
+        "model_name": model_name,
+        "pooling": pooling,
+        "normalize": has_normalize,
+        "max_seq_length": int(st.max_seq_length or tok.model_max_length),
+        "dim": int(st.get_sentence_embedding_dimension()),
+        "input_names": input_names,
+        "model_file": os.path.basename(model_path),
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    print(f"[ONNX] exported {model_name} -> {model_path}")
+    return model_path
+
+# =========================================
+# ONNX Runtime 埋め込み
+# =========================================
+class OnnxEmbedder:
+    """SentenceTransformer 互換の最小インターフェース（encode / tokenizer / 次元）"""
+
+    def __init__(self, model_dir: str, threads: int = 0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta: Dict = json.load(f)
+        if self.meta["pooling"] not in ONNX_POOLING:
+            # 対応前にエクスポートされたモデル
+            raise ValueError(f"Unsupported pooling mode in {model_dir}: {self.meta['pooling']}")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+        self.max_seq_length = self.meta["max_seq_length"]
+
+        opts = ort.SessionOptions()
+        if threads > 0:
+            opts.intra_op_num_threads = threads
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, self.meta["model_file"]),
+            sess_options=opts,
+            providers=["CPUExecutionProvider"],
+        )
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.meta["dim"]
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        mode = self.meta["pooling"]
+        if mode == "cls":
+            return hidden[:, 0]
+        m = mask[..., None].astype(np.float32)
+        if mode == "max":
+            return np.where(m > 0, hidden, -1e9).max(axis=1)
+        # mean（MiniLM / e5 はこれ）
+        return (hidden * m).sum(axis=1) / np.clip(m.sum(axis=1), 1e-9, None)
+
+    def encode(
+        self,
+        sentences,
+        batch_size: int = 32,
+        show_progress_bar: bool = False,
+        normalize_embeddings: bool = False,
+        **_,
+    ) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts: List[str] = [sentences] if single else list(sentences)
+        dim = self.get_sentence_embedding_dimension()
+        if not texts:
+            return np.zeros((0, dim), dtype=np.float32)
+
+        # まとめてトークナイズ → 長さ順に並べてバッチ内パディングを最小化
+        enc = self.tokenizer(texts, truncation=True, max_length=self.max_seq_length)
+        order = sorted(range(len(texts)), key=lambda i: len(enc["input_ids"][i]))
+        out = np.zeros((len(texts), dim), dtype=np.float32)
+        names = self.meta["input_names"]
+
+        for b in range(0, len(order), batch_size):
+            idx = order[b:b + batch_size]
+            feats = self.tokenizer.pad(
+                {n: [enc[n][i] for i in idx] for n in names if n in enc},
+                return_tensors="np",
+            )
+            feed = {n: feats[n].astype(np.int64) for n in names if n in feats}
+            hidden = self.session.run(["last_hidden_state"], feed)[0]
+            out[idx] = self._pool(hidden, feed["attention_mask"])
+            if show_progress_bar:
+                print(f"[ONNX] {min(b + batch_size, len(order))}/{len(order)}")
+
+        if normalize_embeddings or self.meta["normalize"]:
+            out /= np.clip(np.linalg.norm(out, axis=1, keepdims=True), 1e-12, None)
+        return out[0] if single else out
+
+def load_onnx_embedder(model_name: Optional[str] = None) -> OnnxEmbedder:
+    model_name = model_name or active_model_name()
+    model_dir = onnx_model_dir(model_name, EMB.onnx_quantize)
+    if not os.path.exists(os.path.join(model_dir, "meta.json")):
+        export_onnx(model_name, model_dir, quantize=EMB.onnx_quantize)
+    return OnnxEmbedder(model_dir, threads=EMB.onnx_threads)
+
+# =========================================
+# バックエンド選択
+# =========================================
+def active_model_name() -> str:
+    """
+    いま使っている埋め込みモデル（ingest のコレクション名・query の埋め込みの両方がここを見る）。
+    起動時は EmbeddingCfg.model_name で、モデル移行の切り替え（migrate.py）で置き換わる
+    """
+    return EMB.model_name
+
+def set_active_model_name(model_name: str):
+    EMB.model_name = model_name
+
+def load_embedding_backend(device: Optional[str] = None, backend: Optional[str] = None, model_name: Optional[str] = None):
+    """model_name を省略すると active_model_name()（モデル移行中は新モデルを明示する）"""
+    backend = backend or EMB.backend
+    if backend == "onnx":
+        return load_onnx_embedder(model_name)
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name or active_model_name(), device=device)
+
+# =========================================
+# 長さバケット化バッチ（パディング削減）
+# =========================================
+# 1トークンあたりの推論時メモリ目安（アクティベーション込みのざっくり値）
+_BYTES_PER_TOKEN = 64 * 1024
+
+def auto_token_budget(model) -> int:
+    """1バッチに載せるトークン数（最長長 × 件数）の上限を空きメモリから決める"""
+    if EMB.batch_tokens > 0:
+        return EMB.batch_tokens
+    free = 0
+    device = str(getattr(model, "device", "cpu"))
+    if device.startswith("cuda"):
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+    else:
+        try:
+            import psutil
+            free = psutil.virtual_memory().available
+        except ImportError:
+            pass
+    if not free:
+        return 16384
+    budget = int(free * EMB.batch_memory_fraction / _BYTES_PER_TOKEN)
+    return max(2048, min(budget, 262144))
+
+def token_lengths(model, texts: List[str]) -> List[int]:
+    max_len = getattr(model, "max_seq_length", None) or 512
+    enc = model.tokenizer(texts, truncation=True, max_length=max_len, add_special_tokens=True)
+    return [len(ids) for ids in enc["input_ids"]]
+
+def _padding_efficiency(lengths: List[int], batches: List[List[int]]) -> float:
+    real = sum(lengths[i] for b in batches for i in b)
+    padded = sum(len(b) * max(lengths[i] for i in b) for b in batches if b)
+    return real / padded if padded else 1.0
+
+def plan_batches(lengths: List[int], token_budget: int, max_batch: int) -> List[List[int]]:
+    """トークン長でソートし、(件数 × バッチ内最長) が予算内に収まるようにまとめる"""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    for i in order:
+        # 昇順なので追加する要素がバッチ内最長になる
+        if cur and ((len(cur) + 1) * lengths[i] > token_budget or len(cur) >= max_batch):
+            batches.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        batches.append(cur)
+    return batches
+
+def encode_bucketed(
+    model,
+    texts: List[str],
+    normalize_embeddings: bool = True,
+    show_progress_bar: bool = False,
+) -> np.ndarray:
+    """
+    長さバケット化したバッチで埋め込み、元の順序に戻して返す。
+    各テキストの埋め込み自体はバッチ構成に依存しないので、出力は従来の encode と同じ。
+    """
+    if not texts:
+        dim = model.get_sentence_embedding_dimension()
+        return np.zeros((0, dim), dtype=np.float32)
+
+    lengths = token_lengths(model, texts)
+    budget = auto_token_budget(model)
+    # 件数上限は短文が大量に並ぶケースのため（batch_size の数倍まで許す）
+    batches = plan_batches(lengths, budget, max_batch=EMB.batch_size * 8)
+
+    if show_progress_bar:
+        # 進捗表示はインジェストのバッチだけ（質問や文圧縮の埋め込みは呼ばれるたびに出さない）
+        doc_order = [list(range(i, min(i + EMB.batch_size, len(texts)))) for i in range(0, len(texts), EMB.batch_size)]
+        eff = _padding_efficiency(lengths, batches)
+        base = _padding_efficiency(lengths, doc_order)
+        print(f"[EMBED] {len(texts)} texts, {len(batches)} batches, token budget={budget}, "
+              f"padding efficiency={eff:.1%} (document order: {base:.1%})")
+
+    out: Optional[np.ndarray] = None
+    for n, idx in enumerate(batches, 1):
+        vecs = model.encode(
+            [texts[i] for i in idx],
+            batch_size=len(idx),
+            normalize_embeddings=normalize_embeddings,
+        )
+        vecs = np.asarray(vecs, dtype=np.float32)
+        if out is None:
+            out = np.zeros((len(texts), vecs.shape[-1]), dtype=np.float32)
+        out[idx] = vecs
+        if show_progress_bar:
+            print(f"[EMBED] batch {n}/{len(batches)} ({len(idx)} texts, max_len={lengths[idx[-1]]})")
+    return out
@@ -1,50 +1,586 @@
 # -*- coding: utf-8 -*-
+# qdrant_client / sentence_transformers / pdfplumber は使う関数の中で import する（起動を速くするため）
+from __future__ import annotations
+
+import io
 import os
+import re
 import uuid
-from typing import List, Dict
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
-from sentence_transformers import SentenceTransformer
-import pdfplumber
+import hashlib
+from typing import TYPE_CHECKING, List, Dict, Iterable, Iterator, Optional, Tuple, Union, BinaryIO
+
+from config import EmbeddingCfg, QdrantCfg, ChunkCfg, DedupCfg
+from embedding import active_model_name, load_embedding_backend, encode_bucketed
+from utils_chunk import greedy_chunk_by_tokens, greedy_chunk_pages
+from utils_json import iter_json_records, record_to_chunks
+from utils_dedup import LSHIndex, MinHasher, decode_signature, encode_signature
+import chunk_cache
 
-from config import EmbeddingCfg, QdrantCfg, ChunkCfg
-from utils_chunk import greedy_chunk_by_tokens
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import FieldCondition
+    from sentence_transformers import SentenceTransformer
 
 EMB = EmbeddingCfg()
 QDR = QdrantCfg()
 CH  = ChunkCfg()
+DD  = DedupCfg()
+
+TEXT_EXTS = (".txt", ".md")
+JSON_EXTS = (".json", ".jsonl")
+SUPPORTED_EXTS = TEXT_EXTS + JSON_EXTS + (".pdf",)
+
+# パス、またはアップロードを受けたバイナリストリーム
+Source = Union[str, BinaryIO]
+
+# 重複検出用に payload に持たせる内部フィールド（検索結果からは除く）
+INTERNAL_KEYS = ["minhash", "lsh"]
+
+# 親チャンク（節）の保存先は "{collection}__parents"。id は本文ハッシュから決まる uuid5
+PARENT_SUFFIX = "__parents"
+_PARENT_NS = uuid.UUID("6f1c2a3e-9b7d-4e58-a0c1-3d2b5e8f7a94")
+
+# ベクトルの実体は埋め込みモデルごとのコレクション "{collection}__emb_{モデル}" に置き、
+# {collection} はそれを指すエイリアスにする（モデル移行時にエイリアスを付け替える: migrate.py）
+MODEL_MARK = "__emb_"
+
+def parent_collection(collection: str) -> str:
+    # 親はベクトルを持たないので、モデルごとの実体のコレクションからも同じ親を引く
+    return collection.split(MODEL_MARK)[0] + PARENT_SUFFIX
+
+class ModelMismatch(Exception):
+    """コレクションの実体が、設定（使用中）と別の埋め込みモデルで作られている"""
+
+def model_slug(model_name: Optional[str] = None) -> str:
+    return re.sub(r"[^0-9a-z]+", "_", (model_name or active_model_name()).split("/")[-1].lower()).strip("_")
+
+def model_collection(collection: str, model_name: Optional[str] = None) -> str:
+    """model_name を省略すると使用中のモデル（移行の切り替え後は新モデル）"""
+    return f"{collection}{MODEL_MARK}{model_slug(model_name)}"
+
+def collection_names(client: QdrantClient) -> set:
+    """コレクション名とエイリアス名（どちらも検索・登録に使える名前）"""
+    names = {c.name for c in client.get_collections().collections}
+    names.update(a.alias_name for a in client.get_aliases().aliases)
+    return names
+
+def resolve_collection(client: QdrantClient, name: str) -> str:
+    """エイリアスなら実体のコレクション名（エイリアスでなければそのまま）"""
+    for a in client.get_aliases().aliases:
+        if a.alias_name == name:
+            return a.collection_name
+    return name
+
+def collection_model(client: QdrantClient, name: str) -> Optional[str]:
+    """エイリアスの指す実体の埋め込みモデル（model_slug の形）。エイリアス導入前の実体なら None"""
+    physical = resolve_collection(client, name)
+    return physical.split(MODEL_MARK, 1)[1] if MODEL_MARK in physical else None
+
+def check_collection_models(client: QdrantClient, model_name: Optional[str] = None, names: Optional[Iterable[str]] = None):
+    """
+    コレクション（既定・テナント）のエイリアスが model_name（省略時は使用中のモデル）の実体を指しているか確かめる。
+    モデル移行の切り替え後に config.py を更新せず再起動すると、旧モデルで新モデルのベクトルを検索してしまうため、
+    起動時に呼んで違えば ModelMismatch を送出する
+    """
+    expected = model_slug(model_name)
+    wanted = set(names) if names is not None else None
+    wrong = []
+    for a in client.get_aliases().aliases:
+        name = a.alias_name
+        if wanted is not None and name not in wanted:
+            continue
+        if wanted is None and name != QDR.collection and not name.startswith(QDR.collection + "__"):
+            continue
+        if MODEL_MARK in a.collection_name and a.collection_name.split(MODEL_MARK, 1)[1] != expected:
+            wrong.append(f"{name} -> {a.collection_name}")
+    if wrong:
+        raise ModelMismatch(
+            f"埋め込みモデル {model_name or active_model_name()} と一致しないコレクションがあります: {', '.join(sorted(wrong))}"
+            f"（モデル移行で切り替えた場合は config.py の EmbeddingCfg.model_name を新モデルにしてください）"
+        )
+
+def _section_tokens() -> Tuple[int, int]:
+    """ファイルを区切る単位の (target, overlap)。親子チャンクでは親（重なりなし）の大きさ"""
+    if CH.parent_child:
+        return CH.parent_tokens, 0
+    return CH.target_tokens, CH.overlap_tokens
+
+def _open_text(src: Source):
+    if isinstance(src, str):
+        return open(src, "r", encoding="utf-8", errors="ignore")
+    return io.TextIOWrapper(src, encoding="utf-8", errors="ignore")
 
 def load_text_from_file(path: str) -> str:
-    if path.lower().endswith((".txt", ".md", ".json")):
+    if path.lower().endswith(TEXT_EXTS + JSON_EXTS):
         return open(path, "r", encoding="utf-8", errors="ignore").read()
     if path.lower().endswith(".pdf"):
-        out = []
-        with pdfplumber.open(path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text:
-                    out.append(text)
-        return "\n".join(out)
+        return "\n".join(text for _, text in iter_pdf_pages(path) if text)
     return ""
 
+def iter_pdf_pages(src: Source) -> Iterator[Tuple[int, str]]:
+    """PDFを1ページずつ (page_no, text) で返す。抽出後はページのキャッシュを解放する"""
+    import pdfplumber
+
+    with pdfplumber.open(src) as pdf:
+        for page_no, page in enumerate(pdf.pages, 1):
+            text = page.extract_text() or ""
+            page.close()
+            yield page_no, text
+
 def discover_files(root: str) -> List[str]:
     files = []
     for dirpath, _, filenames in os.walk(root):
         for fn in filenames:
-            if fn.lower().endswith((".txt", ".md", ".pdf", ".json")):
+            if fn.lower().endswith(SUPPORTED_EXTS):
                 files.append(os.path.join(dirpath, fn))
     return files
 
+def iter_json_chunks(src: Source, source: str) -> Iterator[Dict]:
+    """JSON/JSONL をレコード単位でストリームし、1 Q&A = 1 チャンクにする"""
+    i = 0
+    with _open_text(src) as f:
+        for rec in iter_json_records(f):
+            for ch in record_to_chunks(rec):
+                ch["source"] = source
+                ch["chunk_id"] = i
+                i += 1
+                yield ch
+
+def iter_pdf_chunks(src: Source, source: str) -> Iterator[Dict]:
+    """ページをストリームしながらチャンク化し、ページ範囲を payload に載せる"""
+    target, overlap = _section_tokens()
+    chunks = greedy_chunk_pages(
+        iter_pdf_pages(src),
+        target_tokens=target,
+        overlap_tokens=overlap,
+        min_chars=CH.min_chars,
+    )
+    for i, ch in enumerate(chunks):
+        ps, pe = ch["page_start"], ch["page_end"]
+        yield {
+            "text": ch["text"],
+            "source": source,
+            "chunk_id": i,
+            "page": str(ps) if ps == pe else f"{ps}-{pe}",
+            "page_start": ps,
+            "page_end": pe,
+        }
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def parent_id(text: str) -> str:
+    return str(uuid.uuid5(_PARENT_NS, text_hash(text)))
+
+def split_children(sections: Iterable[Dict]) -> Iterator[Dict]:
+    """
+    節（親）を文ウィンドウの子チャンクに分ける。
+    子は節のメタデータを引き継ぎ、parent_id と parent_text（保存時に親コレクションへ移す）を持つ。
+    子が1つにしかならない短い節（Q&A など）はそのまま返す。
+    """
+    i = 0
+    for sec in sections:
+        children = greedy_chunk_by_tokens(
+            sec["text"],
+            target_tokens=CH.child_tokens,
+            overlap_tokens=CH.child_overlap_tokens,
+            min_chars=0,
+        )
+        if len(children) <= 1:
+            sec["chunk_id"] = i
+            i += 1
+            yield sec
+            continue
+        pid = parent_id(sec["text"])
+        for child in children:
+            ch = dict(sec)
+            ch.update(text=child, chunk_id=i, parent_id=pid, parent_text=sec["text"])
+            i += 1
+            yield ch
+
+def iter_file_chunks(src: Source, source: str) -> Iterator[Dict]:
+    """
+    拡張子に応じてチャンク（text + メタデータ + text_hash）を順に返す。
+    src がストリームの場合は source のファイル名で形式を判定する。
+    ChunkCfg.parent_child では節を子チャンクに分けて返す。
+    """
+    chunks = _iter_file_chunks(src, source)
+    if CH.parent_child:
+        chunks = split_children(chunks)
+    for ch in chunks:
+        ch["text_hash"] = text_hash(ch["text"])
+        yield ch
+
+def _iter_file_chunks(src: Source, source: str) -> Iterator[Dict]:
+    name = (src if isinstance(src, str) else source).lower()
+    if name.endswith(JSON_EXTS):
+        yield from iter_json_chunks(src, source)
+        return
+    if name.endswith(".pdf"):
+        yield from iter_pdf_chunks(src, source)
+        return
+    if isinstance(src, str):
+        text = load_text_from_file(src)
+    else:
+        text = src.read().decode("utf-8", errors="ignore")
+    if not text.strip():
+        return
+    target, overlap = _section_tokens()
+    chunks = greedy_chunk_by_tokens(
+        text,
+        target_tokens=target,
+        overlap_tokens=overlap,
+        min_chars=CH.min_chars,
+    )
+    for i, ch in enumerate(chunks):
+        yield {
+            "text": ch,
+            "source": source,
+            "chunk_id": i
+        }
+
+# =========================================
+# 差分インジェスト（変更のあったチャンクだけ再埋め込み）
+# =========================================
+def existing_chunks(
+    client: QdrantClient,
+    collection: str,
+    source: str,
+    scope: Optional[List[FieldCondition]] = None,
+) -> Dict[str, List]:
+    """source の既存ポイントを text_hash -> [point id] で返す（scope はテナント条件など）"""
+    from qdrant_client.http.models import FieldCondition, Filter, MatchValue
+
+    out: Dict[str, List] = {}
+    offset = None
+    must = [FieldCondition(key="source", match=MatchValue(value=source))] + (scope or [])
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            scroll_filter=Filter(must=must),
+            limit=1024,
+            offset=offset,
+            with_payload=["text_hash"],
+            with_vectors=False,
+        )
+        for p in points:
+            out.setdefault((p.payload or {}).get("text_hash", ""), []).append(p.id)
+        if offset is None:
+            return out
+
+def skip_unchanged(
+    client: QdrantClient,
+    collection: str,
+    source: str,
+    chunks: Iterable[Dict],
+    reused: List[Tuple],
+    stale: List,
+    scope: Optional[List[FieldCondition]] = None,
+) -> Iterator[Dict]:
+    """
+    既存ポイントと text_hash が一致するチャンクは埋め込みをスキップし (id, payload) を reused へ、
+    新規・変更チャンクだけを返す。走査後に残った既存ポイントは stale に積む。
+    """
+    old = existing_chunks(client, collection, source, scope)
+    for ch in chunks:
+        ids = old.get(ch["text_hash"])
+        if ids:
+            pid = ids.pop()
+            reused.append((pid, {k: v for k, v in ch.items() if k != "text"}))
+            continue
+        yield ch
+    for ids in old.values():
+        stale.extend(ids)
+
+def apply_incremental(client: QdrantClient, collection: str, reused: List[Tuple], stale: List, batch: int = 256):
+    """
+    再利用チャンクの payload（chunk_id/page/parent_id など）を更新し、消えたチャンクを削除する。
+    どの子からも参照されなくなった親は最後にまとめて削除する。
+    """
+    from qdrant_client.http.models import SetPayload, SetPayloadOperation
+
+    old_parents = set()
+    for i in range(0, len(reused), batch):
+        part = reused[i:i + batch]
+        old_parents |= _parent_ids(client, collection, [pid for pid, _ in part])
+        upsert_parents(client, collection, [meta for _, meta in part])
+        chunk_cache.invalidate(collection, [pid for pid, _ in part])
+        client.batch_update_points(
+            collection_name=collection,
+            update_operations=[
+                SetPayloadOperation(set_payload=SetPayload(payload=meta, points=[pid]))
+                for pid, meta in part
+            ],
+        )
+    points = []
+    if stale:
+        points = client.retrieve(
+            collection_name=collection, ids=stale,
+            with_payload=["parent_id", "dup_sources"], with_vectors=False,
+        )
+    delete_points(client, collection, points, old_parents)
+
+def delete_points(client: QdrantClient, collection: str, points: List, old_parents: Iterable[str] = ()) -> Tuple[List, List]:
+    """
+    ポイントを削除し、(削除した id, 残した id) を返す。points は payload に parent_id / dup_sources を含めて取得したもの。
+    他ファイルの重複元でもある（dup_sources を持つ）ポイントは削除せず、dup_sources の先頭ファイルのポイントとして残す。
+    最後に、削除したポイントと old_parents のうちどの子からも参照されなくなった親を削除する。
+    """
+    from qdrant_client.http.models import SetPayload, SetPayloadOperation
+
+    deleted, promoted, ops = [], [], []
+    parents = set(old_parents)
+    for p in points:
+        pay = p.payload or {}
+        others = pay.get("dup_sources") or []
+        if others:
+            ops.append(SetPayloadOperation(set_payload=SetPayload(
+                payload={"source": others[0], "dup_sources": others[1:]}, points=[p.id],
+            )))
+            promoted.append(p.id)
+        else:
+            deleted.append(p.id)
+            if pay.get("parent_id"):
+                parents.add(pay["parent_id"])
+    chunk_cache.invalidate(collection, deleted + promoted)
+    if ops:
+        client.batch_update_points(collection_name=collection, update_operations=ops)
+    if deleted:
+        client.delete(collection_name=collection, points_selector=deleted)
+    prune_parents(client, collection, parents)
+    return deleted, promoted
+
+# =========================================
+# 親チャンク（節）の保存・削除
+# =========================================
+def _parent_ids(client: QdrantClient, collection: str, ids: List) -> set:
+    """指定ポイントが参照している parent_id の集合"""
+    if not ids:
+        return set()
+    points = client.retrieve(collection_name=collection, ids=ids, with_payload=["parent_id"], with_vectors=False)
+    return {p.payload["parent_id"] for p in points if (p.payload or {}).get("parent_id")}
+
+def parent_ids_of(client: QdrantClient, collection: str, flt=None) -> set:
+    """フィルタに一致する子チャンクの parent_id の集合（削除前に呼び、prune_parents に渡す）"""
+    out, offset = set(), None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            scroll_filter=flt,
+            limit=1024,
+            offset=offset,
+            with_payload=["parent_id"],
+            with_vectors=False,
+        )
+        out |= {p.payload["parent_id"] for p in points if (p.payload or {}).get("parent_id")}
+        if offset is None:
+            return out
+
+def upsert_parents(client: QdrantClient, collection: str, chunks: List[Dict]) -> int:
+    """
+    チャンクから parent_text を取り除き、親を "{collection}__parents" に登録する。
+    id は本文ハッシュなので、重なり合う子や別ファイルの同一節が何度出てきても1件しか保存されない。
+    """
+    from qdrant_client.http.models import PointStruct
+
+    parents: Dict[str, str] = {}
+    for ch in chunks:
+        text = ch.pop("parent_text", None)
+        if text is not None:
+            parents[ch["parent_id"]] = text
+    if parents:
+        client.upsert(
+            collection_name=parent_collection(collection),
+            points=[PointStruct(id=pid, vector={}, payload={"text": text, "text_hash": text_hash(text)})
+                    for pid, text in parents.items()],
+        )
+    return len(parents)
+
+def prune_parents(client: QdrantClient, collection: str, parent_ids: Iterable[str]) -> int:
+    """どの子チャンクからも参照されなくなった親を削除する（子の削除後に呼ぶ）"""
+    from qdrant_client.http.models import FieldCondition, Filter, MatchAny
+
+    candidates = list(set(parent_ids))
+    if not candidates:
+        return 0
+    flt = Filter(must=[FieldCondition(key="parent_id", match=MatchAny(any=candidates))])
+    orphans = set(candidates) - parent_ids_of(client, collection, flt)
+    if orphans:
+        client.delete(collection_name=parent_collection(collection), points_selector=list(orphans))
+        print(f"[INGEST] pruned {len(orphans)} orphan parent sections from '{parent_collection(collection)}'")
+    return len(orphans)
+
+# =========================================
+# 近似重複の除去（MinHash/LSH。署名と帯のキーは payload の minhash / lsh に保存）
+# =========================================
+_hasher: Optional[MinHasher] = None
+
+def dedup_index() -> LSHIndex:
+    """1回のインジェスト（複数ファイル）で共有する、未登録チャンク用の LSH インデックス"""
+    global _hasher
+    if _hasher is None:
+        _hasher = MinHasher(DD.num_perm, DD.bands, DD.shingle)
+    return LSHIndex(_hasher)
+
+def _stored_candidates(
+    client: QdrantClient,
+    collection: str,
+    band_keys: List[str],
+    scope: Optional[List[FieldCondition]],
+) -> LSHIndex:
+    """帯のキーが1つでも一致する既存ポイントを Qdrant のキーワードインデックスから引く"""
+    from qdrant_client.http.models import FieldCondition, Filter, MatchAny
+
+    found = dedup_index()
+    flt = Filter(must=[FieldCondition(key="lsh", match=MatchAny(any=band_keys))] + (scope or []))
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            scroll_filter=flt,
+            limit=1024,
+            offset=offset,
+            with_payload=["minhash", "source"],
+            with_vectors=False,
+        )
+        for p in points:
+            pay = p.payload or {}
+            if pay.get("minhash"):
+                found.add(str(p.id), decode_signature(pay["minhash"]), {"source": pay.get("source", "")})
+        if offset is None:
+            return found
+
+def drop_near_duplicates(
+    client: QdrantClient,
+    collection: str,
+    chunks: Iterable[Dict],
+    dups: Dict[str, List[str]],
+    index: LSHIndex,
+    scope: Optional[List[FieldCondition]] = None,
+) -> Iterator[Dict]:
+    """
+    別ファイルの既存ポイント、または index に登録済みのチャンク（同じインジェストで先に出たもの）と
+    ほぼ同一のチャンクを除く。除いたチャンクは dups[重複先のポイント id] に自身の source を積む
+    （登録後に apply_duplicates で dup_sources に反映）。
+    残すチャンクには point_id / minhash / lsh を付けて返す。
+    同じファイル内の重複は対象外（差分インジェストで既存ポイントと対応が取れなくなるため）。
+    """
+    if not DD.enabled:
+        yield from chunks
+        return
+    hasher = index.hasher
+    batch: List[Dict] = []
+
+    def flush():
+        sigs = [hasher.signature(ch["text"]) for ch in batch]
+        keys = [hasher.band_keys(sig) for sig in sigs]
+        stored = _stored_candidates(client, collection, sorted({k for ks in keys for k in ks}), scope)
+        for ch, sig, ks in zip(batch, sigs, keys):
+            match = next(
+                (key for _, key, meta in stored.query(sig, DD.threshold) + index.query(sig, DD.threshold)
+                 if meta["source"] != ch["source"]),
+                None,
+            )
+            if match is not None:
+                dups.setdefault(match, []).append(ch["source"])
+                continue
+            ch.update(point_id=str(uuid.uuid4()), minhash=encode_signature(sig), lsh=ks)
+            index.add(ch["point_id"], sig, {"source": ch["source"]})
+            yield ch
+
+    for ch in chunks:
+        batch.append(ch)
+        if len(batch) >= DD.query_batch:
+            yield from flush()
+            batch = []
+    if batch:
+        yield from flush()
+
+def apply_duplicates(client: QdrantClient, collection: str, dups: Dict[str, List[str]], batch: int = 256) -> int:
+    """drop_near_duplicates で除いたチャンクの source を、重複先ポイントの dup_sources に追加する"""
+    from qdrant_client.http.models import SetPayload, SetPayloadOperation
+
+    ids = list(dups)
+    for i in range(0, len(ids), batch):
+        points = client.retrieve(
+            collection_name=collection, ids=ids[i:i + batch],
+            with_payload=["source", "dup_sources"], with_vectors=False,
+        )
+        ops = []
+        for p in points:
+            pay = p.payload or {}
+            merged = sorted((set(pay.get("dup_sources") or []) | set(dups[str(p.id)])) - {pay.get("source")})
+            ops.append(SetPayloadOperation(set_payload=SetPayload(payload={"dup_sources": merged}, points=[p.id])))
+        chunk_cache.invalidate(collection, [p.id for p in points])
+        if ops:
+            client.batch_update_points(collection_name=collection, update_operations=ops)
+    return sum(len(v) for v in dups.values())
+
+def release_duplicates(
+    client: QdrantClient,
+    collection: str,
+    source: str,
+    scope: Optional[List[FieldCondition]] = None,
+) -> int:
+    """
+    source を他ポイントの dup_sources から外す（ファイルの削除・再インジェスト前に呼ぶ）。
+    再インジェストでまだ重複していれば drop_near_duplicates が改めて記録する。
+    """
+    from qdrant_client.http.models import FieldCondition, Filter, MatchValue, SetPayload, SetPayloadOperation
+
+    flt = Filter(must=[FieldCondition(key="dup_sources", match=MatchValue(value=source))] + (scope or []))
+    released, offset = 0, None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            scroll_filter=flt,
+            limit=256,
+            offset=offset,
+            with_payload=["dup_sources"],
+            with_vectors=False,
+        )
+        ops = [
+            SetPayloadOperation(set_payload=SetPayload(
+                payload={"dup_sources": [s for s in (p.payload or {}).get("dup_sources") or [] if s != source]},
+                points=[p.id],
+            ))
+            for p in points
+        ]
+        if ops:
+            chunk_cache.invalidate(collection, [p.id for p in points])
+            client.batch_update_points(collection_name=collection, update_operations=ops)
+            released += len(ops)
+        if offset is None:
+            return released
+
+def create_chunk_collection(client: QdrantClient, name: str, dim: int):
+    from qdrant_client.http.models import Distance, PayloadSchemaType, VectorParams
+
+    client.create_collection(
+        collection_name=name,
+        vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
+    )
+    # 親の参照確認（prune_parents）・近似重複の候補検索（lsh）・重複元の解除（dup_sources）用
+    for field in ("parent_id", "lsh", "dup_sources"):
+        client.create_payload_index(collection_name=name, field_name=field, field_schema=PayloadSchemaType.KEYWORD)
+
 def ensure_collection(client: QdrantClient, dim: int, name: str):
-    existing = [c.name for c in client.get_collections().collections]
+    from qdrant_client.http.models import CreateAlias, CreateAliasOperation
+
+    existing = collection_names(client)
     if name not in existing:
-        client.create_collection(
-            collection_name=name,
-            vectors_config=VectorParams(size=dim, distance=Distance.COSINE),
-        )
+        physical = model_collection(name)
+        if physical not in existing:
+            create_chunk_collection(client, physical, dim)
+        client.update_collection_aliases(change_aliases_operations=[
+            CreateAliasOperation(create_alias=CreateAlias(collection_name=physical, alias_name=name))
+        ])
+    if CH.parent_child and parent_collection(name) not in existing:
+        # 親は本文を引くだけなのでベクトルを持たない（埋め込みモデルに依存しないので移行もしない）
+        client.create_collection(collection_name=parent_collection(name), vectors_config={})
 
 def embedder():
-    model = SentenceTransformer(EMB.model_name)
+    model = load_embedding_backend()
     if EMB.normalize:
         # SentenceTransformers は encode(normalize_embeddings=True) でもOK
         model.encode(["test"], normalize_embeddings=True)
@@ -56,50 +592,103 @@ def upsert_chunks(
     model: SentenceTransformer,
     chunks: List[Dict],
 ):
+    from qdrant_client.http.models import PointStruct
+
+    upsert_parents(client, collection, chunks)
     texts = [c["text"] for c in chunks]
-    vecs  = model.encode(texts, batch_size=EMB.batch_size, show_progress_bar=True, normalize_embeddings=EMB.normalize)
+    vecs  = encode_bucketed(model, texts, normalize_embeddings=EMB.normalize, show_progress_bar=True)
     points = []
     for v, meta in zip(vecs, chunks):
+        # drop_near_duplicates が先に id を決めている場合はそれを使う（重複の記録先になるため）
+        pid = meta.pop("point_id", None) or str(uuid.uuid4())
         points.append(PointStruct(
-            id=str(uuid.uuid4()),
+            id=pid,
             vector=v.tolist(),
             payload=meta
         ))
     client.upsert(collection_name=collection, points=points)
 
+def upsert_stream(
+    client: QdrantClient,
+    collection: str,
+    model: SentenceTransformer,
+    chunks: Iterable[Dict],
+    batch: int = EMB.upsert_batch,
+) -> int:
+    """チャンクを batch 件ずつまとめて埋め込み・登録する（全件をメモリに載せない）"""
+    buf: List[Dict] = []
+    total = 0
+    for ch in chunks:
+        buf.append(ch)
+        if len(buf) >= batch:
+            upsert_chunks(client, collection, model, buf)
+            total += len(buf)
+            buf = []
+    if buf:
+        upsert_chunks(client, collection, model, buf)
+        total += len(buf)
+    return total
+
 def main():
+    import argparse
+
+    from tenants import TenantError, TenantRouter
+
+    ap = argparse.ArgumentParser(description="docs/ のファイルを埋め込んで Qdrant に登録する")
+    ap.add_argument("--tenant", default=None, help="登録先のテナント（省略時は既定テナント。TenantCfg.mode に従う）")
+    args = ap.parse_args()
+
     src_dir = "docs"   # ← 学習・検索対象の文書ディレクトリ ここを変数で受け取って代入する、受け取る先はフロントエンド側からのリクエストから取得する
     files = discover_files(src_dir)
     if not files:
-        print("No files found in ./docs. Put .txt/.md/.pdf files there.")
+        print("No files found in ./docs. Put .txt/.md/.pdf/.json files there.")
         return
 
+    # /embedd と同じくテナントのコレクションと範囲（payload モードでは tenant キー）で登録する
+    router = TenantRouter()
+    try:
+        tenant = router.get(args.tenant)
+    except TenantError as e:
+        print(f"[ERROR] {e}")
+        return
+    collection, scope = tenant.collection, tenant.scope
+
+    client = router.client()
+    try:
+        check_collection_models(client)
+    except ModelMismatch as e:
+        print(f"[ERROR] {e}")
+        return
     model = embedder()
     dim = model.encode(["dim_check"], normalize_embeddings=EMB.normalize).shape[-1]
-    client = QdrantClient(host=QDR.host, port=QDR.port)
-    ensure_collection(client, dim, QDR.collection)
+    ensure_collection(client, dim, collection)
+    router.ensure_tenant_index(tenant)
 
-    all_chunks = []
-    for fp in files:
-        text = load_text_from_file(fp)
-        if not text.strip():
-            continue
-        chunks = greedy_chunk_by_tokens(
-            text,
-            target_tokens=CH.target_tokens,
-            overlap_tokens=CH.overlap_tokens,
-            min_chars=CH.min_chars,
-        )
-        for i, ch in enumerate(chunks):
-            all_chunks.append({
-                "text": ch,
-                "source": os.path.relpath(fp, start=os.getcwd()),
-                "chunk_id": i
-            })
-        print(f"[INGEST] {fp} -> {len(chunks)} chunks")
-
-    upsert_chunks(client, QDR.collection, model, all_chunks)
-    print(f"Done. Total chunks: {len(all_chunks)}")
+    reused, stale = [], []
+    dups: Dict[str, List[str]] = {}
+    index = dedup_index()
+    def corpus():
+        for fp in files:
+            source = os.path.relpath(fp, start=os.getcwd())
+            n_reused, n_dups = len(reused), sum(len(v) for v in dups.values())
+            n = 0
+            release_duplicates(client, collection, source, scope=scope)
+            chunks = iter_file_chunks(fp, source)
+            if scope:
+                chunks = (dict(ch, tenant=tenant.name) for ch in chunks)
+            chunks = skip_unchanged(client, collection, source, chunks, reused, stale, scope=scope)
+            for ch in drop_near_duplicates(client, collection, chunks, dups, index, scope=scope):
+                n += 1
+                yield ch
+            print(f"[INGEST] {fp} -> {n} chunks to embed, {len(reused) - n_reused} unchanged, "
+                  f"{sum(len(v) for v in dups.values()) - n_dups} near-duplicates")
+
+    total = upsert_stream(client, collection, model, corpus())
+    # 重複の記録を先に: 消えるチャンクが他ファイルの重複元なら、削除せずそのファイルのポイントとして残る
+    n_dups = apply_duplicates(client, collection, dups)
+    apply_incremental(client, collection, reused, stale)
+    print(f"Done ({tenant.name} -> {collection}). Embedded chunks: {total}, unchanged: {len(reused)}, "
+          f"removed: {len(stale)}, near-duplicates: {n_dups}")
 
 if __name__ == "__main__":
     main()
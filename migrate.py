@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""
+埋め込みモデルの移行（再インジェスト・停止なし）
+
+各コレクション名（既定・テナントごと）はモデルごとの実体 "{name}__emb_{モデル}" を指すエイリアス。
+  1. start : 保存済みのチャンク本文を scroll で読み、新モデルで埋め込み直して新しい実体へ
+             id・payload ごと書き込む（バックグラウンドスレッド。元ファイルは読み直さない）
+  2. shadow: その間 /question の一部（MigrationCfg.shadow_sample）を新しい実体でも検索し、
+             上位の一致率とレイテンシを記録する（本番の応答は待たせない）
+  3. switch: 移行中の追加・削除・payload 変更を全件の突き合わせで反映してから書き込みを止め、
+             その間に書き込まれたファイルの分だけを反映して、
+             全コレクションのエイリアスを1回の update_collection_aliases で付け替える
+  4. finish: 切り替え後は旧モデルの実体を削除（切り替え前なら中止して新しい実体を削除）
+
+親チャンク（{name}__parents）はベクトルを持たないので移行しない（新旧で共有）。
+"""
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import chunk_cache
+import embedding
+from config import EmbeddingCfg, MigrationCfg, QdrantCfg
+from embedding import encode_bucketed
+from ingest import (
+    MODEL_MARK,
+    PARENT_SUFFIX,
+    collection_names,
+    create_chunk_collection,
+    model_collection,
+    resolve_collection,
+)
+
+EMB = EmbeddingCfg()
+QDR = QdrantCfg()
+MIG = MigrationCfg()
+
+class MigrationError(Exception):
+    status = 409
+
+class WritesPaused(MigrationError):
+    status = 503
+
+class _Cancelled(Exception):
+    pass
+
+# 移行が終わった（書き込みを止める必要のない）状態
+_DONE = ("switched", "failed", "cancelled")
+
+def logical_collections(client) -> List[str]:
+    """移行対象のコレクション名（既定コレクションとテナントごとのコレクション。親・実体は除く）"""
+    real = {c.name for c in client.get_collections().collections}
+    names = {a.alias_name for a in client.get_aliases().aliases}
+    names.update(n for n in real if MODEL_MARK not in n and not n.endswith(PARENT_SUFFIX))
+    return sorted(n for n in names if n == QDR.collection or n.startswith(QDR.collection + "__"))
+
+def _scroll(client, collection: str, batch: int, with_payload=True, scroll_filter=None) -> Iterator[List]:
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            scroll_filter=scroll_filter,
+            limit=batch,
+            offset=offset,
+            with_payload=with_payload,
+            with_vectors=False,
+        )
+        if points:
+            yield points
+        if offset is None:
+            return
+
+def _hit_key(payload: Dict):
+    return payload.get("source"), payload.get("parent_id") or payload.get("chunk_id")
+
+class WriteGate:
+    """切り替えの間だけ書き込みを止める（実行中の書き込みは終わるまで待つ）"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = 0
+        self._closed = False
+
+    @contextmanager
+    def enter(self):
+        with self._cond:
+            if self._closed:
+                raise WritesPaused("埋め込みモデルの切り替え中です。しばらくしてから再送してください")
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def closed(self, timeout: float):
+        with self._cond:
+            self._closed = True
+            if not self._cond.wait_for(lambda: self._active == 0, timeout):
+                self._closed = False
+                raise MigrationError(f"実行中の書き込みが {timeout:.0f} 秒以内に終わりませんでした")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._closed = False
+
+class Migration:
+    def __init__(self, client, model_name: str, collections: List[str]):
+        self.client = client
+        self.model_name = model_name
+        self.model = None
+        self.dim = 0
+        self.sources: Dict[str, str] = {}
+        self.targets: Dict[str, str] = {}
+        self.progress: Dict[str, Dict[str, int]] = {}
+        for name in collections:
+            self._add(name)
+        self.state = "loading"
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.switched_at: Optional[float] = None
+        self.gate = WriteGate()
+        self._shadow = deque(maxlen=MIG.shadow_history)
+        self._shadow_slot = threading.Semaphore(1)
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        # 切り替え前の同期を始めてから書き込みがあった (コレクション -> source の集合)
+        self._dirty: Dict[str, set] = {}
+        self._dirty_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="embedding-migration", daemon=True)
+
+    def _add(self, name: str):
+        source = resolve_collection(self.client, name)
+        target = model_collection(name, self.model_name)
+        if source == target:
+            raise MigrationError(f"'{name}' は既に {self.model_name} のコレクションです")
+        self.sources[name] = source
+        self.targets[name] = target
+        self.progress[name] = {"copied": 0, "total": 0}
+
+    # =========================================
+    # 埋め込み直し（バックグラウンド）
+    # =========================================
+    def _run(self):
+        from query import load_embedder
+
+        try:
+            print(f"[MIGRATE] Loading {self.model_name} ...")
+            self.model = load_embedder(self.model_name)
+            self.dim = self.model.get_sentence_embedding_dimension()
+            self.state = "copying"
+            for name in list(self.targets):
+                self._copy_all(name)
+            self.state = "ready"
+            print(f"[MIGRATE] Re-embedded {sum(p['copied'] for p in self.progress.values())} chunks "
+                  f"in {time.time() - self.started_at:.0f}s; ready to switch")
+        except _Cancelled:
+            pass
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"[ERROR] Migration failed: {e}")
+
+    def _ensure_target(self, name: str):
+        if self.targets[name] not in collection_names(self.client):
+            create_chunk_collection(self.client, self.targets[name], self.dim)
+
+    def _embed_upsert(self, target: str, points: List):
+        from qdrant_client.http.models import PointStruct
+
+        # payload の text は埋め込んだ本文そのもの（親子チャンクでは子の本文）
+        texts = [p.payload.get("text", "") for p in points]
+        vecs = encode_bucketed(self.model, texts, normalize_embeddings=EMB.normalize)
+        self.client.upsert(
+            collection_name=target,
+            points=[PointStruct(id=p.id, vector=v.tolist(), payload=p.payload) for p, v in zip(points, vecs)],
+        )
+
+    def _copy_all(self, name: str):
+        source, target = self.sources[name], self.targets[name]
+        self._ensure_target(name)
+        progress = self.progress[name]
+        progress["total"] = self.client.count(collection_name=source, exact=True).count
+        for points in _scroll(self.client, source, MIG.batch):
+            if self._cancel.is_set():
+                raise _Cancelled()
+            self._embed_upsert(target, points)
+            progress["copied"] += len(points)
+            print(f"[MIGRATE] {name}: {progress['copied']}/{progress['total']}")
+
+    def _apply(self, target: str, points: List) -> Tuple[int, int]:
+        """旧コレクションの points を新コレクションに反映する（無いものは埋め込み直し、payload の違うものは上書き）"""
+        have = {
+            str(p.id): p.payload
+            for p in self.client.retrieve(
+                collection_name=target, ids=[p.id for p in points], with_payload=True, with_vectors=False
+            )
+        }
+        missing = [p for p in points if str(p.id) not in have]
+        if missing:
+            self._embed_upsert(target, missing)
+        updated = 0
+        for p in points:
+            if str(p.id) in have and have[str(p.id)] != p.payload:
+                self.client.overwrite_payload(collection_name=target, payload=p.payload, points=[p.id])
+                updated += 1
+        return len(missing), updated
+
+    def _sync(self, name: str) -> Dict[str, int]:
+        """コピー後に旧コレクションへ入った追加・削除・payload 変更を新コレクションに反映する（全件を走査）"""
+        from qdrant_client.http.models import PointIdsList
+
+        source, target = self.sources[name], self.targets[name]
+        seen = set()
+        added = updated = 0
+        for points in _scroll(self.client, source, MIG.batch):
+            seen.update(str(p.id) for p in points)
+            a, u = self._apply(target, points)
+            added += a
+            updated += u
+        stale = [p.id for points in _scroll(self.client, target, MIG.batch, with_payload=False)
+                 for p in points if str(p.id) not in seen]
+        if stale:
+            self.client.delete(collection_name=target, points_selector=PointIdsList(points=stale))
+        self.progress[name]["copied"] = len(seen)
+        return {"added": added, "updated": updated, "removed": len(stale)}
+
+    def _sync_sources(self, name: str, sources: set) -> Dict[str, int]:
+        """
+        書き込みのあったファイル（source）に関係するポイントだけを反映する（書き込みを止めている間の差分）。
+        重複の記録・解除や重複元の付け替えで別ファイルのポイントも変わるので、
+        source か dup_sources にそのファイルを含むポイントを新旧両方から集めて突き合わせる
+        """
+        from qdrant_client.http.models import FieldCondition, Filter, MatchAny, PointIdsList
+
+        source, target = self.sources[name], self.targets[name]
+        files = sorted(sources)
+        flt = Filter(should=[
+            FieldCondition(key="source", match=MatchAny(any=files)),
+            FieldCondition(key="dup_sources", match=MatchAny(any=files)),
+        ])
+        current = {str(p.id): p for points in _scroll(self.client, source, MIG.batch, scroll_filter=flt) for p in points}
+        copied = {str(p.id): p.id for points in _scroll(self.client, target, MIG.batch, with_payload=False, scroll_filter=flt)
+                  for p in points}
+        # 新コレクション側だけで一致したもの: 旧コレクションでは削除されたか、source が付け替わった
+        others = [pid for key, pid in copied.items() if key not in current]
+        for i in range(0, len(others), MIG.batch):
+            for p in self.client.retrieve(collection_name=source, ids=others[i:i + MIG.batch],
+                                          with_payload=True, with_vectors=False):
+                current[str(p.id)] = p
+        added = updated = 0
+        points = list(current.values())
+        for i in range(0, len(points), MIG.batch):
+            a, u = self._apply(target, points[i:i + MIG.batch])
+            added += a
+            updated += u
+        stale = [pid for key, pid in copied.items() if key not in current]
+        if stale:
+            self.client.delete(collection_name=target, points_selector=PointIdsList(points=stale))
+        return {"added": added, "updated": updated, "removed": len(stale)}
+
+    def mark_dirty(self, writes: Dict[str, set]):
+        with self._dirty_lock:
+            for name, sources in writes.items():
+                self._dirty.setdefault(name, set()).update(sources)
+
+    # =========================================
+    # シャドー検索
+    # =========================================
+    def shadow(self, collection: str, question: str, top_k: int, source_filter, scope,
+               primary: List, primary_ms: float):
+        """サンプリングした質問を新コレクションでも検索する（前回の比較が実行中なら捨てる）"""
+        if self.state not in ("copying", "ready") or collection not in self.targets:
+            return
+        if random.random() >= MIG.shadow_sample or not self._shadow_slot.acquire(blocking=False):
+            return
+        threading.Thread(
+            target=self._shadow_run,
+            args=(collection, question, top_k, source_filter, scope, primary, primary_ms),
+            daemon=True,
+        ).start()
+
+    def _shadow_run(self, collection, question, top_k, source_filter, scope, primary, primary_ms):
+        from query import search
+
+        try:
+            t0 = time.perf_counter()
+            hits = search(
+                client=self.client,
+                emb_model=self.model,
+                query=question,
+                top_k=top_k,
+                source_filter=source_filter,
+                collection=self.targets[collection],
+                scope=scope,
+            )
+            new_ms = (time.perf_counter() - t0) * 1000
+            old = [_hit_key(p) for _, p in primary]
+            new = [_hit_key(p) for _, p in hits]
+            self._shadow.append({
+                "overlap": len(set(old) & set(new)) / max(len(old), 1),
+                "top1": bool(old and new and old[0] == new[0]),
+                "old_ms": primary_ms,
+                "new_ms": new_ms,
+            })
+        except Exception as e:
+            print(f"[WARN] Shadow search failed: {e}")
+        finally:
+            self._shadow_slot.release()
+
+    def shadow_summary(self) -> Dict:
+        samples = list(self._shadow)
+        if not samples:
+            return {"samples": 0}
+        old_ms = [s["old_ms"] for s in samples]
+        new_ms = [s["new_ms"] for s in samples]
+        return {
+            "samples": len(samples),
+            "overlap_mean": round(float(np.mean([s["overlap"] for s in samples])), 3),
+            "top1_agreement": round(float(np.mean([s["top1"] for s in samples])), 3),
+            "old_ms_p50": round(float(np.percentile(old_ms, 50)), 1),
+            "old_ms_p95": round(float(np.percentile(old_ms, 95)), 1),
+            "new_ms_p50": round(float(np.percentile(new_ms, 50)), 1),
+            "new_ms_p95": round(float(np.percentile(new_ms, 95)), 1),
+        }
+
+    # =========================================
+    # 切り替え・後片付け
+    # =========================================
+    def switch(self, on_switch: Optional[Callable] = None) -> Dict[str, Dict[str, int]]:
+        """
+        on_switch(model) はエイリアスを付け替えた直後、書き込みを止めたまま呼ばれる
+        （サーバーが保持している埋め込みモデルの差し替えなど）
+        """
+        from qdrant_client.http.models import (
+            CreateAlias,
+            CreateAliasOperation,
+            DeleteAlias,
+            DeleteAliasOperation,
+        )
+
+        with self._lock:
+            if self.state != "ready":
+                raise MigrationError(f"切り替えできる状態ではありません（{self.state}）")
+            self.state = "switching"
+            # 実行中のシャドー検索を待ち、以降は始めさせない（新しい実体のキャッシュに同期前の payload を残さないため）
+            self._shadow_slot.acquire()
+            try:
+                # 移行中に作られたコレクション（新しいテナント）も移す
+                for name in logical_collections(self.client):
+                    if name not in self.targets:
+                        self._add(name)
+                        self._ensure_target(name)
+                # 全件の突き合わせは書き込みを止める前に行う。ここから先の書き込みは
+                # writing() が (コレクション, source) を記録するので、止めている間はその分だけ反映する
+                with self._dirty_lock:
+                    self._dirty = {}
+                synced = {}
+                for name in self.targets:
+                    self._ensure_target(name)
+                    synced[name] = self._sync(name)
+                with self.gate.closed(MIG.write_wait_s):
+                    with self._dirty_lock:
+                        dirty, self._dirty = self._dirty, {}
+                    for name, sources in dirty.items():
+                        if name in self.targets:
+                            for key, n in self._sync_sources(name, sources).items():
+                                synced[name][key] += n
+                    # 全件の突き合わせの後に作られたコレクション（作られたばかりで小さい）は全件で
+                    for name in logical_collections(self.client):
+                        if name not in self.targets:
+                            self._add(name)
+                            self._ensure_target(name)
+                            synced[name] = self._sync(name)
+                    real = {c.name for c in self.client.get_collections().collections}
+                    aliases = {a.alias_name for a in self.client.get_aliases().aliases}
+                    ops = []
+                    for name, target in self.targets.items():
+                        if name in real:
+                            # エイリアス導入前の実体（名前が論理名のまま）は同名のエイリアスを作れないので削除する。
+                            # この1回だけは付け替えが原子的にならず、旧モデルのデータも残らない
+                            print(f"[WARN] '{name}' is a plain collection; deleting it before creating the alias")
+                            self.client.delete_collection(collection_name=name)
+                            self.sources[name] = ""
+                        elif name in aliases:
+                            ops.append(DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=name)))
+                        ops.append(CreateAliasOperation(create_alias=CreateAlias(collection_name=target, alias_name=name)))
+                    # 全コレクションのエイリアスを1回の操作で付け替える
+                    self.client.update_collection_aliases(change_aliases_operations=ops)
+                    # このプロセスの埋め込み（ingest / query）と新しく作るコレクションの実体名も新モデルにする。
+                    # 再起動後は config.py の EmbeddingCfg.model_name が新モデルでないと起動時の確認で止まる
+                    embedding.set_active_model_name(self.model_name)
+                    if on_switch is not None:
+                        # 質問の埋め込みに使うモデルもエイリアスの付け替えと同じ区間で入れ替える
+                        on_switch(self.model)
+                    # キャッシュのキーは実体名なので旧モデルのエントリは新しい実体に引き継がれない。
+                    # シャドー検索で載せた新しい実体のエントリは同期で payload が変わっている可能性があるので捨てる
+                    for target in self.targets.values():
+                        chunk_cache.invalidate_collection(target)
+                    self.state = "switched"
+                    self.switched_at = time.time()
+            except Exception:
+                if self.state == "switching":
+                    self.state = "ready"
+                raise
+            finally:
+                self._shadow_slot.release()
+        print(f"[MIGRATE] Switched {len(self.targets)} collections to {self.model_name}")
+        return synced
+
+    def finish(self) -> List[str]:
+        """切り替え後: 旧モデルの実体を削除。切り替え前: 移行を中止して新しい実体を削除"""
+        with self._lock:
+            if self.state == "switched":
+                drop = [s for s in self.sources.values() if s]
+            else:
+                self._cancel.set()
+                self._thread.join()
+                drop = list(self.targets.values())
+                self.state = "cancelled"
+            existing = collection_names(self.client)
+            dropped = [name for name in drop if name in existing]
+            for name in dropped:
+                self.client.delete_collection(collection_name=name)
+                chunk_cache.invalidate_collection(name)
+        print(f"[MIGRATE] Dropped {dropped}")
+        return dropped
+
+    def status(self) -> Dict:
+        return {
+            "model_name": self.model_name,
+            "state": self.state,
+            "error": self.error,
+            "elapsed_sec": round(time.time() - self.started_at, 1),
+            "collections": {
+                name: {"source": self.sources[name], "target": self.targets[name], **self.progress[name]}
+                for name in list(self.targets)
+            },
+            "shadow": self.shadow_summary(),
+        }
+
+# =========================================
+# プロセス内で1つだけ実行する
+# =========================================
+_current: Optional[Migration] = None
+_current_lock = threading.Lock()
+
+def current() -> Optional[Migration]:
+    return _current
+
+def start(client, model_name: str) -> Migration:
+    global _current
+    with _current_lock:
+        if _current is not None and _current.state not in _DONE:
+            raise MigrationError(f"移行が進行中です（{_current.model_name}: {_current.state}）")
+        collections = logical_collections(client)
+        if not collections:
+            raise MigrationError("移行するコレクションがありません")
+        _current = Migration(client, model_name, collections)
+        _current._thread.start()
+    return _current
+
+_writes = threading.local()
+
+def record_write(collection: str, sources):
+    """
+    書き込み中のリクエストが変更するファイル（source）を記録する（writing() の中で、書き込む前に呼ぶ）。
+    writing() を抜けるときに移行の差分対象に加わり、切り替え時はこの分だけを書き込みを止めて反映する
+    """
+    pending = getattr(_writes, "pending", None)
+    if pending is not None:
+        pending.setdefault(collection, set()).update(sources)
+
+@contextmanager
+def writing(destructive: bool = False):
+    """
+    書き込み系のリクエストを囲む。移行中は切り替えの間だけ WritesPaused を送出する。
+    コレクションごと消す操作（destructive）は移行中は受け付けない
+    """
+    m = _current
+    if m is None or m.state in _DONE:
+        yield
+        return
+    if destructive:
+        raise MigrationError("埋め込みモデルの移行中はリセットできません")
+    with m.gate.enter():
+        _writes.pending = {}
+        try:
+            yield
+        finally:
+            # 失敗した書き込みも途中まで反映されている可能性があるので記録する
+            m.mark_dirty(_writes.pending)
+            _writes.pending = None
@@ -1,25 +1,45 @@
 # -*- coding: utf-8 -*-
-from typing import List, Tuple, Dict, Optional
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Filter, FieldCondition, MatchValue
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
+# torch / transformers / sentence_transformers / qdrant_client は import に数秒かかるため、
+# 使う関数の中で import する（app の起動や /health を重い依存の読み込みで待たせない）
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, List, Tuple, Dict, Optional
+from collections import OrderedDict
+import copy
+import threading
+import numpy as np
 import math
 import re
 import time
 import os
+import weakref
+
+from config import EmbeddingCfg, QdrantCfg, LLMCfg, ChunkCfg, SearchCfg, CacheCfg, CompressCfg
+from embedding import load_embedding_backend, encode_bucketed
+from ingest import INTERNAL_KEYS, check_collection_models, parent_collection
+from chunk_cache import cache_collection, get_chunk_cache
+from tenants import LRUCache
+from utils_chunk import split_sentences
 
-from config import EmbeddingCfg, QdrantCfg, LLMCfg
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import FieldCondition, Filter
+    from sentence_transformers import SentenceTransformer
+    from transformers import AutoTokenizer
 
 EMB = EmbeddingCfg()
 QDR = QdrantCfg()
 LLM = LLMCfg()
+CH = ChunkCfg()
+SRCH = SearchCfg()
+CACHE = CacheCfg()
+COMP = CompressCfg()
 
 # =========================================
 # デバイス/共通ユーティリティ
 # =========================================
 def pick_device() -> str:
+    import torch
     if torch.cuda.is_available():
         return "cuda"
     # Apple Silicon (MPS)
@@ -28,6 +48,7 @@ def pick_device() -> str:
     return "cpu"
 
 def get_dtype():
+    import torch
     if LLM.dtype == "bfloat16":
         return torch.bfloat16
     if LLM.dtype == "float16":
@@ -37,12 +58,20 @@ def get_dtype():
 def now_ms() -> int:
     return int(time.time() * 1000)
 
+def rss_gb() -> float:
+    """現在のプロセスの常駐メモリ（GB）。psutil が無ければ 0"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 3
+    except ImportError:
+        return 0.0
+
 # =========================================
 # 埋め込みモデル読み込み
 # =========================================
-def load_embedder() -> SentenceTransformer:
+def load_embedder(model_name: Optional[str] = None) -> SentenceTransformer:
     device = pick_device()
-    model = SentenceTransformer(EMB.model_name, device=device)
+    model = load_embedding_backend(device=device, model_name=model_name)
     return model
 
 # =========================================
@@ -110,29 +139,55 @@ def search(
     mmr_lambda: float = 0.7,
     hybrid_boost: float = 0.15,
     timeout: int = 5,
+    collection: Optional[str] = None,
+    scope: Optional[List[FieldCondition]] = None,
+    adaptive: Optional[bool] = None,
+    stats: Optional[Dict] = None,
+    expand: Optional[bool] = None,
+    paraphrases: Optional[List[str]] = None,
 ) -> List[Tuple[float, Dict]]:
     """
-    - ベクトル検索 (top_k*3) で粗取り
+    - ベクトル検索 (top_k*3) で粗取り（adaptive では id とスコアだけをページ単位で取り、早期に打ち切る）
+    - expand（既定は SearchCfg.expansion）ではキーワードの部分集合・言い換えでも検索し、RRF で統合して粗取りにする
     - クエリ/候補のコサインからMMRで多様化して上位 top_k を選出
     - ハイブリッド風: payloadの title/text/source にキーワード命中で微ブースト
+    - 親子チャンク: 子の命中を親ごとに1件にまとめ、親の本文を1回の retrieve で取得して差し替える
+    - collection / scope でテナントのコレクション・絞り込み条件を指定（省略時は QDR.collection）
+    - stats を渡すと取得件数・ページ数・所要時間を書き込む
     """
     t0 = now_ms()
-    qvec = emb_model.encode([query], normalize_embeddings=EMB.normalize)[0].tolist()
-    flt = None
-    if source_filter:
-        flt = Filter(must=[FieldCondition(key="source", match=MatchValue(value=source_filter))])
+    collection = collection or QDR.collection
+    flt = _build_filter(source_filter, scope)
+    adaptive = SRCH.adaptive if adaptive is None else adaptive
+    expand = SRCH.expansion if expand is None else expand
+    stats = {} if stats is None else stats
+    queries = expand_query(query, paraphrases) if expand else [query]
 
-    # まずは十分大きく取得して MMR
-    rough_k = max(top_k * 3, 12)
-    hits = client.search(
-        collection_name=QDR.collection,
-        query_vector=qvec,
-        limit=rough_k,
-        with_payload=True,
-        query_filter=flt,
-        timeout=timeout,
-        with_vectors=True,  # MMR用にベクトルを取り出す
-    )
+    if len(queries) > 1:
+        # 拡張したクエリをまとめて埋め込み・検索し、RRF で統合した候補を MMR にかける
+        qvec, hits = multi_query_candidates(client, emb_model, collection, queries, flt, top_k, timeout, stats)
+    elif adaptive:
+        qvec = emb_model.encode([query], normalize_embeddings=EMB.normalize)[0].tolist()
+        # キーワードブーストの上限（これを足しても届かない候補は取らない）
+        max_boost = hybrid_boost * len(extract_keywords(query))
+        hits = adaptive_candidates(client, collection, qvec, flt, top_k, max_boost, timeout, stats)
+    else:
+        qvec = emb_model.encode([query], normalize_embeddings=EMB.normalize)[0].tolist()
+        # まずは十分大きく取得して MMR
+        rough_k = _rough_k(top_k)
+        hits = client.search(
+            collection_name=collection,
+            query_vector=qvec,
+            limit=rough_k,
+            with_payload=_payload_selector(),
+            query_filter=flt,
+            timeout=timeout,
+            with_vectors=True,  # MMR用にベクトルを取り出す
+        )
+        stats.update(fetched=len(hits), pages=1)
+        # 同じ親の子はスコア最上位の1件だけ残す
+        hits = collapse_by_parent(hits)
+        stats["survivors"] = len(hits)
 
     if not hits:
         return []
@@ -140,7 +195,293 @@ def search(
     # 候補ベクトルとMMR
     cand_vecs = [h.vector for h in hits]  # type: ignore
     selected_idx = mmr_select(qvec, cand_vecs, k=top_k, lambda_div=mmr_lambda)
+    results = rerank_hits(query, hits, selected_idx, top_k, hybrid_boost)
+    results = expand_parents(client, collection, [results])[0]
+    stats["search_ms"] = now_ms() - t0
+    return results
+
+# =========================================
+# 適応的な候補取得（id + スコアをページ単位で取り、生き残りだけ本体を取得）
+# =========================================
+class _Candidate:
+    """retrieve の結果にスコアを付けたもの（ScoredPoint と同じ属性で MMR / rerank_hits に渡す）"""
+    __slots__ = ("id", "score", "payload", "vector")
+
+    def __init__(self, id, score: float, payload: Optional[Dict], vector):
+        self.id = id
+        self.score = score
+        self.payload = payload
+        self.vector = vector
+
+def _cannot_enter(score: float, best: float, kth: float, max_boost: float) -> bool:
+    """score 以下の候補が上位 top_k に入り得ないか（best: 最高スコア, kth: top_k 番目のスコア）"""
+    if SRCH.min_score > 0 and score < SRCH.min_score:
+        return True
+    if best - score > SRCH.score_gap:
+        return True
+    # キーワードブーストを最大まで足しても top_k 番目に届かない
+    return score + max_boost < kth
+
+def adaptive_candidates(
+    client: QdrantClient,
+    collection: str,
+    qvec: List[float],
+    flt: Optional[Filter],
+    top_k: int,
+    max_boost: float,
+    timeout: int = 5,
+    stats: Optional[Dict] = None,
+) -> List[_Candidate]:
+    """
+    ベクトル・本文なしで (id, スコア, parent_id) をページ単位に取得し、
+    取得済みの最低スコアが上位 top_k に入り得なくなった時点（または従来の粗取り件数）で打ち切る。
+    生き残った候補だけ、ベクトルと必要な payload を1回の retrieve で取得する。
+    同じ親の子はスコア最上位の1件だけを候補にする。
+    """
+    # キャッシュのキーは検索を始めた時点のモデルの実体名（途中でモデル移行の切り替えがあっても取り違えない）
+    cache_name = cache_collection(collection)
+    max_fetch = _rough_k(top_k)
+    max_pool = max(top_k * 3, 12)
+    page = max(SRCH.page_size, top_k)
+    pool: List[Tuple] = []  # (id, score)、スコア降順
+    parents = set()
+    fetched = pages = 0
+    while fetched < max_fetch and len(pool) < max_pool:
+        res = client.search(
+            collection_name=collection,
+            query_vector=qvec,
+            query_filter=flt,
+            limit=min(page, max_fetch - fetched),
+            offset=fetched,
+            with_payload=["parent_id"],
+            with_vectors=False,
+            timeout=timeout,
+        )
+        pages += 1
+        fetched += len(res)
+        for h in res:
+            pid = (h.payload or {}).get("parent_id")
+            if pid:
+                if pid in parents:
+                    continue
+                parents.add(pid)
+            pool.append((h.id, float(h.score)))
+        if len(res) < page or (
+            len(pool) >= top_k and _cannot_enter(pool[-1][1], pool[0][1], pool[top_k - 1][1], max_boost)
+        ):
+            break
+
+    # 上位 top_k 件は必ず残し、それ以降は入り得るものだけ
+    survivors = pool[:top_k]
+    if len(pool) > top_k:
+        best, kth = pool[0][1], pool[top_k - 1][1]
+        survivors += [(pid, sc) for pid, sc in pool[top_k:max_pool] if not _cannot_enter(sc, best, kth, max_boost)]
+    if not survivors:
+        if stats is not None:
+            stats.update(fetched=fetched, pages=pages, survivors=0, cache_hits=0)
+        return []
+
+    # ベクトル・payload はキャッシュに無いものだけ Qdrant から取得する
+    cache = get_chunk_cache()
+    bodies = cache.get_many(cache_name, [pid for pid, _ in survivors], dim=len(qvec)) if cache is not None else {}
+    n_cached = len(bodies)
+    missing = [pid for pid, _ in survivors if str(pid) not in bodies]
+    if missing:
+        records = client.retrieve(
+            collection_name=collection,
+            ids=missing,
+            with_payload=_payload_selector(),
+            with_vectors=True,
+        )
+        for r in records:
+            bodies[str(r.id)] = (r.vector, r.payload or {})
+        if cache is not None:
+            cache.put_many(cache_name, [(r.id, r.vector, r.payload or {}) for r in records])
+    if stats is not None:
+        stats.update(fetched=fetched, pages=pages, survivors=len(survivors), cache_hits=n_cached)
+    return [
+        _Candidate(pid, sc, bodies[str(pid)][1], list(bodies[str(pid)][0]))
+        for pid, sc in survivors if str(pid) in bodies
+    ]
+
+# =========================================
+# クエリ拡張（キーワードの部分集合・LLM の言い換え → 1回の search_batch → RRF）
+# =========================================
+_HIRAGANA = re.compile(r"[ぁ-ん]+")
+
+def expansion_terms(query: str, max_terms: int = 8) -> List[str]:
+    """
+    extract_keywords の語をひらがな（助詞・送り仮名）で区切った語。
+    日本語の文はひらがなを挟んで1語につながるため、そのままでは部分集合を作れない
+    """
+    terms, seen = [], set()
+    for w in extract_keywords(query, max_kw=max_terms):
+        for t in _HIRAGANA.split(w):
+            if len(t) >= 2 and t.lower() not in seen:
+                seen.add(t.lower())
+                terms.append(t)
+    return terms[:max_terms]
+
+def expand_query(query: str, paraphrases: Optional[List[str]] = None) -> List[str]:
+    """元の質問を先頭に、キーワードの部分集合と言い換えを加える（重複を除き、追加は expansion_max 件まで）"""
+    kws = expansion_terms(query)
+    variants: List[str] = []
+    if len(kws) >= 2:
+        variants.append(" ".join(kws))
+    variants += list(paraphrases or [])
+    if len(kws) >= 4:
+        # 複数の論点を含む質問は前半・後半のキーワードでも別々に引く
+        half = (len(kws) + 1) // 2
+        variants += [" ".join(kws[:half]), " ".join(kws[half:])]
+    out, seen = [query], {query.strip().lower()}
+    for v in variants:
+        key = v.strip().lower()
+        if key and key not in seen and len(out) <= SRCH.expansion_max:
+            seen.add(key)
+            out.append(v.strip())
+    return out
+
+_paraphrase_cache = LRUCache(SRCH.paraphrase_entries)
+_LIST_MARK = re.compile(r"^\s*(?:[-・*]|\d+[.)．、])\s*")
+
+def llm_paraphrases(query: str, model, tok, n: Optional[int] = None) -> List[str]:
+    """LLM に質問の言い換えを n 通り作らせる（同じ質問は LRU キャッシュから返す）"""
+    n = n or SRCH.paraphrases
+    cached = _paraphrase_cache.get((query, n))
+    if cached is not None:
+        return cached
+    messages = [
+        {"role": "system", "content": "あなたは検索クエリを書き換えるアシスタントです。"},
+        {"role": "user", "content": (
+            f"次の質問を、意味を変えずに別の言い回しで{n}通り書き換えてください。"
+            f"1行に1つずつ、説明は付けずに出力してください。\n\n質問: {query}"
+        )},
+    ]
+    # 接頭辞KVキャッシュは回答用のシステム文のものなので使わない
+    text = chat(model, tok, messages, use_prefix_cache=False, profile="greedy")
+    out = [_LIST_MARK.sub("", line).strip() for line in text.splitlines()]
+    out = [line for line in out if line][:n]
+    _paraphrase_cache.put((query, n), out)
+    return out
+
+def multi_query_candidates(
+    client: QdrantClient,
+    emb_model: SentenceTransformer,
+    collection: str,
+    queries: List[str],
+    flt: Optional[Filter],
+    top_k: int,
+    timeout: int = 5,
+    stats: Optional[Dict] = None,
+) -> Tuple[List[float], List[_Candidate]]:
+    """
+    全クエリを1回の encode で埋め込み、1回の search_batch で検索する。
+    各クエリの順位（同じ親の子は1件に畳む）を RRF で統合し、上位を MMR の候補にする。
+    候補のスコアは元の質問（queries[0]）とのコサインにする（MMR・キーワードブーストは従来どおり）
+    """
+    from qdrant_client.http.models import SearchRequest
+
+    qvecs = np.asarray(
+        emb_model.encode(queries, batch_size=EMB.batch_size, normalize_embeddings=EMB.normalize),
+        dtype=np.float32,
+    )
+    results = client.search_batch(
+        collection_name=collection,
+        requests=[
+            SearchRequest(vector=v.tolist(), limit=_rough_k(top_k), filter=flt,
+                          with_payload=_payload_selector(), with_vector=True)
+            for v in qvecs
+        ],
+        timeout=timeout,
+    )
+    fused: Dict[str, float] = {}
+    first: Dict[str, object] = {}
+    for hits in results:
+        for rank, h in enumerate(collapse_by_parent(hits)):
+            key = str((h.payload or {}).get("parent_id") or h.id)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (SRCH.rrf_k + rank + 1)
+            first.setdefault(key, h)
+    order = sorted(fused, key=fused.get, reverse=True)[:max(top_k * 3, 12)]
+
+    q = qvecs[0] / (np.linalg.norm(qvecs[0]) + 1e-12)
+    cands = []
+    for key in order:
+        h = first[key]
+        v = np.asarray(h.vector, dtype=np.float32)
+        cands.append(_Candidate(h.id, float(v @ q / (np.linalg.norm(v) + 1e-12)), h.payload or {}, list(h.vector)))
+    if stats is not None:
+        stats.update(fetched=sum(len(r) for r in results), pages=1, survivors=len(cands), queries=len(queries))
+    return qvecs[0].tolist(), cands
+
+def _payload_selector():
+    """検索・プロンプト・レスポンスで使う payload だけを取得する（重複検出用の minhash / lsh は取らない）"""
+    if SRCH.payload_fields:
+        return list(SRCH.payload_fields)
+    from qdrant_client.http.models import PayloadSelectorExclude
+    return PayloadSelectorExclude(exclude=INTERNAL_KEYS)
+
+def _rough_k(top_k: int) -> int:
+    rough_k = max(top_k * 3, 12)
+    return rough_k * CH.search_fanout if CH.parent_child else rough_k
+
+# =========================================
+# 親子チャンク（子の命中 → 親の本文）
+# =========================================
+def collapse_by_parent(hits: List) -> List:
+    """スコア順の命中から、同じ parent_id を持つ2件目以降を除く（parent_id の無い点はそのまま）"""
+    seen = set()
+    out = []
+    for h in hits:
+        pid = (h.payload or {}).get("parent_id")
+        if pid:
+            if pid in seen:
+                continue
+            seen.add(pid)
+        out.append(h)
+    return out
 
+_parent_cache = LRUCache(CACHE.parent_entries)
+
+def expand_parents(
+    client: QdrantClient,
+    collection: str,
+    results_list: List[List[Tuple[float, Dict]]],
+) -> List[List[Tuple[float, Dict]]]:
+    """
+    子チャンクの payload を親の本文に差し替える（全クエリ分の親を1回の retrieve で取得）。
+    命中した子の本文は match_text に残す。親が見つからない場合は子のまま返す。
+    """
+    pids = list({p["parent_id"] for results in results_list for _, p in results if p.get("parent_id")})
+    if not pids:
+        return results_list
+    # 親の ID は本文ハッシュなので、キャッシュした本文が古くなることはない
+    parents = {pid: _parent_cache.get(pid) for pid in pids}
+    missing = [pid for pid, text in parents.items() if text is None]
+    if missing:
+        for pt in client.retrieve(collection_name=parent_collection(collection), ids=missing,
+                                  with_payload=["text"], with_vectors=False):
+            parents[str(pt.id)] = (pt.payload or {}).get("text", "")
+            _parent_cache.put(str(pt.id), parents[str(pt.id)])
+    out = []
+    for results in results_list:
+        expanded = []
+        for sc, p in results:
+            text = parents.get(p.get("parent_id") or "")
+            if text:
+                p = dict(p, text=text, match_text=p.get("text", ""))
+            expanded.append((sc, p))
+        out.append(expanded)
+    return out
+
+def _build_filter(source_filter: Optional[str], scope: Optional[List[FieldCondition]]) -> Optional[Filter]:
+    from qdrant_client.http.models import FieldCondition, Filter, MatchValue
+    must = list(scope or [])
+    if source_filter:
+        must.append(FieldCondition(key="source", match=MatchValue(value=source_filter)))
+    return Filter(must=must) if must else None
+
+def rerank_hits(query: str, hits, selected_idx: List[int], top_k: int, hybrid_boost: float) -> List[Tuple[float, Dict]]:
+    """MMRで選ばれた候補にキーワードブーストをかけ、スコア順に並べて重複を除く"""
     # 簡易ハイブリッド: キーワード命中で微ブースト
     kws = extract_keywords(query)
     out: List[Tuple[float, Dict]] = []
@@ -172,6 +513,201 @@ def search(
             deduped.append((sc, p))
     return deduped[:top_k]
 
+# =========================================
+# バッチ検索（評価ワークロード向け）
+# =========================================
+def mmr_select_batch(
+    query_vecs: np.ndarray,
+    cand_vecs: List[List[List[float]]],
+    k: int,
+    lambda_div: float = 0.7,
+) -> List[List[int]]:
+    """
+    全クエリ分の MMR を行列演算でまとめて行う（結果は mmr_select と同じ選択順）。
+    候補数の違いはパディング＋マスクで吸収する。
+    """
+    nq = len(cand_vecs)
+    nc = max((len(c) for c in cand_vecs), default=0)
+    if nq == 0 or nc == 0:
+        return [[] for _ in range(nq)]
+    dim = query_vecs.shape[-1]
+    C = np.zeros((nq, nc, dim), dtype=np.float32)
+    valid = np.zeros((nq, nc), dtype=bool)
+    for qi, vecs in enumerate(cand_vecs):
+        if vecs:
+            C[qi, :len(vecs)] = np.asarray(vecs, dtype=np.float32)
+            valid[qi, :len(vecs)] = True
+    Q = query_vecs.astype(np.float32)
+    C /= np.linalg.norm(C, axis=-1, keepdims=True) + 1e-12
+    Q = Q / (np.linalg.norm(Q, axis=-1, keepdims=True) + 1e-12)
+
+    rel = np.einsum("qd,qcd->qc", Q, C)          # クエリとの類似
+    sim = np.einsum("qcd,qed->qce", C, C)        # 候補同士の類似
+    div = np.zeros((nq, nc), dtype=np.float32)   # 選択済みとの最大類似
+    available = valid.copy()
+    selected: List[List[int]] = [[] for _ in range(nq)]
+    rows = np.arange(nq)
+    for step in range(min(k, nc)):
+        score = lambda_div * rel - (1 - lambda_div) * div
+        score = np.where(available, score, -np.inf)
+        best = score.argmax(axis=1)
+        ok = available[rows, best]
+        for qi in np.nonzero(ok)[0]:
+            selected[qi].append(int(best[qi]))
+        available[rows[ok], best[ok]] = False
+        picked = sim[rows, best]                  # (nq, nc)
+        div = np.where(ok[:, None], np.maximum(div, picked) if step else picked, div)
+    return selected
+
+def search_batch(
+    client: QdrantClient,
+    emb_model: SentenceTransformer,
+    queries: List[str],
+    top_k: int = 5,
+    source_filter: Optional[str] = None,
+    mmr_lambda: float = 0.7,
+    hybrid_boost: float = 0.15,
+    timeout: int = 30,
+    collection: Optional[str] = None,
+    scope: Optional[List[FieldCondition]] = None,
+) -> List[List[Tuple[float, Dict]]]:
+    """
+    search の複数クエリ版:
+    - クエリは1回の encode でまとめて埋め込む
+    - Qdrant へは search_batch 1回で問い合わせる
+    - MMR は全クエリ分をまとめて計算
+    """
+    from qdrant_client.http.models import SearchRequest
+
+    if not queries:
+        return []
+    qvecs = np.asarray(
+        emb_model.encode(queries, batch_size=EMB.batch_size, normalize_embeddings=EMB.normalize),
+        dtype=np.float32,
+    )
+    collection = collection or QDR.collection
+    flt = _build_filter(source_filter, scope)
+    rough_k = _rough_k(top_k)
+    results = client.search_batch(
+        collection_name=collection,
+        requests=[
+            SearchRequest(vector=v.tolist(), limit=rough_k, filter=flt, with_payload=_payload_selector(), with_vector=True)
+            for v in qvecs
+        ],
+        timeout=timeout,
+    )
+    results = [collapse_by_parent(hits) for hits in results]
+    selected = mmr_select_batch(qvecs, [[h.vector for h in hits] for hits in results], k=top_k, lambda_div=mmr_lambda)
+    return expand_parents(client, collection, [
+        rerank_hits(q, hits, idx, top_k, hybrid_boost) if hits else []
+        for q, hits, idx in zip(queries, results, selected)
+    ])
+
+# =========================================
+# コンテキスト圧縮（質問に近い文だけを残す）
+# =========================================
+# 文の埋め込みは埋め込みモデルごとに持つ（モデル移行で別モデルに切り替わっても混ざらない）
+_sentence_caches: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_sentence_lock = threading.Lock()
+
+def _sentence_cache(emb_model) -> LRUCache:
+    with _sentence_lock:
+        cache = _sentence_caches.get(emb_model)
+        if cache is None:
+            cache = LRUCache(COMP.sentence_entries)
+            _sentence_caches[emb_model] = cache
+        return cache
+
+def _approx_tokens(s: str) -> int:
+    return int(len(s) / 1.8) + 1
+
+def compress_contexts_batch(
+    emb_model: SentenceTransformer,
+    queries: List[str],
+    contexts_list: List[List[Dict]],
+    token_budget: Optional[int] = None,
+    stats: Optional[Dict] = None,
+) -> List[List[Dict]]:
+    """
+    各コンテキストを文に分け、質問とのコサインが高い文から質問ごとに token_budget まで残す。
+    - 質問とキャッシュに無い文は1回の encode でまとめて埋め込み、類似度は質問ごとに1回の行列積で求める
+    - 各コンテキストには最低 min_sentences 文を残し（出典番号を欠番にしない）、文は元の順に並べる
+    - 連続しない文の間は「…」でつなぐ。命中した子の本文（match_text）はそのまま残す
+    """
+    token_budget = token_budget or COMP.token_budget
+    cache = _sentence_cache(emb_model)
+    sents_list = [[split_sentences(str(c.get("text", ""))) for c in ctxs] for ctxs in contexts_list]
+    vecs: Dict[str, np.ndarray] = {}
+    todo: List[str] = []
+    for sent in dict.fromkeys(s for per_q in sents_list for sents in per_q for s in sents):
+        v = cache.get(sent)
+        if v is None:
+            todo.append(sent)
+        else:
+            vecs[sent] = v
+    embs = encode_bucketed(emb_model, list(queries) + todo, normalize_embeddings=True)
+    qvecs = embs[:len(queries)]
+    for sent, v in zip(todo, embs[len(queries):]):
+        vecs[sent] = v
+        cache.put(sent, v)
+
+    out: List[List[Dict]] = []
+    kept = total = chars_in = chars_out = 0
+    for q, ctxs, sents_per_ctx in zip(qvecs, contexts_list, sents_list):
+        flat = [(ci, si) for ci, sents in enumerate(sents_per_ctx) for si in range(len(sents))]
+        if not flat:
+            out.append(ctxs)
+            continue
+        # 正規化済みなので内積がコサイン
+        S = np.stack([vecs[sents_per_ctx[ci][si]] for ci, si in flat])
+        scores = S @ q
+        order = np.argsort(-scores, kind="stable")
+
+        chosen = set()
+        used = 0
+        # 各コンテキストの上位 min_sentences 文を先に確保し、残りの予算を全体のスコア順で埋める
+        per_ctx = [0] * len(ctxs)
+        for j in order:
+            ci, si = flat[j]
+            if per_ctx[ci] < COMP.min_sentences:
+                per_ctx[ci] += 1
+                chosen.add(flat[j])
+                used += _approx_tokens(sents_per_ctx[ci][si])
+        for j in order:
+            if flat[j] in chosen:
+                continue
+            ci, si = flat[j]
+            t = _approx_tokens(sents_per_ctx[ci][si])
+            if used + t > token_budget:
+                continue
+            chosen.add(flat[j])
+            used += t
+
+        compressed = []
+        for ci, c in enumerate(ctxs):
+            sents = sents_per_ctx[ci]
+            idx = sorted(si for cj, si in chosen if cj == ci)
+            if not idx or len(idx) == len(sents):
+                compressed.append(c)
+                continue
+            text = sents[idx[0]]
+            for prev, si in zip(idx, idx[1:]):
+                text += ("" if si == prev + 1 else " … ") + sents[si]
+            compressed.append(dict(c, text=text))
+            chars_in += len(str(c.get("text", "")))
+            chars_out += len(text)
+        kept += len(chosen)
+        total += len(flat)
+        out.append(compressed)
+    print(f"[COMPRESS] kept {kept}/{total} sentences ({len(todo)} embedded), "
+          f"trimmed contexts {chars_in} -> {chars_out} chars")
+    if stats is not None:
+        stats.update(sentences=total, kept_sentences=kept, embedded_sentences=len(todo))
+    return out
+
+def compress_contexts(emb_model: SentenceTransformer, query: str, contexts: List[Dict], **kwargs) -> List[Dict]:
+    return compress_contexts_batch(emb_model, [query], [contexts], **kwargs)[0]
+
 # =========================================
 # プロンプト生成（トークン予算に合わせて圧縮）
 # =========================================
@@ -195,10 +731,21 @@ def summarize_for_context(txt: str, max_chars: int = 800) -> str:
         return s[:max_chars]
     return " ".join(out)
 
+# プロンプトの固定部分（KVキャッシュの接頭辞として再利用するため、可変部分より前に置く）
+SYS_BASE = (
+    "あなたは事実に忠実なアシスタントです。回答は以下のコンテキストに厳密に基づき、"
+    "不明な点は『不明』と答えてください。推測や脚色はしないでください。"
+    "最終行に参照した出典番号（例: [1],[3]）を列挙してください。"
+)
+CTX_HEADER = "# コンテキスト（出典付き）\n"
+INSTRUCTION = "指示: コンテキストの範囲で箇条書きを用いながら簡潔に回答。最後に参照出典番号を列挙。"
+
 def build_prompt(query: str, contexts: List[Dict], tok: AutoTokenizer, ctx_token_budget: int = 2300) -> List[Dict]:
     """
     - LLMのコンテキスト長に合わせてcontextを切り詰め
     - 重要メタ（source/title/page/chunk_id）を明示
+    - 並びは [固定のシステム文・見出し] → [コンテキスト] → [質問] の順
+      （同じコンテキストが続く場合も接頭辞KVキャッシュが効くように、質問を最後に置く）
     """
     # 1チャンクあたりの目安（ざっくり）
     per_ctx_chars = 900
@@ -213,28 +760,20 @@ def build_prompt(query: str, contexts: List[Dict], tok: AutoTokenizer, ctx_token
         blocks.append(block)
 
     # トークン予算を超えないように後方から削る（新しい/上位を優先）
-    sys_base = (
-        "あなたは事実に忠実なアシスタントです。回答は以下のコンテキストに厳密に基づき、"
-        "不明な点は『不明』と答えてください。推測や脚色はしないでください。"
-        "最終行に参照した出典番号（例: [1],[3]）を列挙してください。"
-    )
-    header = (
-        f"# 質問\n{query}\n\n"
-        "# コンテキスト（出典付き）\n"
-    )
+    question = f"# 質問\n{query}\n\n"
 
     # 先に粗結合しトークン数を見ながら調整
-    joined = header + "\n\n".join(blocks) + "\n\n指示: コンテキストの範囲で箇条書きを用いながら簡潔に回答。最後に参照出典番号を列挙。"
+    joined = CTX_HEADER + "\n\n".join(blocks) + "\n\n" + question + INSTRUCTION
     def count_tokens(s: str) -> int:
         return len(tok(s, add_special_tokens=False).input_ids)
 
     # 予算 = ctx_token_budget（回答・システム分の余白は別途残す）
     while count_tokens(joined) > ctx_token_budget and blocks:
         blocks.pop()  # 末尾から間引く
-        joined = header + "\n\n".join(blocks) + "\n\n指示: コンテキストの範囲で箇条書きを用いながら簡潔に回答。最後に参照出典番号を列挙。"
+        joined = CTX_HEADER + "\n\n".join(blocks) + "\n\n" + question + INSTRUCTION
 
     return [
-        {"role": "system", "content": sys_base},
+        {"role": "system", "content": SYS_BASE},
         {"role": "user", "content": joined},
     ]
 
@@ -247,45 +786,336 @@ def load_llm():
         return None, None
     
     # ローカルモデルの場合
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    t0 = time.perf_counter()
+    configure_cpu_threads()
     tok = AutoTokenizer.from_pretrained(LLM.model_path, use_fast=True)
     if tok.pad_token is None:
         tok.pad_token = tok.eos_token
 
-    model = AutoModelForCausalLM.from_pretrained(
-        LLM.model_path,
-        device_map="auto",
-        torch_dtype=get_dtype(),
-    )
+    if LLM.cpu_quant != "none" or pick_device() == "cpu":
+        model = load_llm_cpu()
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            LLM.model_path,
+            device_map="auto",
+            torch_dtype=get_dtype(),
+        )
+    print(f"[LLM] loaded {LLM.model_path} (quant={LLM.cpu_quant}) in {time.perf_counter() - t0:.1f}s, "
+          f"RSS={rss_gb():.2f} GB, threads={torch.get_num_threads()}")
     return tok, model
 
+# =========================================
+# CPU 向け読み込み（スレッド数 / 量子化）
+# =========================================
+def configure_cpu_threads():
+    import torch
+    if LLM.num_threads > 0:
+        torch.set_num_threads(LLM.num_threads)
+    if LLM.interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(LLM.interop_threads)
+        except RuntimeError:
+            # 並列処理が一度でも走った後は変更できない
+            print("[WARN] interop_threads は起動直後にしか設定できません")
+
+def quantize_linear_int8(model):
+    """
+    nn.Linear を1層ずつ int8 動的量子化に置き換える。
+    bf16 で読み込んだモデルを層単位で fp32 → int8 にするので、fp32 全体を一度に持たない。
+    """
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torch.nn.Linear):
+                wrapper = torch.nn.Sequential(child.float())
+                quantize_dynamic(wrapper, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+                setattr(module, name, wrapper[0])
+    # 量子化 Linear の入出力は fp32 なので、残り（埋め込み・正規化層）も fp32 に揃える
+    return model.float()
+
+def load_llm_cpu():
+    """
+    CPU 専用ホスト向け:
+      - safetensors を low_cpu_mem_usage で読み込み（mmap されるので起動が速く、ピークメモリも低い）
+      - cpu_quant="int8": torch 動的量子化（重み int8、7B で約 7〜8GB）
+      - cpu_quant="int4": optimum-quanto による weight-only int4
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    kwargs = {"low_cpu_mem_usage": True}
+    if LLM.cpu_quant == "int8":
+        model = AutoModelForCausalLM.from_pretrained(LLM.model_path, torch_dtype=torch.bfloat16, **kwargs)
+        model = quantize_linear_int8(model)
+    elif LLM.cpu_quant == "int4":
+        try:
+            from transformers import QuantoConfig
+            model = AutoModelForCausalLM.from_pretrained(
+                LLM.model_path,
+                torch_dtype=torch.float32,
+                quantization_config=QuantoConfig(weights="int4"),
+                **kwargs,
+            )
+        except ImportError:
+            raise ImportError("int4 quantization requires optimum-quanto. Run: pip install optimum-quanto")
+    elif LLM.cpu_quant == "none":
+        model = AutoModelForCausalLM.from_pretrained(LLM.model_path, torch_dtype=get_dtype(), **kwargs)
+    else:
+        raise ValueError(f"Unknown cpu_quant: {LLM.cpu_quant}")
+    return model.eval()
+
+# =========================================
+# 接頭辞 KV キャッシュ（固定のシステム文・繰り返し出るコンテキストの prefill を省く）
+# =========================================
+class PrefixKVCache:
+    """
+    プロンプトのトークン列 → past_key_values の小さな LRU。
+    新しい入力と最長共通接頭辞を持つエントリをコピーして crop し、残りのトークンだけ prefill させる。
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[int, ...], object]" = OrderedDict()
+        self.pinned: Optional[Tuple[Tuple[int, ...], object]] = None  # システム文の接頭辞（追い出さない）
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _common(a: Tuple[int, ...], b: List[int]) -> int:
+        n = min(len(a), len(b))
+        i = 0
+        while i < n and a[i] == b[i]:
+            i += 1
+        return i
+
+    def lookup(self, ids: List[int]):
+        """(再利用できるトークン数, crop 済みキャッシュのコピー) を返す"""
+        best_len, best_key, best_cache = 0, None, None
+        with self._lock:
+            candidates = list(self.entries.items())
+            if self.pinned is not None:
+                candidates.append(self.pinned)
+            for key, cache in candidates:
+                n = self._common(key, ids)
+                if n > best_len:
+                    best_len, best_key, best_cache = n, key, cache
+            # 最後の1トークンは必ず forward させる（次トークンのロジットが必要）
+            best_len = min(best_len, len(ids) - 1)
+            if best_cache is None or best_len <= 0:
+                return 0, None
+            if best_key in self.entries:
+                self.entries.move_to_end(best_key)
+        # コピーはロックの外で（保存済みのキャッシュは書き換えないので参照だけ取れば十分。
+        # 大きな KV のコピー中に他の生成を待たせない）
+        cache = copy.deepcopy(best_cache)
+        cache.crop(best_len)
+        return best_len, cache
+
+    def store(self, ids: List[int], cache):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self.entries[tuple(ids)] = cache
+            self.entries.move_to_end(tuple(ids))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+_prefix_caches: Dict[int, PrefixKVCache] = {}
+_prefix_lock = threading.Lock()
+
+def get_prefix_cache(model, tok) -> PrefixKVCache:
+    """モデルごとに1つ。初回にシステム文＋見出しまでの KV を計算して固定しておく"""
+    with _prefix_lock:
+        kv = _prefix_caches.get(id(model))
+        if kv is None:
+            kv = _prefix_caches[id(model)] = _build_prefix_cache(model, tok)
+    return kv
+
+def _build_prefix_cache(model, tok) -> PrefixKVCache:
+    import torch
+    from transformers import DynamicCache
+
+    kv = PrefixKVCache(LLM.prefix_cache_entries)
+    # 質問/コンテキストが違っても必ず一致する部分 = 2つのダミー入力の共通接頭辞。
+    # chat() と同じ経路でトークナイズする（apply_chat_template(tokenize=True) は BOS の付き方が違うことがある）
+    a, b = (
+        encode_chat(tok, [{"role": "system", "content": SYS_BASE}, {"role": "user", "content": CTX_HEADER + x}])["input_ids"]
+        for x in ("A", "B")
+    )
+    prefix = list(a[:PrefixKVCache._common(tuple(a), b)])
+    if prefix:
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            out = model(input_ids=torch.tensor([prefix], device=model.device), use_cache=True)
+        past = out.past_key_values
+        if isinstance(past, tuple):
+            past = DynamicCache.from_legacy_cache(past)
+        kv.pinned = (tuple(prefix), past)
+        print(f"[LLM] prefix KV cache: {len(prefix)} tokens in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    return kv
+
+class _FirstTokenTimer:
+    """generate の streamer として渡し、最初の生成トークンまでの時間（TTFT）を測る"""
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.calls = 0
+        self.ttft_ms: Optional[float] = None
+
+    def put(self, value):
+        self.calls += 1
+        # 1回目はプロンプト、2回目が最初の生成トークン
+        if self.calls == 2:
+            self.ttft_ms = (time.perf_counter() - self.t0) * 1000
+
+    def end(self):
+        pass
+
+# =========================================
+# デコードプロファイル（sample / greedy / assisted）と停止条件
+# =========================================
+# 「[1],[3]」「参照: [2]」のような出典番号だけの行（改行まで出たら回答完了とみなす）
+_CITATION_LINE = re.compile(r"(?:^|\n)[ \t]*(?:[-・*]\s*)?(?:参照|出典)?[:：]?\s*\[\d+\](?:\s*[,、，]?\s*\[\d+\])*[ \t]*\n")
+
+class StopOnCitationLine:
+    """
+    出典番号の行、または stop_sequences のいずれかが生成されたら止める。
+    generate は StoppingCriteria と同じ呼び出し規約で呼ぶだけなので、transformers を import せずに定義している。
+    """
+
+    def __init__(self, tok, prompt_len: int, stop_sequences=(), on_citation: bool = True, window: int = 48):
+        self.tok = tok
+        self.prompt_len = prompt_len
+        self.stop_sequences = [s for s in stop_sequences if s]
+        self.on_citation = on_citation
+        self.window = window
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+        done = []
+        for row in input_ids:
+            gen = row[self.prompt_len:]
+            tail = self.tok.decode(gen[-self.window:], skip_special_tokens=True)
+            hit = any(s in tail for s in self.stop_sequences)
+            if not hit and self.on_citation and "]" in tail:
+                line = tail
+                if len(gen) > self.window:
+                    # 窓の先頭は行頭とは限らないので、窓内の最初の改行より後だけを見る
+                    nl = tail.find("\n")
+                    line = tail[nl:] if nl >= 0 else ""
+                hit = bool(_CITATION_LINE.search(line))
+            done.append(hit)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+_draft_model = None
+
+def load_draft_model():
+    """assisted デコード用の小さいドラフトモデル（本番モデルとトークナイザが同系列であること）"""
+    global _draft_model
+    if _draft_model is None:
+        from transformers import AutoModelForCausalLM
+        _draft_model = AutoModelForCausalLM.from_pretrained(
+            LLM.draft_model_path,
+            device_map="auto",
+            torch_dtype=get_dtype(),
+        )
+    return _draft_model
+
+def generation_kwargs(tok, prompt_len: int, profile: Optional[str] = None, batch: bool = False) -> Dict:
+    """LLMCfg.decoding に応じた generate の引数"""
+    profile = profile or LLM.decoding
+    kwargs: Dict = {
+        "max_new_tokens": LLM.max_new_tokens,
+        "pad_token_id": tok.pad_token_id if batch else tok.eos_token_id,
+        "eos_token_id": tok.eos_token_id,
+    }
+    if LLM.stop_at_citation or LLM.stop_sequences:
+        from transformers import StoppingCriteriaList
+        kwargs["stopping_criteria"] = StoppingCriteriaList([
+            StopOnCitationLine(tok, prompt_len, LLM.stop_sequences, on_citation=LLM.stop_at_citation)
+        ])
+    if profile == "sample":
+        kwargs.update(do_sample=True, temperature=LLM.temperature, top_p=LLM.top_p)
+    elif profile in ("greedy", "assisted"):
+        # 決定的: 同じ入力には同じ回答（assisted も greedy と同じ出力になる）
+        kwargs.update(do_sample=False, temperature=None, top_p=None)
+        # assisted はバッチ1のみ対応なので、バッチ生成では greedy にする
+        if profile == "assisted" and not batch:
+            kwargs["assistant_model"] = load_draft_model()
+    else:
+        raise ValueError(f"Unknown decoding profile: {profile}")
+    return kwargs
+
 # =========================================
 # チャット生成
 # =========================================
-def chat(model, tok, messages: List[Dict]) -> str:
+def encode_chat(tok, messages: List[Dict], **kwargs):
+    """チャットテンプレートを文字列にしてからトークナイズする（chat と接頭辞キャッシュで同じ id 列にするため）"""
+    text = tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tok(text, **kwargs)
+
+def chat(
+    model,
+    tok,
+    messages: List[Dict],
+    use_prefix_cache: Optional[bool] = None,
+    stats: Optional[Dict] = None,
+    profile: Optional[str] = None,
+) -> str:
     if LLM.model_type == "openai":
         return chat_openai(messages)
     
     # ローカルモデルの場合
-    text = tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tok(text, return_tensors="pt")
+    import torch
+    from transformers import DynamicCache
+
+    inputs = encode_chat(tok, messages, return_tensors="pt")
     # MPSは half 未対応ケースがあるため to() は安全に
     device = model.device
     for k, v in inputs.items():
         inputs[k] = v.to(device)
 
+    ids = inputs["input_ids"][0].tolist()
+    gen_kwargs = generation_kwargs(tok, len(ids), profile)
+    use_prefix_cache = LLM.prefix_cache if use_prefix_cache is None else use_prefix_cache
+    kv, reused, past = None, 0, None
+    # assisted デコードはドラフトモデル側とキャッシュ長を揃えるため接頭辞キャッシュを使わない
+    if use_prefix_cache and "assistant_model" not in gen_kwargs:
+        kv = get_prefix_cache(model, tok)
+        reused, past = kv.lookup(ids)
+
+    timer = _FirstTokenTimer()
     with torch.no_grad():
         out = model.generate(
             **inputs,
-            max_new_tokens=LLM.max_new_tokens,
-            do_sample=True,
-            temperature=LLM.temperature,
-            top_p=LLM.top_p,
-            pad_token_id=tok.eos_token_id,
-            eos_token_id=tok.eos_token_id,
+            past_key_values=past if past is not None else (DynamicCache() if kv is not None else None),
+            streamer=timer,
+            return_dict_in_generate=True,
+            **gen_kwargs,
         )
+    total_ms = (time.perf_counter() - timer.t0) * 1000
+    n_new = out.sequences.shape[1] - len(ids)
+    tps = n_new / (total_ms / 1000) if total_ms > 0 else 0.0
+    print(f"[LLM] decoding={profile or LLM.decoding} prompt={len(ids)} tokens (cached {reused}), "
+          f"TTFT={timer.ttft_ms or 0:.0f} ms, {n_new} tokens in {total_ms:.0f} ms ({tps:.1f} tokens/s)")
+    if stats is not None:
+        stats.update({"prompt_tokens": len(ids), "cached_tokens": reused, "ttft_ms": timer.ttft_ms,
+                      "total_ms": total_ms, "new_tokens": n_new, "tokens_per_s": tps})
+
+    # プロンプト部分の KV を保存（同じコンテキストが続く質問で再利用）
+    if kv is not None and out.past_key_values is not None:
+        cache = out.past_key_values
+        if isinstance(cache, tuple):
+            cache = DynamicCache.from_legacy_cache(cache)
+        cache.crop(len(ids))
+        kv.store(ids, cache)
     
     # 生成されたトークンのみを取得（入力プロンプトを除外）
-    generated_tokens = out[0][inputs['input_ids'].shape[1]:]
+    generated_tokens = out.sequences[0][len(ids):]
     answer = tok.decode(generated_tokens, skip_special_tokens=True)
     
     # assistantの回答部分のみを抽出（念のため）
@@ -297,6 +1127,75 @@ def chat(model, tok, messages: List[Dict]) -> str:
     
     return answer.strip()
 
+def chat_batch(model, tok, messages_list: List[List[Dict]]) -> List[str]:
+    """複数プロンプトを左パディングした1バッチで生成する"""
+    if not messages_list:
+        return []
+    if LLM.model_type == "openai":
+        return [chat_openai(m) for m in messages_list]
+    import torch
+
+    texts = [tok.apply_chat_template(m, tokenize=False, add_generation_prompt=True) for m in messages_list]
+    # デコーダのみのモデルは左パディングでないと生成位置がずれる
+    padding_side = tok.padding_side
+    tok.padding_side = "left"
+    try:
+        inputs = tok(texts, return_tensors="pt", padding=True)
+    finally:
+        tok.padding_side = padding_side
+    device = model.device
+    for k, v in inputs.items():
+        inputs[k] = v.to(device)
+
+    with torch.no_grad():
+        out = model.generate(
+            **inputs,
+            **generation_kwargs(tok, inputs["input_ids"].shape[1], batch=True),
+        )
+
+    prompt_len = inputs["input_ids"].shape[1]
+    return [tok.decode(row[prompt_len:], skip_special_tokens=True).strip() for row in out]
+
+# =========================================
+# 複数質問の一括処理（Python API）
+# =========================================
+def answer_batch(
+    client: QdrantClient,
+    emb_model: SentenceTransformer,
+    model,
+    tok,
+    questions: List[str],
+    top_k: int = 5,
+    source_filter: Optional[str] = None,
+    batch_size: int = 8,
+    collection: Optional[str] = None,
+    scope: Optional[List[FieldCondition]] = None,
+):
+    """
+    questions を batch_size ずつ search_batch → build_prompt → chat_batch で処理し、
+    1問ごとに {"index", "question", "answer", "contexts"} を入力順に yield する。
+    """
+    for start in range(0, len(questions), batch_size):
+        qs = questions[start:start + batch_size]
+        hits_list = search_batch(
+            client, emb_model, qs,
+            top_k=top_k, source_filter=source_filter,
+            collection=collection, scope=scope,
+        )
+        contexts_list = [[p for _, p in hits] for hits in hits_list]
+        if COMP.enabled:
+            contexts_list = compress_contexts_batch(emb_model, qs, contexts_list)
+        todo = [i for i, ctxs in enumerate(contexts_list) if ctxs]
+        answers = chat_batch(model, tok, [build_prompt(qs[i], contexts_list[i], tok) for i in todo])
+        answer_of = dict(zip(todo, answers))
+        for i, q in enumerate(qs):
+            yield {
+                "index": start + i,
+                "question": q,
+                "answer": answer_of.get(i),
+                "contexts": contexts_list[i],
+            }
+
 # =========================================
 # OpenAI API チャット生成
 # =========================================
@@ -340,11 +1239,17 @@ def main():
             print("空の質問です。終了します。")
             return
 
-        emb = load_embedder()
+        from qdrant_client import QdrantClient
+
         client = QdrantClient(host=QDR.host, port=QDR.port)
+        # コレクションが別の埋め込みモデル（移行で切り替え済み）のものなら検索しない
+        check_collection_models(client, names=[QDR.collection])
+        emb = load_embedder()
 
         hits = search(client, emb, query_text, top_k=5)
         contexts = [p for _, p in hits]
+        if COMP.enabled:
+            contexts = compress_contexts(emb, query_text, contexts)
 
         tok, model = load_llm()
         msgs = build_prompt(query_text, contexts, tok, ctx_token_budget=2300)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+インデックスのスナップショット（新しいノードを再インジェストなしで立ち上げる）
+
+  python snapshot.py export --out snapshots/rag_docs             # コレクションを書き出す
+  python snapshot.py import --src snapshots/rag_docs             # 別ノードの Qdrant に読み込む
+
+スナップショットはディレクトリ:
+  manifest.json          埋め込みモデル（名前と、コレクションの実体名から取った model_slug）・次元・正規化・チャンク設定・件数
+  vectors.npy            ベクトル (N, dim)。既定は float16（--float32 で無変換）
+  payloads.jsonl.gz      {"id": ..., "payload": {...}} を vectors.npy と同じ順に1行ずつ
+  parents.jsonl.gz       親チャンク（{collection}__parents）があればその内容
+
+読み込み時は manifest の埋め込みモデル・次元・正規化が現在の設定と違えば中止する
+（別モデルのベクトルを混ぜると検索が壊れるため）。
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from config import ChunkCfg, DedupCfg, EmbeddingCfg, QdrantCfg
+
+EMB = EmbeddingCfg()
+QDR = QdrantCfg()
+CH = ChunkCfg()
+DD = DedupCfg()
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+VECTORS = "vectors.npy"
+PAYLOADS = "payloads.jsonl.gz"
+PARENTS = "parents.jsonl.gz"
+
+class SnapshotError(Exception):
+    pass
+
+def _client():
+    from qdrant_client import QdrantClient
+    return QdrantClient(host=QDR.host, port=QDR.port, timeout=120)
+
+def _iter_points(client, collection: str, batch: int, with_vectors: bool) -> Iterator[List]:
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection,
+            limit=batch,
+            offset=offset,
+            with_payload=True,
+            with_vectors=with_vectors,
+        )
+        if points:
+            yield points
+        if offset is None:
+            return
+
+def _collection_dim(client, collection: str) -> int:
+    from ingest import resolve_collection
+
+    vectors = client.get_collection(resolve_collection(client, collection)).config.params.vectors
+    return int(vectors.size)
+
+# =========================================
+# 書き出し
+# =========================================
+def export_snapshot(collection: str, out_dir: str, float16: bool = True, batch: int = 1024) -> Dict:
+    from ingest import collection_model, collection_names, model_slug, parent_collection
+
+    client = _client()
+    existing = collection_names(client)
+    if collection not in existing:
+        raise SnapshotError(f"コレクション '{collection}' がありません")
+    # モデルは設定ではなくエイリアスの指す実体の名前から取る（移行で切り替えた後は設定と違うことがある）
+    model = collection_model(client, collection) or model_slug(EMB.model_name)
+    if model != model_slug(EMB.model_name):
+        raise SnapshotError(
+            f"コレクション '{collection}' は埋め込みモデル '{model}' のものですが、設定は {EMB.model_name} です"
+            f"（config.py の EmbeddingCfg.model_name を更新してください）"
+        )
+    os.makedirs(out_dir, exist_ok=True)
+    dim = _collection_dim(client, collection)
+    total = client.count(collection_name=collection, exact=True).count
+    dtype = np.float16 if float16 else np.float32
+
+    t0 = time.perf_counter()
+    vecs = np.lib.format.open_memmap(os.path.join(out_dir, VECTORS), mode="w+", dtype=dtype, shape=(total, dim))
+    n = 0
+    with gzip.open(os.path.join(out_dir, PAYLOADS), "wt", encoding="utf-8") as f:
+        for points in _iter_points(client, collection, batch, with_vectors=True):
+            # 書き出し中に増えた分は含めない（件数は manifest の count が正）
+            points = points[:total - n]
+            if not points:
+                break
+            vecs[n:n + len(points)] = np.asarray([p.vector for p in points], dtype=np.float32)
+            for p in points:
+                f.write(json.dumps({"id": p.id, "payload": p.payload}, ensure_ascii=False) + "\n")
+            n += len(points)
+            print(f"[SNAPSHOT] exported {n}/{total}")
+    vecs.flush()
+    del vecs
+
+    parents = 0
+    if parent_collection(collection) in existing:
+        with gzip.open(os.path.join(out_dir, PARENTS), "wt", encoding="utf-8") as f:
+            for points in _iter_points(client, parent_collection(collection), batch, with_vectors=False):
+                for p in points:
+                    f.write(json.dumps({"id": p.id, "payload": p.payload}, ensure_ascii=False) + "\n")
+                parents += len(points)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "collection": collection,
+        "count": n,
+        "parents": parents,
+        "dim": dim,
+        "dtype": np.dtype(dtype).name,
+        "embedding": {
+            "model_name": EMB.model_name,
+            "model_slug": model,
+            "normalize": EMB.normalize,
+            "backend": EMB.backend,
+            "onnx_quantize": EMB.onnx_quantize,
+        },
+        "chunk": asdict(CH),
+        "dedup": asdict(DD),
+    }
+    with open(os.path.join(out_dir, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"[SNAPSHOT] {collection}: {n} points, {parents} parents -> {out_dir} "
+          f"({time.perf_counter() - t0:.1f}s)")
+    return manifest
+
+# =========================================
+# 読み込み
+# =========================================
+def read_manifest(src_dir: str) -> Dict:
+    path = os.path.join(src_dir, MANIFEST)
+    if not os.path.exists(path):
+        raise SnapshotError(f"{path} がありません")
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(f"未対応のスナップショット形式です: {manifest.get('format_version')}")
+    return manifest
+
+def check_compatible(manifest: Dict, client=None, collection: Optional[str] = None):
+    """埋め込みモデル・正規化・次元・MinHash/LSH の形が現在の設定（と既存コレクション）と一致しなければ SnapshotError"""
+    from ingest import collection_model, collection_names, model_slug
+
+    emb = manifest["embedding"]
+    # model_slug はエクスポートしたコレクションの実体名から取ったもの（古い manifest は model_name から）
+    model = emb.get("model_slug") or model_slug(emb["model_name"])
+    if model != model_slug(EMB.model_name):
+        raise SnapshotError(
+            f"埋め込みモデルが一致しません: snapshot={emb['model_name']} ({model}) config={EMB.model_name}"
+        )
+    if emb["normalize"] != EMB.normalize:
+        raise SnapshotError(f"normalize が一致しません: snapshot={emb['normalize']} config={EMB.normalize}")
+    if emb.get("backend") != EMB.backend or emb.get("onnx_quantize") != EMB.onnx_quantize:
+        # torch と ONNX(int8) のベクトルはほぼ一致するので警告のみ
+        print(f"[WARN] 埋め込みバックエンドが異なります: snapshot={emb.get('backend')} config={EMB.backend}")
+    if manifest["chunk"] != asdict(CH):
+        print("[WARN] チャンク設定が異なります（以後のインジェストと分割単位が揃いません）")
+    dedup = manifest.get("dedup")
+    if dedup is not None:
+        # 保存済みの minhash / lsh はこの3つが同じでないと、以後のインジェストの重複検出で一致しない
+        diff = [k for k in ("num_perm", "bands", "shingle") if dedup.get(k) != getattr(DD, k)]
+        if diff:
+            raise SnapshotError(
+                "重複除去の設定が一致しません: "
+                + ", ".join(f"{k}: snapshot={dedup.get(k)} config={getattr(DD, k)}" for k in diff)
+            )
+        if dedup != asdict(DD):
+            print("[WARN] 重複除去の設定が異なります（threshold などは以後のインジェストの判定だけに影響します）")
+    if client is not None and collection is not None and collection in collection_names(client):
+        existing = collection_model(client, collection)
+        if existing is not None and existing != model:
+            raise SnapshotError(
+                f"既存コレクション '{collection}' は埋め込みモデル '{existing}' のものです（snapshot: '{model}'）"
+            )
+        if _collection_dim(client, collection) != manifest["dim"]:
+            raise SnapshotError(
+                f"既存コレクション '{collection}' の次元 {_collection_dim(client, collection)} と "
+                f"スナップショットの次元 {manifest['dim']} が一致しません"
+            )
+
+def _iter_jsonl(path: str) -> Iterator[Dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def _parallel_upsert(client, collection: str, batches: Iterator[List], workers: int) -> int:
+    """バッチを並列に upsert する（未完了のバッチは workers * 2 までに抑えてメモリを一定に保つ）"""
+    total = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for points in batches:
+            pending.append(pool.submit(client.upsert, collection_name=collection, points=points, wait=True))
+            total += len(points)
+            if len(pending) >= workers * 2:
+                pending.pop(0).result()
+        for fut in pending:
+            fut.result()
+    return total
+
+def import_snapshot(src_dir: str, collection: Optional[str] = None, batch: int = 512, workers: int = 4) -> int:
+    from qdrant_client.http.models import PointStruct
+
+    import chunk_cache
+    from ingest import collection_names, ensure_collection, parent_collection
+
+    manifest = read_manifest(src_dir)
+    collection = collection or manifest["collection"]
+    client = _client()
+    check_compatible(manifest, client, collection)
+    ensure_collection(client, manifest["dim"], collection)
+
+    t0 = time.perf_counter()
+    vecs = np.load(os.path.join(src_dir, VECTORS), mmap_mode="r")
+    count = manifest["count"]
+
+    def point_batches() -> Iterator[List]:
+        buf, start = [], 0
+        for i, rec in enumerate(_iter_jsonl(os.path.join(src_dir, PAYLOADS))):
+            if i >= count:
+                break
+            buf.append(rec)
+            if len(buf) >= batch:
+                yield _points(buf, start)
+                start += len(buf)
+                buf = []
+                print(f"[SNAPSHOT] imported {start}/{count}")
+        if buf:
+            yield _points(buf, start)
+
+    def _points(recs: List[Dict], start: int) -> List:
+        block = np.asarray(vecs[start:start + len(recs)], dtype=np.float32)
+        return [PointStruct(id=r["id"], vector=v.tolist(), payload=r["payload"]) for r, v in zip(recs, block)]
+
+    n = _parallel_upsert(client, collection, point_batches(), workers)
+
+    parents_path = os.path.join(src_dir, PARENTS)
+    if os.path.exists(parents_path):
+        def parent_batches() -> Iterator[List]:
+            buf = []
+            for rec in _iter_jsonl(parents_path):
+                buf.append(PointStruct(id=rec["id"], vector={}, payload=rec["payload"]))
+                if len(buf) >= batch:
+                    yield buf
+                    buf = []
+            if buf:
+                yield buf
+        if parent_collection(collection) not in collection_names(client):
+            client.create_collection(collection_name=parent_collection(collection), vectors_config={})
+        _parallel_upsert(client, parent_collection(collection), parent_batches(), workers)
+
+    # 同じ id のポイントを上書きした可能性があるので
+    chunk_cache.invalidate_collection(collection)
+    print(f"[SNAPSHOT] {src_dir} -> {collection}: {n} points ({time.perf_counter() - t0:.1f}s)")
+    return n
+
+def main():
+    ap = argparse.ArgumentParser(description="LocalLLMRAG index snapshots")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("export", help="コレクションをスナップショットに書き出す")
+    p.add_argument("--collection", default=QDR.collection)
+    p.add_argument("--out", required=True)
+    p.add_argument("--float32", action="store_true", help="ベクトルを float16 に変換しない")
+    p.add_argument("--batch", type=int, default=1024)
+
+    p = sub.add_parser("import", help="スナップショットをコレクションに読み込む")
+    p.add_argument("--src", required=True)
+    p.add_argument("--collection", default=None, help="省略時はスナップショット元のコレクション名")
+    p.add_argument("--batch", type=int, default=512)
+    p.add_argument("--workers", type=int, default=4)
+
+    args = ap.parse_args()
+    try:
+        if args.cmd == "export":
+            export_snapshot(args.collection, args.out, float16=not args.float32, batch=args.batch)
+        else:
+            import_snapshot(args.src, args.collection, batch=args.batch, workers=args.workers)
+    except SnapshotError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+マルチテナントのルーティング
+
+- テナントはリクエストごとに選択（ヘッダー TenantCfg.header / JSON・フォームの "tenant"）
+- TenantCfg.mode:
+    "collection": テナントごとにコレクションを分ける（既定テナントは QdrantCfg.collection をそのまま使う）
+    "payload"   : 共有コレクション + インデックス付き "tenant" キーで分割（テナント数が多い場合向け）
+- Qdrant クライアントは全テナントで1つを共有する
+- テナントごとに同時実行数の上限・チャンク数クォータ・検索/回答キャッシュを持つ
+"""
+from __future__ import annotations
+
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from config import QdrantCfg, TenantCfg
+from ingest import MODEL_MARK, PARENT_SUFFIX, collection_names
+
+QDR = QdrantCfg()
+TNT = TenantCfg()
+
+if TYPE_CHECKING:
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import FieldCondition, Filter
+
+_TENANT_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class TenantError(Exception):
+    """テナント関連のエラー（HTTP ステータス付き）"""
+    status = 400
+
+class TenantBusy(TenantError):
+    status = 429
+
+class QuotaExceeded(TenantError):
+    status = 413
+
+# =========================================
+# LRU キャッシュ（スレッドセーフ）
+# =========================================
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# =========================================
+# テナント状態
+# =========================================
+class TenantState:
+    def __init__(self, name: str):
+        self.name = name
+        if TNT.mode == "payload":
+            from qdrant_client.http.models import FieldCondition, MatchValue
+            self.collection = QDR.collection
+            self.scope = [FieldCondition(key="tenant", match=MatchValue(value=name))]
+        else:
+            self.collection = QDR.collection if name == TNT.default_tenant else f"{QDR.collection}__{name}"
+            self.scope = []
+        self.query_cache = LRUCache(TNT.query_cache_size)
+        self.answer_cache = LRUCache(TNT.answer_cache_size)
+        # max_concurrent が 0 なら同時実行数を制限しない
+        self._slots = threading.BoundedSemaphore(TNT.max_concurrent) if TNT.max_concurrent > 0 else None
+        self.active = 0   # slot() で枠を待っている・使っているリクエスト数（0 でなければ追い出さない）
+
+    def filter(self, extra: Optional[List[FieldCondition]] = None) -> Optional[Filter]:
+        from qdrant_client.http.models import Filter
+
+        must = self.scope + (extra or [])
+        return Filter(must=must) if must else None
+
+    def tag(self, chunks: List[Dict]) -> List[Dict]:
+        """payload モードではチャンクに tenant キーを付ける"""
+        if self.scope:
+            for ch in chunks:
+                ch["tenant"] = self.name
+        return chunks
+
+    def invalidate(self):
+        """文書の追加/削除時に呼ぶ（古い検索結果・回答を返さないため）"""
+        self.query_cache.clear()
+        self.answer_cache.clear()
+
+# =========================================
+# ルーター
+# =========================================
+class TenantRouter:
+    def __init__(self):
+        self._client: Optional[QdrantClient] = None
+        self._tenants: "OrderedDict[str, TenantState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexed = set()
+
+    def client(self) -> QdrantClient:
+        """全テナント共有のクライアント"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from qdrant_client import QdrantClient
+                    self._client = QdrantClient(host=QDR.host, port=QDR.port)
+        return self._client
+
+    def get(self, tenant: Optional[str]) -> TenantState:
+        name = (tenant or TNT.default_tenant).strip()
+        if not _TENANT_ID.match(name):
+            raise TenantError(f"不正なテナントIDです: {name!r}")
+        # "{collection}__{tenant}" が親チャンク・モデルごとの実体のコレクション名と衝突しないように
+        if f"__{name}".endswith(PARENT_SUFFIX) or MODEL_MARK in f"__{name}":
+            raise TenantError(f"予約済みのテナントIDです: {name!r}")
+        with self._lock:
+            state = self._tenants.get(name)
+            if state is None:
+                state = TenantState(name)
+                self._tenants[name] = state
+            self._tenants.move_to_end(name)
+            # 使われていないテナントの状態（キャッシュ）から捨てる
+            if len(self._tenants) > TNT.max_tenants:
+                for key in list(self._tenants):
+                    if len(self._tenants) <= TNT.max_tenants:
+                        break
+                    if key != name and self._tenants[key].active == 0:
+                        del self._tenants[key]
+            return state
+
+    def from_request(self, request) -> TenantState:
+        tenant = request.headers.get(TNT.header)
+        if not tenant:
+            data = request.get_json(silent=True) or {}
+            tenant = data.get("tenant") or request.args.get("tenant")
+        return self.get(tenant)
+
+    @contextmanager
+    def slot(self, state: TenantState):
+        """テナントごとの同時実行数を制限する（上限超過は TenantBusy）"""
+        with self._lock:
+            # get() の後に状態が追い出されていたら、登録済みの状態（無ければ state を戻す）の枠を使う。
+            # 別の状態のセマフォで数えると、そのテナントの上限を超えてしまう
+            current = self._tenants.setdefault(state.name, state)
+            # 枠を待っている間・使っている間は追い出さない（get() の追い出しは active == 0 のものだけ）
+            current.active += 1
+        try:
+            if current._slots is not None and not current._slots.acquire(timeout=TNT.acquire_timeout):
+                raise TenantBusy(f"テナント '{state.name}' の同時リクエスト数が上限（{TNT.max_concurrent}）です")
+            try:
+                yield state
+            finally:
+                if current._slots is not None:
+                    current._slots.release()
+        finally:
+            with self._lock:
+                current.active -= 1
+
+    def ensure_tenant_index(self, state: TenantState):
+        """payload モードでは tenant キーにインデックスを張る（1コレクション1回）"""
+        if not state.scope or state.collection in self._indexed:
+            return
+        from qdrant_client.http.models import PayloadSchemaType
+
+        self.client().create_payload_index(
+            collection_name=state.collection,
+            field_name="tenant",
+            field_schema=PayloadSchemaType.KEYWORD,
+        )
+        self._indexed.add(state.collection)
+
+    def invalidate_all(self):
+        """埋め込みモデルの切り替え後など、全テナントの検索結果・回答を捨てる"""
+        with self._lock:
+            states = list(self._tenants.values())
+        for state in states:
+            state.invalidate()
+
+    def count(self, state: TenantState) -> int:
+        client = self.client()
+        if state.collection not in collection_names(client):
+            return 0
+        return client.count(collection_name=state.collection, count_filter=state.filter(), exact=True).count
+
+    def check_quota(self, state: TenantState, adding: int):
+        if TNT.max_chunks <= 0 or adding <= 0:
+            return
+        current = self.count(state)
+        if current + adding > TNT.max_chunks:
+            raise QuotaExceeded(
+                f"テナント '{state.name}' のチャンク数上限（{TNT.max_chunks}）を超えます"
+                f"（現在 {current} + 追加 {adding}）"
+            )
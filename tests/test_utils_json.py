@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import utils_json
+from utils_json import iter_json_records
+
+
+def _faqs(n):
+    return [{"question": f"質問 {i}", "answer": "回答 " + "x" * 200} for i in range(n)]
+
+
+def test_streams_pretty_printed_object_with_other_members():
+    faqs = _faqs(8000)
+    doc = {"version": "1.0", "meta": {"lang": "ja"}, "faqs": faqs, "count": len(faqs)}
+    text = json.dumps(doc, ensure_ascii=False, indent=2)
+    assert len(text) > utils_json.INLINE_OBJECT_CHARS
+    assert list(iter_json_records(io.StringIO(text), read_size=4096)) == faqs
+
+
+def test_streams_object_without_record_list():
+    doc = {"title": "t", "body": "y" * (utils_json.INLINE_OBJECT_CHARS + 10)}
+    text = json.dumps(doc, indent=2)
+    assert list(iter_json_records(io.StringIO(text))) == [doc]
+
+
+def test_small_object_is_read_inline():
+    faqs = _faqs(3)
+    text = json.dumps({"version": "1.0", "faqs": faqs, "count": 3}, indent=2)
+    assert list(iter_json_records(io.StringIO(text))) == faqs
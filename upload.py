@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+multipart/form-data のストリーミング受信
+
+Werkzeug の request.files は本文をすべてバッファしてから返すため、/embedd では
+request.stream を MultipartDecoder で直接読み、ファイルパートが届き終わった時点で
+1件ずつ返す（呼び出し側は次のパートの受信中にチャンク化を始められる）。
+  - テキスト/JSON: メモリ上の BytesIO
+  - PDF          : SpooledTemporaryFile（UploadCfg.spool_threshold を超えたらディスクへ）
+"""
+import io
+import tempfile
+from typing import IO, Iterator, Sequence, Tuple
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from config import UploadCfg
+
+UPLOAD = UploadCfg()
+
+class UploadError(Exception):
+    status = 400
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+def new_buffer(filename: str) -> IO[bytes]:
+    if filename.lower().endswith(".pdf"):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD.spool_threshold)
+    return io.BytesIO()
+
+def iter_uploaded_files(
+    stream: IO[bytes],
+    boundary: bytes,
+    field_names: Sequence[str] = ("files", "file"),
+) -> Iterator[Tuple[str, str, IO[bytes]]]:
+    """
+    ファイルパートを受信し終えた順に (field_name, filename, buffer) を返す。
+    buffer は先頭にシーク済みで、閉じるのは呼び出し側。
+    サイズ上限を超えた時点で UploadTooLarge を送出し、残りは読まない。
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=UPLOAD.max_field_bytes)
+    current = None  # [field_name, filename, buffer, size]
+    received = 0
+    try:
+        while True:
+            data = stream.read(UPLOAD.read_size)
+            received += len(data)
+            if received > UPLOAD.max_request_bytes:
+                raise UploadTooLarge(f"リクエストが上限（{UPLOAD.max_request_bytes} bytes）を超えています")
+            decoder.receive_data(data or None)
+
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, File):
+                    current = None
+                    if event.name in field_names:
+                        current = [event.name, event.filename or "", new_buffer(event.filename or ""), 0]
+                elif isinstance(event, Field):
+                    # 通常のフォーム値は使わないので読み捨てる
+                    current = None
+                elif isinstance(event, Data) and current is not None:
+                    current[3] += len(event.data)
+                    if current[3] > UPLOAD.max_file_bytes:
+                        raise UploadTooLarge(
+                            f"ファイル '{current[1]}' が上限（{UPLOAD.max_file_bytes} bytes）を超えています"
+                        )
+                    current[2].write(event.data)
+                    if not event.more_data:
+                        name, filename, buf, _ = current
+                        current = None
+                        buf.seek(0)
+                        yield name, filename, buf
+                event = decoder.next_event()
+
+            if not data or isinstance(event, Epilogue):
+                return
+    except ValueError as e:
+        # 途中で切れた本文など
+        raise UploadError(f"multipart の解析に失敗しました: {e}")
+    finally:
+        if current is not None:
+            current[2].close()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import re
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 _SENT_SPLIT = re.compile(r"(?<=[。．！？\?\!])\s*|\n{2,}", re.MULTILINE)
 
@@ -42,4 +42,65 @@ def greedy_chunk_by_tokens(
         chunk = "".join(cur).strip()
         if len(chunk) >= min_chars:
             chunks.append(chunk)
-    return chunks
\ No newline at end of file
+    return chunks
+
+def greedy_chunk_pages(
+    pages: Iterable[Tuple[int, str]],
+    tokenizer_like_len=lambda s: int(len(s) / 1.8),
+    target_tokens: int = 400,
+    overlap_tokens: int = 60,
+    min_chars: int = 150,
+) -> Iterator[Dict]:
+    """
+    ページ単位のストリーム (page_no, text) からチャンクを逐次生成する。
+    - 各チャンクに page_start / page_end を付ける
+    - ページ境界で、バッファが target の半分以上たまっていれば区切る
+      （チャンク境界がページに揃うので、変更のないページのチャンクは再インジェスト時も同じ内容になる）
+    - 保持するのは現在のバッファだけなので、ページ数が多くてもメモリは増えない
+    """
+    cur: List[Tuple[int, str]] = []
+    cur_toks = 0
+
+    def emit(buf):
+        chunk = "".join(s for _, s in buf).strip()
+        if len(chunk) >= min_chars:
+            return {"text": chunk, "page_start": buf[0][0], "page_end": buf[-1][0]}
+        return None
+
+    def carry(buf):
+        overlapped, otoks = [], 0
+        for p, s in reversed(buf):
+            t = tokenizer_like_len(s)
+            if otoks + t > overlap_tokens:
+                break
+            overlapped.insert(0, (p, s))
+            otoks += t
+        return overlapped
+
+    fresh = 0  # 直近の出力以降に追加した文の数（オーバーラップ分は含まない）
+    for page_no, text in pages:
+        for sent in split_sentences(text or ""):
+            stoks = tokenizer_like_len(sent)
+            if cur_toks + stoks > target_tokens and cur:
+                out = emit(cur)
+                if out:
+                    yield out
+                cur = carry(cur) + [(page_no, sent)]
+                cur_toks = sum(tokenizer_like_len(s) for _, s in cur)
+                fresh = 1
+            else:
+                cur.append((page_no, sent))
+                cur_toks += stoks
+                fresh += 1
+        # ページ境界での区切り
+        if fresh and cur_toks >= target_tokens // 2:
+            out = emit(cur)
+            if out:
+                yield out
+                cur = carry(cur)
+                cur_toks = sum(tokenizer_like_len(s) for _, s in cur)
+                fresh = 0
+    if cur and fresh:
+        out = emit(cur)
+        if out:
+            yield out
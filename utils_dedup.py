@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+MinHash / LSH による近似重複チャンクの検出
+
+- 署名: 正規化した本文の文字 n-gram（shingle）集合の MinHash（num_perm 個の uint32）
+- LSH : 署名を bands 個の帯に分け、帯ごとのハッシュ（"band:hex"）が1つでも一致すれば候補
+- 候補は署名の一致率（推定 Jaccard 係数）が threshold 以上なら重複とみなす
+
+帯のキーと署名は payload（lsh / minhash）に保存し、lsh にはキーワードインデックスを張るので、
+LSH インデックスはコレクションと一緒に永続化され、削除されたポイントは自動的に候補から外れる。
+"""
+import hashlib
+import re
+import unicodedata
+import zlib
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+_MERSENNE = (1 << 61) - 1
+_WS = re.compile(r"\s+")
+
+def normalize(text: str) -> str:
+    """全角/半角・大文字小文字・空白の違いを無視する"""
+    return _WS.sub("", unicodedata.normalize("NFKC", text)).lower()
+
+def shingles(text: str, k: int = 5) -> List[int]:
+    s = normalize(text)
+    if len(s) <= k:
+        return [zlib.crc32(s.encode("utf-8"))]
+    return list({zlib.crc32(s[i:i + k].encode("utf-8")) for i in range(len(s) - k + 1)})
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, bands: int = 16, shingle: int = 5, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+        rng = np.random.RandomState(seed)
+        # h(x) = (a*x + b) mod p。x, a < 2^32 なので a*x は uint64 に収まる
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        x = np.asarray(shingles(text, self.shingle), dtype=np.uint64)[:, None]
+        h = (self.a * x % _MERSENNE + self.b) % _MERSENNE
+        return (h.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+    def band_keys(self, sig: np.ndarray) -> List[str]:
+        keys = []
+        for i in range(self.bands):
+            band = sig[i * self.rows:(i + 1) * self.rows].tobytes()
+            keys.append(f"{i}:{hashlib.blake2b(band, digest_size=8).hexdigest()}")
+        return keys
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """推定 Jaccard 係数（署名の一致率）"""
+    return float(np.mean(a == b))
+
+def encode_signature(sig: np.ndarray) -> str:
+    return sig.astype("<u4").tobytes().hex()
+
+def decode_signature(s: str) -> np.ndarray:
+    return np.frombuffer(bytes.fromhex(s), dtype="<u4")
+
+class LSHIndex:
+    """
+    メモリ上の LSH インデックス（1回のインジェスト内で、まだ登録していないチャンク同士を照合する）
+    key は呼び出し側が決める識別子（ポイント ID など）
+    """
+
+    def __init__(self, hasher: MinHasher):
+        self.hasher = hasher
+        self.buckets: Dict[str, List[str]] = {}
+        self.items: Dict[str, Tuple[np.ndarray, Dict]] = {}
+
+    def add(self, key: str, sig: np.ndarray, meta: Dict):
+        self.items[key] = (sig, meta)
+        for band in self.hasher.band_keys(sig):
+            self.buckets.setdefault(band, []).append(key)
+
+    def query(self, sig: np.ndarray, threshold: float) -> List[Tuple[float, str, Dict]]:
+        """類似度が threshold 以上の登録済み要素を (類似度, key, meta) の降順で返す"""
+        cand = {k for band in self.hasher.band_keys(sig) for k in self.buckets.get(band, [])}
+        out = []
+        for key in cand:
+            other, meta = self.items[key]
+            sim = similarity(sig, other)
+            if sim >= threshold:
+                out.append((sim, key, meta))
+        out.sort(key=lambda x: x[0], reverse=True)
+        return out
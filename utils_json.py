@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import json
+from typing import Any, Dict, IO, Iterator, List, Optional
+
+_DECODER = json.JSONDecoder()
+_WS = " \t\r\n"
+
+# Q&A レコードとみなすキー（先に見つかったものを採用）
+QUESTION_KEYS = ("question", "q", "query", "質問", "title")
+ANSWER_KEYS = ("answer", "a", "response", "回答", "content", "text", "body")
+# トップレベルがオブジェクトで、この配下にレコード配列を持つ形式
+RECORD_LIST_KEYS = ("data", "items", "records", "faqs", "faq", "questions", "entries")
+# chunk の予約フィールド（レコードの値で上書きしない）。インジェストが payload に書くキーはすべて含める
+# （parent_id で親の展開が、tenant でテナントの範囲が壊れるため）
+RESERVED_KEYS = {
+    "text", "source", "chunk_id", "page", "page_start", "page_end", "text_hash",
+    "parent_id", "parent_text", "point_id", "tenant", "minhash", "lsh", "dup_sources",
+}
+
+# =========================================
+# インクリメンタル JSON パーサ
+# =========================================
+# これより大きいトップレベルのオブジェクトは丸ごと読まず、メンバーごとに読む
+# （{"faqs": [...]} の配列はレコード1件ずつ取り出す）
+INLINE_OBJECT_CHARS = 1 << 20
+
+_MISSING = object()
+
+class _JsonStream:
+    """テキストストリームを少しずつ読む JSON リーダー（消費済みのバッファは捨ててメモリを抑える）"""
+
+    def __init__(self, fp: IO[str], read_size: int):
+        self.fp = fp
+        self.read_size = read_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, need: int) -> bool:
+        if self.eof:
+            return False
+        data = self.fp.read(need)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self) -> Optional[str]:
+        """空白を読み飛ばして次の文字を返す（EOF なら None）"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill(self.read_size):
+                return None
+
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"JSON: expected {ch!r} at offset {self.pos}")
+        self.pos += 1
+
+    def decode(self, limit: int = 0) -> Any:
+        """
+        次の値を1つ取り出す。limit を指定すると、未消費のバッファがそれを超えても
+        値が確定しない場合は読むのをやめて _MISSING を返す（位置は進めない）
+        """
+        # raw_decode は先頭の空白を読み飛ばさない（"key": value の値の前など）
+        if self.peek() is None:
+            raise ValueError("JSON: unexpected end of input")
+        need = self.read_size
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+                # 数値などはバッファ末尾で途切れている可能性があるので読み足して再試行
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            if limit and len(self.buf) - self.pos > limit:
+                return _MISSING
+            if not self.fill(need):
+                # 末尾で EOF: 最後にもう一度だけ確定させる
+                value, self.pos = _DECODER.raw_decode(self.buf, self.pos)
+                return value
+            need = min(need * 2, 1 << 26)  # 長大な要素は読み込み量を倍々に
+
+def _array_items(s: _JsonStream) -> Iterator[str]:
+    """'[' の直後から要素の先頭ごとに止まる（呼び出し側が要素を1つ読んでから次へ進める）"""
+    while True:
+        c = s.peek()
+        if c is None:
+            raise ValueError("JSON array is not closed")
+        if c == "]":
+            s.pos += 1
+            return
+        if c == ",":
+            s.pos += 1
+            continue
+        yield c
+
+def _top_level(s: _JsonStream) -> Iterator[str]:
+    """トップレベルの値の先頭ごとに止まる（配列なら要素、JSONL / 連結 JSON なら値ごと）"""
+    first = s.peek()
+    if first is None:
+        return
+    if first == "[":
+        s.pos += 1
+        yield from _array_items(s)
+        return
+    while True:
+        c = s.peek()
+        if c is None:
+            return
+        yield c
+
+def iter_json_values(fp: IO[str], read_size: int = 1 << 16) -> Iterator[Any]:
+    """
+    テキストストリームから JSON 値を逐次取り出す（ファイル全体は読み込まない）。
+      - トップレベルが配列: 要素を1件ずつ
+      - JSONL / 連結 JSON : 値を1件ずつ
+      - トップレベルがオブジェクト: そのオブジェクト1件
+    """
+    s = _JsonStream(fp, read_size)
+    for _ in _top_level(s):
+        yield s.decode()
+
+def _records(value: Any) -> Iterator[Dict]:
+    if isinstance(value, dict):
+        nested = next((value[k] for k in RECORD_LIST_KEYS if isinstance(value.get(k), list)), None)
+        if nested is not None:
+            for rec in nested:
+                if isinstance(rec, dict):
+                    yield rec
+        else:
+            yield value
+    elif isinstance(value, list):
+        for rec in value:
+            if isinstance(rec, dict):
+                yield rec
+
+def _stream_object_records(s: _JsonStream) -> Iterator[Dict]:
+    """
+    大きなオブジェクトをメンバーごとに読み、最初に現れたレコード配列（RECORD_LIST_KEYS）の要素を
+    1件ずつ返す。レコード配列がなければ、読み終えたオブジェクトを通常どおりレコードにする
+    """
+    s.expect("{")
+    obj: Dict = {}
+    streamed = False
+    while True:
+        c = s.peek()
+        if c is None:
+            raise ValueError("JSON object is not closed")
+        if c == "}":
+            s.pos += 1
+            break
+        if c == ",":
+            s.pos += 1
+            continue
+        key = s.decode()
+        s.expect(":")
+        if not streamed and key in RECORD_LIST_KEYS and s.peek() == "[":
+            streamed = True
+            s.pos += 1
+            for _ in _array_items(s):
+                rec = s.decode()
+                if isinstance(rec, dict):
+                    yield rec
+        else:
+            obj[key] = s.decode()
+    if not streamed:
+        yield from _records(obj)
+
+def iter_json_records(fp: IO[str], read_size: int = 1 << 16) -> Iterator[Dict]:
+    """
+    JSON 値をレコード（dict）単位に展開する。
+    INLINE_OBJECT_CHARS を超えるオブジェクト（{"faqs": [...]} 形式の大きなファイル）は
+    丸ごと読まずに、レコード配列の要素を1件ずつ読む
+    """
+    s = _JsonStream(fp, read_size)
+    for c in _top_level(s):
+        if c == "{":
+            value = s.decode(limit=INLINE_OBJECT_CHARS)
+            if value is _MISSING:
+                yield from _stream_object_records(s)
+                continue
+        else:
+            value = s.decode()
+        yield from _records(value)
+
+# =========================================
+# レコード → チャンク
+# =========================================
+def _first_text(rec: Dict, keys) -> str:
+    for k in keys:
+        v = rec.get(k)
+        if isinstance(v, str) and v.strip():
+            return v.strip()
+    return ""
+
+def _metadata(rec: Dict) -> Dict:
+    meta = {}
+    for k, v in rec.items():
+        if k in RESERVED_KEYS:
+            continue
+        if isinstance(v, (str, int, float, bool)):
+            meta[k] = v
+        elif isinstance(v, list) and all(isinstance(x, (str, int, float)) for x in v):
+            meta[k] = v
+    return meta
+
+def record_to_chunks(rec: Dict) -> List[Dict]:
+    """
+    1 Q&A = 1 チャンク。
+      - {"messages": [...]} 形式: user → assistant のペアごと
+      - {"question": ..., "answer": ...} 形式などはキー名から推定
+      - それ以外は "key: value" の行に整形
+    返す dict は text/title と、レコードのスカラー値をメタデータとして持つ。
+    """
+    msgs = rec.get("messages")
+    if isinstance(msgs, list):
+        out, q = [], ""
+        for m in msgs:
+            if not isinstance(m, dict):
+                continue
+            role, content = m.get("role"), str(m.get("content") or "").strip()
+            if role == "user":
+                q = content
+            elif role == "assistant" and (q or content):
+                out.append({"text": f"質問: {q}\n回答: {content}".strip(), "title": q})
+                q = ""
+        if q:
+            out.append({"text": f"質問: {q}", "title": q})
+        return out
+
+    meta = _metadata(rec)
+    q = _first_text(rec, QUESTION_KEYS)
+    a = _first_text(rec, ANSWER_KEYS)
+    if q or a:
+        text = f"質問: {q}\n回答: {a}" if q and a else (q or a)
+        meta["title"] = str(rec.get("title") or q)
+    else:
+        text = "\n".join(f"{k}: {v}" for k, v in meta.items())
+    if not text.strip():
+        return []
+    meta["text"] = text
+    return [meta]